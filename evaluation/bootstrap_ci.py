@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from metrics_engine import iter_records, LabelCoder, confusion_matrix, metrics_from_confusion, to_serializable, DEFAULT_CLASSES
+
+DEFAULT_RESAMPLES = 10000  # bootstrap重采样次数
+DEFAULT_CONFIDENCE = 0.95  # 置信区间的置信水平
+DEFAULT_SEED = 0  # 随机种子，保证结果可复现
+RESAMPLE_CHUNK_SIZE = 2000  # 每个进程任务的重采样次数
+SLICE_TYPES = ("source", "camera", "date")  # 可选的切片维度：结果文件（验证集目录）、摄像头前缀、拍摄日期
+UNKNOWN_SLICE = "unknown"  # 无法从图片名解析出切片时的取值
+IMAGE_NAME_PATTERN = re.compile(r"^(?P<camera>.*?)[_-]?(?P<date>20\d{6})")  # 图片名形如 {摄像头前缀}_{YYYYMMDD}_{HHMM}.jpg
+
+def parse_image_name(image_name):
+    """
+    从图片名中解析摄像头前缀与拍摄日期
+
+    Returns:
+        tuple: (camera, date)，无法解析时为 UNKNOWN_SLICE
+    """
+    match = IMAGE_NAME_PATTERN.match(os.path.basename(image_name or ""))
+    if not match:
+        return UNKNOWN_SLICE, UNKNOWN_SLICE
+    return match.group("camera") or UNKNOWN_SLICE, match.group("date")
+
+def _file_slice_confusions(task):
+    """
+    单个结果文件的混淆矩阵，以及每个切片取值的混淆矩阵（在进程池中运行）
+
+    Returns:
+        dict: 'confusion_matrix' 与 'slices'（切片维度 -> {取值: 混淆矩阵}）
+    """
+    path, label_name, class_names, slice_by = task
+    coder = LabelCoder(class_names)
+    label_code = coder.encode(label_name)
+    if label_code < 0:
+        raise ValueError(f"未知的标签: {label_name}")
+    num_classes = len(coder)
+    source = os.path.splitext(os.path.basename(path))[0]
+
+    # 先按 (切片维度, 取值) 收集预测编码，最后每组用 bincount 一次统计
+    preds = []
+    groups = {slice_type: {} for slice_type in slice_by}
+    for index, record in enumerate(iter_records(path)):
+        preds.append(coder.encode(record.get("final_decision")))
+        camera, date = parse_image_name(record.get("image_name"))
+        values = {"source": source, "camera": camera, "date": date}
+        for slice_type in slice_by:
+            groups[slice_type].setdefault(values[slice_type], []).append(index)
+
+    preds = np.asarray(preds, dtype=np.int8)
+    labels = np.full(len(preds), label_code, dtype=np.int8)
+    return {
+        "record_count": int(len(preds)),
+        "confusion_matrix": confusion_matrix(labels, preds, num_classes),
+        "slices": {
+            slice_type: {value: confusion_matrix(labels[indices], preds[indices], num_classes) for value, indices in values.items()}
+            for slice_type, values in groups.items()
+        }
+    }
+
+def collect_confusions(info_paths, label_names, class_names=None, slice_by=(), workers=None):
+    """
+    读取多个结果文件（每个文件对应一个真实标签），汇总整体与各切片的混淆矩阵，文件之间在进程池中并行处理
+
+    Returns:
+        dict: 'confusion_matrix'、'record_count' 与 'slices'（切片维度 -> {取值: 混淆矩阵}）
+    """
+    if len(info_paths) != len(label_names):
+        raise ValueError("结果文件与标签数量不一致")
+    unknown = set(slice_by) - set(SLICE_TYPES)
+    if unknown:
+        raise ValueError(f"未知的切片维度: {sorted(unknown)}")
+    class_names = list(class_names or DEFAULT_CLASSES)
+    tasks = [(path, label, class_names, tuple(slice_by)) for path, label in zip(info_paths, label_names)]
+    if workers == 1 or len(tasks) <= 1:
+        files = [_file_slice_confusions(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            files = list(pool.map(_file_slice_confusions, tasks))
+
+    num_classes = len(class_names)
+    slices = {slice_type: {} for slice_type in slice_by}
+    for f in files:
+        for slice_type, values in f["slices"].items():
+            for value, cm in values.items():
+                slices[slice_type][value] = slices[slice_type].get(value, 0) + cm
+    return {
+        "confusion_matrix": sum((f["confusion_matrix"] for f in files), np.zeros((num_classes, num_classes), dtype=np.int64)),
+        "record_count": sum(f["record_count"] for f in files),
+        "slices": {slice_type: dict(sorted(values.items())) for slice_type, values in slices.items()}
+    }
+
+def _resample_chunk(task):
+    """
+    一批bootstrap重采样（在进程池中运行）
+
+    对N条记录有放回地抽取N条，等价于按混淆矩阵各单元的比例做一次多项分布抽样，
+    因此不需要逐条记录索引，一次 multinomial 调用即可得到整批重采样的混淆矩阵。
+
+    Returns:
+        np.ndarray: 形状为 (size, n, n) 的混淆矩阵
+    """
+    cm, size, seed = task
+    cm = np.asarray(cm)
+    total = cm.sum()
+    if total == 0:
+        return np.zeros((size,) + cm.shape, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    counts = rng.multinomial(total, cm.ravel() / total, size=size)
+    return counts.reshape((size,) + cm.shape)
+
+def _interval(point, samples, confidence):
+    """百分位法置信区间"""
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(samples, [alpha, 1 - alpha], axis=0)
+    return {"value": point, "low": low, "high": high}
+
+def confidence_intervals(cms, n_resamples=DEFAULT_RESAMPLES, confidence=DEFAULT_CONFIDENCE, workers=None, seed=DEFAULT_SEED):
+    """
+    对多个混淆矩阵分别做bootstrap，计算准确率与各类别precision/recall/f1的置信区间
+
+    所有混淆矩阵的重采样按 RESAMPLE_CHUNK_SIZE 切分成任务，在同一个进程池中并行执行，
+    每个任务使用由 seed 派生的独立随机流，结果与进程数无关。
+
+    Args:
+        cms: 混淆矩阵列表
+        n_resamples: 重采样次数
+        confidence: 置信水平
+        workers: 进程数，None 为CPU核数，1 表示在当前进程串行处理
+        seed: 随机种子
+
+    Returns:
+        list: 与cms一一对应，每项为 {指标名: {'value', 'low', 'high'}}，accuracy 为标量，其余按类别排列
+    """
+    chunks = [min(RESAMPLE_CHUNK_SIZE, n_resamples - start) for start in range(0, n_resamples, RESAMPLE_CHUNK_SIZE)]
+    tasks = [(np.asarray(cm), size) for cm in cms for size in chunks]
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    tasks = [(cm, size, child) for (cm, size), child in zip(tasks, seeds)]
+    if workers == 1 or len(tasks) <= 1:
+        samples = [_resample_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            samples = list(pool.map(_resample_chunk, tasks))
+
+    results = []
+    for i, cm in enumerate(cms):
+        resampled = np.concatenate(samples[i * len(chunks):(i + 1) * len(chunks)])
+        point = metrics_from_confusion(cm)
+        boot = metrics_from_confusion(resampled)
+        results.append({key: _interval(point[key], boot[key], confidence) for key in ("accuracy", "precision", "recall", "f1")})
+    return results
+
+def evaluate_with_ci(info_paths, label_names, class_names=None, slice_by=(), n_resamples=DEFAULT_RESAMPLES,
+                     confidence=DEFAULT_CONFIDENCE, workers=None, seed=DEFAULT_SEED):
+    """
+    评估多个结果文件并给出bootstrap置信区间，可按切片维度分别统计
+
+    Returns:
+        dict: 'class_names'、'record_count'、'n_resamples'、'confidence'、
+            'overall'（{'confusion_matrix', 'support', 'intervals'}）与
+            'slices'（切片维度 -> {取值: 同 overall}）
+    """
+    class_names = list(class_names or DEFAULT_CLASSES)
+    collected = collect_confusions(info_paths, label_names, class_names, slice_by, workers)
+    keys = [(None, None)] + [(slice_type, value) for slice_type, values in collected["slices"].items() for value in values]
+    cms = [collected["confusion_matrix"] if slice_type is None else collected["slices"][slice_type][value]
+           for slice_type, value in keys]
+    intervals = confidence_intervals(cms, n_resamples, confidence, workers, seed)
+
+    entries = [{"confusion_matrix": cm, "support": int(cm.sum()), "intervals": ci} for cm, ci in zip(cms, intervals)]
+    slices = {slice_type: {} for slice_type in collected["slices"]}
+    for (slice_type, value), entry in zip(keys[1:], entries[1:]):
+        slices[slice_type][value] = entry
+    return {
+        "class_names": class_names,
+        "record_count": collected["record_count"],
+        "n_resamples": n_resamples,
+        "confidence": confidence,
+        "overall": entries[0],
+        "slices": slices
+    }
+
+def _format_interval(interval, index=None):
+    pick = (lambda v: v) if index is None else (lambda v: v[index])
+    return f"{pick(interval['value']):.4f} [{pick(interval['low']):.4f}, {pick(interval['high']):.4f}]"
+
+def print_ci_report(result):
+    """打印整体与各切片的指标及置信区间"""
+    print(f"bootstrap: {result['n_resamples']} 次重采样, 置信水平 {result['confidence']:.0%}, 记录数 {result['record_count']}")
+
+    def print_entry(title, entry):
+        intervals = entry["intervals"]
+        print(f"\n{title}（样本数 {entry['support']}）")
+        print(f"  acc: {_format_interval(intervals['accuracy'])}")
+        for class_id, class_name in enumerate(result["class_names"]):
+            print(f"  {class_name}")
+            for key in ("precision", "recall", "f1"):
+                print(f"\t{key}: {_format_interval(intervals[key], class_id)}")
+
+    print_entry("整体", result["overall"])
+    for slice_type, values in result["slices"].items():
+        print('\n' + '=' * 50)
+        print(f"按 {slice_type} 切片:")
+        print('=' * 50)
+        for value, entry in values.items():
+            print_entry(f"【{value}】", entry)
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="推理结果指标的bootstrap置信区间与切片统计")
+    parser.add_argument("--results", nargs="+", required=True, help="结果文件（.jsonl 或 .json）")
+    parser.add_argument("--labels", nargs="+", required=True, help="每个结果文件的真实标签，与--results一一对应")
+    parser.add_argument("--classes", nargs="+", default=DEFAULT_CLASSES, help="类别列表")
+    parser.add_argument("--slice-by", nargs="*", choices=SLICE_TYPES, default=[], help="切片维度")
+    parser.add_argument("--resamples", type=int, default=DEFAULT_RESAMPLES, help="bootstrap重采样次数")
+    parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE, help="置信水平")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="随机种子")
+    parser.add_argument("--workers", type=int, default=None, help="进程数")
+    parser.add_argument("--output", default=None, help="结果JSON路径")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    result = evaluate_with_ci(args.results, args.labels, args.classes, args.slice_by, args.resamples,
+                              args.confidence, args.workers, args.seed)
+    print_ci_report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(to_serializable(result), f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到: {args.output}")
+
+if __name__ == "__main__":
+    main()
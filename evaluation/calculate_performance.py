@@ -1,34 +1,34 @@
-import json
-import os
-import shutil
-import re
-from tqdm import tqdm
-from sklearn.metrics import recall_score,precision_score,accuracy_score,f1_score,confusion_matrix
-import numpy as np
+from metrics_engine import evaluate, print_report, DEFAULT_CLASSES
+from bootstrap_ci import evaluate_with_ci, print_ci_report
+
+def _unique(items):
+    """去重后的元素：可哈希时用集合，否则（如检测框列表）退回列表逐个比较"""
+    try:
+        return set(items)
+    except TypeError:
+        unique = []
+        for item in items:
+            if item not in unique:
+                unique.append(item)
+        return unique
 
 def calculate_precision(labels, preds):
     """计算precision"""
-    true_positives = 0
-    false_positives = 0
     if len(labels) == 0 and len(preds) == 0:
         return None
-    for pred in preds:
-        if pred in labels:
-            true_positives += 1
-        else:
-            false_positives += 1
+    label_set = _unique(labels)
+    true_positives = sum(1 for pred in preds if pred in label_set)
+    false_positives = len(preds) - true_positives
     return true_positives / (true_positives + false_positives) if true_positives + false_positives > 0 else 0
 
 def calculate_recall(labels, preds):
     """计算recall"""
     total = len(labels)
-    pred_true = []
     if len(labels) == 0 and len(preds) == 0:
         return None
-    for pred in preds:
-        if pred in labels and pred not in pred_true:
-            pred_true.append(pred)
-    return len(pred_true) / total if total > 0 else 0
+    label_set = _unique(labels)
+    pred_true = sum(1 for pred in _unique(preds) if pred in label_set)
+    return pred_true / total if total > 0 else 0
 
 def calculate_f1_score(labels, preds):
     """计算f1_score"""
@@ -36,65 +36,26 @@ def calculate_f1_score(labels, preds):
     recall = calculate_recall(labels, preds)
     return 2 * (precision * recall) / (precision + recall) if precision + recall > 0 else 0
 
-def calculate_performance(info_paths:list,label_names:list):
-
-    label_list = []
-    predict_list = []
-    
-
-    for idx,info_path in enumerate(info_paths):
-        with open(info_path,'r',encoding='utf-8') as f:
-            predict_info = json.load(f)
-
-
-        for info in tqdm(predict_info['all_results']):
-            predict = info['final_decision']
-            predict_int = classes_name.index(predict)
-            label_int = classes_name.index(label_names[idx])
-        
-            predict_list.append(predict_int)
-            label_list.append(label_int)
-
-    # 准确率 
-    print('-----------------------------'*3)
-    acc = accuracy_score(label_list, predict_list)
-
-    # 精确率
-    precision = precision_score(label_list, predict_list, zero_division=0,average=None)
-    # 召回率
-    recall = recall_score(label_list, predict_list, zero_division=0,average=None)
-    # f1-score
-    f1 = f1_score(label_list, predict_list, zero_division=0,average=None)
-    
-    # 计算混淆矩阵
-    cm = confusion_matrix(label_list, predict_list)
-    print(f'混淆矩阵:\n{cm}')
-    print('-----------------------------'*3)
-    
-    print(f'acc: {acc:.4f}')
-    for class_id,class_name in enumerate(classes_name):
-        print(f'{class_name}\n\tprecision: {precision[class_id]:.4f}\n\trecall: {recall[class_id]:.4f}\n\tf1_score: {f1[class_id]:.4f}')
-
-    # 计算每个类别的TP、TN、FP、FN
-    print('\n' + '='*50)
-    print('每个类别的混淆矩阵指标:')
-    print('='*50)
-    
-    for class_id, class_name in enumerate(classes_name):
-        # 对于多分类问题，将当前类作为正类，其他类作为负类
-        tp = cm[class_id, class_id]  # 真正例：实际为该类且预测为该类
-        fn = np.sum(cm[class_id, :]) - tp  # 假负例：实际为该类但预测为其他类
-        fp = np.sum(cm[:, class_id]) - tp  # 假正例：实际为其他类但预测为该类
-        tn = np.sum(cm) - tp - fn - fp  # 真负例：实际为其他类且预测为其他类
-        
-        print(f'\n【{class_name}】:')
-        print(f'  TP (真正例): {tp}')
-        print(f'  TN (真负例): {tn}')
-        print(f'  FP (假正例): {fp}')
-        print(f'  FN (假负例): {fn}')
-        print(f'  总样本数: {tp + tn + fp + fn}')
+def calculate_performance(info_paths:list,label_names:list,classes_name:list=None,workers:int=None,
+                          n_resamples:int=0,slice_by:list=None):
+    """
+    计算多个结果文件的整体指标并打印（每个文件对应一个真实标签）
 
+    结果文件流式读取、决策编码为整数后用 bincount 统计混淆矩阵，多个文件在进程池中并行处理，详见 metrics_engine。
+    n_resamples 大于0时额外打印bootstrap置信区间，slice_by 指定切片维度（source/camera/date），详见 bootstrap_ci。
 
+    Returns:
+        dict: metrics_engine.evaluate 的评估结果，计算置信区间时 'bootstrap' 为 bootstrap_ci.evaluate_with_ci 的结果
+    """
+    if classes_name is None:
+        classes_name = DEFAULT_CLASSES
+    result = evaluate(info_paths, label_names, classes_name, workers)
+    print_report(result)
+    if n_resamples > 0:
+        print('\n' + '=' * 50)
+        result["bootstrap"] = evaluate_with_ci(info_paths, label_names, classes_name, slice_by or (), n_resamples, workers=workers)
+        print_ci_report(result["bootstrap"])
+    return result
 
 
 if __name__ == "__main__":
@@ -102,6 +63,5 @@ if __name__ == "__main__":
     predict_paths = ["inference_result/complete_directory_test_20250715_014557.json","inference_result/complete_directory_test_20250715_022547.json"]
     label_names = ["盖板缺失","盖板存在"] # 指定当前验证集的正确标签，需要与predict_paths的一一对应
     assert len(predict_paths) == len(label_names)
-    calculate_performance(predict_paths,label_names)  
-        
-        
\ No newline at end of file
+    # 需要置信区间与切片统计时传入 n_resamples/slice_by，或使用 bootstrap_ci.py 的命令行
+    calculate_performance(predict_paths,label_names,classes_name)  
@@ -0,0 +1,294 @@
+import json
+import argparse
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+DEFAULT_CLASSES = ["盖板缺失", "盖板存在"]  # 类别顺序，编码即下标
+INVALID_CODE = -1  # 无法识别的决策（如处理失败、没有final_decision）的编码
+READ_CHUNK_SIZE = 1 << 20  # 流式解析旧版JSON时每次读取的字符数
+STORE_SUFFIXES = (".db", ".sqlite", ".sqlite3")  # 视为结果库（见 result_store）的文件后缀
+RUN_SEPARATOR = "#"  # 结果库路径中指定运行名的分隔符，如 results.db#complete_directory_test_20250715_014557
+
+def _iter_json_array(f, key="all_results", chunk_size=READ_CHUNK_SIZE):
+    """
+    流式解析JSON文件中指定键的数组，逐个产出元素，不把整个文件读入内存
+
+    使用 JSONDecoder.raw_decode 从缓冲区中逐个解析数组元素，缓冲区只保留尚未解析的部分。
+    """
+    decoder = json.JSONDecoder()
+    marker = f'"{key}"'
+    buffer = ""
+    # 定位键名
+    while True:
+        index = buffer.find(marker)
+        if index >= 0:
+            buffer = buffer[index + len(marker):]
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buffer = buffer[-len(marker):] + chunk
+    # 跳过冒号，定位数组开头
+    while True:
+        stripped = buffer.lstrip().lstrip(":").lstrip()
+        if stripped:
+            if stripped[0] != "[":
+                return
+            buffer = stripped[1:]
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+
+    position = 0
+    eof = False
+    while True:
+        # 跳过空白与逗号
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            if position >= len(buffer):
+                raise json.JSONDecodeError("缓冲区已读完", buffer, position)
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # 元素跨越了缓冲区边界，读入更多内容后重试
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+        position = end
+        if position > chunk_size:
+            buffer = buffer[position:]
+            position = 0
+
+def iter_records(path):
+    """
+    逐条读取推理结果，兼容三种格式：
+        - JSONL：每行一条结果（忽略崩溃留下的不完整末行）
+        - 旧版 complete_directory_test_*.json：流式解析其中的 all_results
+        - 结果库（results.db 或 results.db#运行名，见 result_store）
+    """
+    if is_store_path(path):
+        yield from iter_store_records(path)
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+        else:
+            yield from _iter_json_array(f)
+
+def is_store_path(path):
+    """是否为结果库路径（可带 #运行名）"""
+    return path.split(RUN_SEPARATOR, 1)[0].endswith(STORE_SUFFIXES)
+
+def iter_store_records(path):
+    from result_store import iter_store_records as iter_store  # result_store 依赖本模块，延迟导入
+    yield from iter_store(path)
+
+def read_store_decisions(path):
+    from result_store import read_store_decisions as read_decisions  # result_store 依赖本模块，延迟导入
+    return read_decisions(path)
+
+class LabelCoder:
+    """类别名与整数编码的映射，未知类别编码为 INVALID_CODE"""
+
+    def __init__(self, class_names=None):
+        self.class_names = list(class_names or DEFAULT_CLASSES)
+        if len(self.class_names) > 127:
+            raise ValueError("类别数不能超过127")
+        self._codes = {name: code for code, name in enumerate(self.class_names)}
+
+    def encode(self, name):
+        return self._codes.get(name, INVALID_CODE)
+
+    def __len__(self):
+        return len(self.class_names)
+
+def encode_predictions(path, class_names=None):
+    """
+    流式读取一个结果文件，把每条记录的 final_decision 编码为整数
+
+    Returns:
+        np.ndarray: int8 编码数组（每条记录1字节），无法识别的决策为 INVALID_CODE
+    """
+    coder = LabelCoder(class_names)
+    if is_store_path(path):
+        # 结果库只读取 final_decision 一列
+        codes = array("b", (coder.encode(decision) for decision in read_store_decisions(path)))
+    else:
+        codes = array("b", (coder.encode(record.get("final_decision")) for record in iter_records(path)))
+    return np.frombuffer(codes, dtype=np.int8) if codes else np.zeros(0, dtype=np.int8)
+
+def confusion_matrix(labels, preds, num_classes):
+    """
+    用 bincount 计算混淆矩阵，行为真实类别、列为预测类别；
+    任一方为 INVALID_CODE 的样本不计入
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    preds = np.asarray(preds, dtype=np.int64)
+    valid = (labels >= 0) & (preds >= 0)
+    return np.bincount(labels[valid] * num_classes + preds[valid],
+                       minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+def _safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+def metrics_from_confusion(cm):
+    """
+    由混淆矩阵计算各类别的TP/FP/FN/TN、precision、recall、f1与整体准确率（除零时为0，与sklearn zero_division=0一致）
+
+    cm 也可以是形状为 (..., n, n) 的一批混淆矩阵（如bootstrap重采样），此时各指标多出相同的前导维度。
+
+    Returns:
+        dict: 'accuracy' 为标量（批量时为数组），其余为按类别排列的数组
+    """
+    cm = np.asarray(cm)
+    total = cm.sum(axis=(-2, -1))
+    tp = np.diagonal(cm, axis1=-2, axis2=-1)
+    fp = cm.sum(axis=-2) - tp
+    fn = cm.sum(axis=-1) - tp
+    tn = np.expand_dims(total, -1) - tp - fp - fn
+    precision = _safe_divide(tp, tp + fp)
+    recall = _safe_divide(tp, tp + fn)
+    accuracy = _safe_divide(tp.sum(axis=-1), total)
+    return {
+        "accuracy": float(accuracy) if cm.ndim == 2 else accuracy,
+        "precision": precision,
+        "recall": recall,
+        "f1": _safe_divide(2 * precision * recall, precision + recall),
+        "support": tp + fn,
+        "tp": tp,
+        "fp": fp,
+        "fn": fn,
+        "tn": tn
+    }
+
+def _file_confusion(task):
+    """单个结果文件的混淆矩阵（在进程池中运行，只返回 n×n 矩阵与计数）"""
+    path, label_name, class_names = task
+    coder = LabelCoder(class_names)
+    preds = encode_predictions(path, class_names)
+    label_code = coder.encode(label_name)
+    if label_code == INVALID_CODE:
+        raise ValueError(f"未知的标签: {label_name}")
+    labels = np.full(len(preds), label_code, dtype=np.int8)
+    return {
+        "path": path,
+        "label": label_name,
+        "record_count": int(len(preds)),
+        "invalid_count": int((preds == INVALID_CODE).sum()),
+        "confusion_matrix": confusion_matrix(labels, preds, len(coder))
+    }
+
+def evaluate(info_paths, label_names, class_names=None, workers=None):
+    """
+    评估多个结果文件（每个文件对应一个真实标签），文件之间在进程池中并行处理
+
+    Args:
+        info_paths: 结果文件列表（.jsonl 或旧版 .json）
+        label_names: 每个文件的真实标签，与info_paths一一对应
+        class_names: 类别列表，默认 DEFAULT_CLASSES
+        workers: 进程数，None 为CPU核数，1 表示在当前进程串行处理
+
+    Returns:
+        dict: 'class_names'、'confusion_matrix'、'metrics'（见 metrics_from_confusion）、
+            'files'（每个文件的记录数、无效记录数与混淆矩阵）、'record_count'、'invalid_count'
+    """
+    if len(info_paths) != len(label_names):
+        raise ValueError("结果文件与标签数量不一致")
+    class_names = list(class_names or DEFAULT_CLASSES)
+    tasks = [(path, label, class_names) for path, label in zip(info_paths, label_names)]
+    if workers == 1 or len(tasks) <= 1:
+        files = [_file_confusion(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            files = list(pool.map(_file_confusion, tasks))
+
+    num_classes = len(class_names)
+    cm = sum((f["confusion_matrix"] for f in files), np.zeros((num_classes, num_classes), dtype=np.int64))
+    return {
+        "class_names": class_names,
+        "confusion_matrix": cm,
+        "metrics": metrics_from_confusion(cm),
+        "files": files,
+        "record_count": sum(f["record_count"] for f in files),
+        "invalid_count": sum(f["invalid_count"] for f in files)
+    }
+
+def to_serializable(value):
+    """把评估结果中的NumPy数组与数值转换为可JSON序列化的类型"""
+    if isinstance(value, dict):
+        return {key: to_serializable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_serializable(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def print_report(result):
+    """按 calculate_performance 的格式打印评估结果"""
+    cm = result["confusion_matrix"]
+    metrics = result["metrics"]
+    print('-----------------------------' * 3)
+    print(f'混淆矩阵:\n{cm}')
+    print('-----------------------------' * 3)
+    print(f'acc: {metrics["accuracy"]:.4f}')
+    for class_id, class_name in enumerate(result["class_names"]):
+        print(f'{class_name}\n\tprecision: {metrics["precision"][class_id]:.4f}\n\trecall: {metrics["recall"][class_id]:.4f}'
+              f'\n\tf1_score: {metrics["f1"][class_id]:.4f}')
+    if result["invalid_count"]:
+        print(f'无法识别决策的记录（未计入）: {result["invalid_count"]}/{result["record_count"]}')
+
+    print('\n' + '=' * 50)
+    print('每个类别的混淆矩阵指标:')
+    print('=' * 50)
+    for class_id, class_name in enumerate(result["class_names"]):
+        tp, tn, fp, fn = (metrics[key][class_id] for key in ("tp", "tn", "fp", "fn"))
+        print(f'\n【{class_name}】:')
+        print(f'  TP (真正例): {tp}')
+        print(f'  TN (真负例): {tn}')
+        print(f'  FP (假正例): {fp}')
+        print(f'  FN (假负例): {fn}')
+        print(f'  总样本数: {tp + tn + fp + fn}')
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="流式评估推理结果（混淆矩阵与各类别指标）")
+    parser.add_argument("--results", nargs="+", required=True, help="结果文件（.jsonl 或 .json）")
+    parser.add_argument("--labels", nargs="+", required=True, help="每个结果文件的真实标签，与--results一一对应")
+    parser.add_argument("--classes", nargs="+", default=DEFAULT_CLASSES, help="类别列表")
+    parser.add_argument("--workers", type=int, default=None, help="并行处理文件的进程数")
+    parser.add_argument("--output", default=None, help="评估结果JSON路径")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    result = evaluate(args.results, args.labels, args.classes, args.workers)
+    print_report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(to_serializable(result), f, ensure_ascii=False, indent=2)
+        print(f"评估结果已保存到: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+import csv
+import json
+import argparse
+import itertools
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from metrics_engine import iter_records, LabelCoder, confusion_matrix, metrics_from_confusion, to_serializable, DEFAULT_CLASSES, INVALID_CODE
+
+POSITIVE_CLASS = "盖板缺失"  # 正类（告警）
+NEGATIVE_CLASS = "盖板存在"
+POSITIVE_ANSWER = "存在盖板缺失"  # VLM确认盖板缺失时的答案
+DEFAULT_OPEN_CLASSES = ["gaiban_open"]  # 视为盖板缺失的YOLO类别
+DEFAULT_STORED_THRESHOLD = 0.25  # 推理时使用的YOLO置信度阈值，结果中只保存了不低于它的检测框
+DEFAULT_THRESHOLDS = [round(t, 2) for t in np.arange(0.25, 1.0, 0.05)]  # 扫描的YOLO置信度阈值
+DEFAULT_MIN_BOXES = [1]  # 扫描的最少盖板缺失框数
+DEFAULT_GATES = ["none:none"]  # 扫描的VLM送检区间 skip_below:accept_above
+
+# VLM答案编码
+VLM_NEGATIVE = 0
+VLM_POSITIVE = 1
+VLM_MISSING = -1  # 原始推理中没有调用VLM或VLM失败
+
+def _extract_file(task):
+    """
+    流式读取一个结果文件，提取回放所需的最少信息（在进程池中运行）
+
+    与 metrics_engine 一致，final_decision 无法识别的记录（如处理失败）不参与回放，只计数。
+
+    Returns:
+        dict: 'labels'（int8，每条记录的真实类别编码）、'vlm_answers'（int8）、
+            'box_conf'（float32，所有盖板缺失框的置信度）、'box_record'（int32，框所属的记录下标）、
+            'excluded'（跳过的无效记录数）
+    """
+    path, label_name, class_names, open_class_names = task
+    coder = LabelCoder(class_names)
+    label_code = coder.encode(label_name)
+    if label_code < 0:
+        raise ValueError(f"未知的标签: {label_name}")
+    open_class_names = set(open_class_names)
+    vlm_answers = array("b")
+    box_conf = array("f")
+    box_record = array("i")
+    excluded = 0
+    for record in iter_records(path):
+        if coder.encode(record.get("final_decision")) < 0:
+            excluded += 1
+            continue
+        index = len(vlm_answers)
+        vlm = record.get("vlm_analysis") or {}
+        if vlm.get("success") and vlm.get("answer"):
+            vlm_answers.append(VLM_POSITIVE if vlm["answer"] == POSITIVE_ANSWER else VLM_NEGATIVE)
+        else:
+            vlm_answers.append(VLM_MISSING)
+        for obj in (record.get("yolo_detection") or {}).get("objects", []):
+            if obj.get("class_name") in open_class_names:
+                box_conf.append(obj["conf"])
+                box_record.append(index)
+    return {
+        "labels": np.full(len(vlm_answers), label_code, dtype=np.int8),
+        "vlm_answers": np.frombuffer(vlm_answers, dtype=np.int8) if vlm_answers else np.zeros(0, dtype=np.int8),
+        "box_conf": np.frombuffer(box_conf, dtype=np.float32) if box_conf else np.zeros(0, dtype=np.float32),
+        "box_record": np.frombuffer(box_record, dtype=np.int32) if box_record else np.zeros(0, dtype=np.int32),
+        "excluded": excluded
+    }
+
+def load_replay_data(info_paths, label_names, open_class_names=None, workers=None):
+    """
+    读取多个结果文件（每个文件对应一个真实标签）并合并为回放数据，文件之间在进程池中并行读取
+
+    Returns:
+        dict: 'record_count'（参与回放的记录数）、'excluded_count'（无效记录数）
+            以及 _extract_file 返回的各数组（box_record 为合并后的全局记录下标）
+    """
+    if len(info_paths) != len(label_names):
+        raise ValueError("结果文件与标签数量不一致")
+    open_class_names = list(open_class_names or DEFAULT_OPEN_CLASSES)
+    tasks = [(path, label, [POSITIVE_CLASS, NEGATIVE_CLASS], open_class_names) for path, label in zip(info_paths, label_names)]
+    if workers == 1 or len(tasks) <= 1:
+        parts = [_extract_file(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_extract_file, tasks))
+
+    offsets = np.cumsum([0] + [len(part["labels"]) for part in parts])
+    return {
+        "record_count": int(offsets[-1]),
+        "excluded_count": sum(part["excluded"] for part in parts),
+        "labels": np.concatenate([part["labels"] for part in parts]),
+        "vlm_answers": np.concatenate([part["vlm_answers"] for part in parts]),
+        "box_conf": np.concatenate([part["box_conf"] for part in parts]),
+        "box_record": np.concatenate([part["box_record"] + offset for part, offset in zip(parts, offsets[:-1])])
+    }
+
+def open_box_stats(data, threshold):
+    """
+    每条记录中置信度不低于threshold的盖板缺失框数与最高置信度
+
+    Returns:
+        tuple: (框数 int64数组, 最高置信度 float32数组，没有框时为0)
+    """
+    keep = data["box_conf"] >= threshold
+    records = data["box_record"][keep]
+    counts = np.bincount(records, minlength=data["record_count"])
+    max_conf = np.zeros(data["record_count"], dtype=np.float32)
+    np.maximum.at(max_conf, records, data["box_conf"][keep])
+    return counts, max_conf
+
+def replay_decisions(data, counts, max_conf, min_boxes=1, skip_below=None, accept_above=None):
+    """
+    按指定规则重新得出每条记录的最终决策，规则与 hybrid_server / VLMGatePolicy 一致：
+        - 盖板缺失框数少于min_boxes：盖板存在（no_open）
+        - 最高置信度 >= accept_above：盖板缺失，不调用VLM（accept）
+        - 最高置信度 <  skip_below：盖板存在，不调用VLM（reject）
+        - 其余送VLM（escalate）：按VLM答案决定；结果中没有VLM答案（原始推理未调用VLM或VLM失败）时无法回放，
+          决策记为 INVALID_CODE，不计入混淆矩阵，单独统计（'missing'）
+
+    Returns:
+        dict: 'preds'（0为盖板缺失、1为盖板存在、INVALID_CODE为缺VLM答案）以及 'accept'、'reject'、'escalate'、'missing' 布尔数组
+    """
+    has_open = counts >= max(1, min_boxes)
+    accept = has_open & (max_conf >= accept_above) if accept_above is not None else np.zeros_like(has_open)
+    reject = has_open & ~accept & (max_conf < skip_below) if skip_below is not None else np.zeros_like(has_open)
+    escalate = has_open & ~accept & ~reject
+    missing = escalate & (data["vlm_answers"] == VLM_MISSING)
+    positive = accept | (escalate & (data["vlm_answers"] == VLM_POSITIVE))
+    preds = np.where(positive, 0, 1).astype(np.int8)
+    preds[missing] = INVALID_CODE
+    return {
+        "preds": preds,
+        "accept": accept,
+        "reject": reject,
+        "escalate": escalate,
+        "missing": missing
+    }
+
+def evaluate_operating_point(data, counts, max_conf, threshold, min_boxes=1, skip_below=None, accept_above=None):
+    """
+    评估一个工作点：混淆矩阵、正类（盖板缺失）的precision/recall/f1、准确率与VLM调用率
+
+    缺VLM答案的记录不计入混淆矩阵与各指标，数量记在 'vlm_missing'，按真实类别的分布记在 'vlm_missing_by_label'
+    """
+    decisions = replay_decisions(data, counts, max_conf, min_boxes, skip_below, accept_above)
+    cm = confusion_matrix(data["labels"], decisions["preds"], 2)
+    metrics = metrics_from_confusion(cm)
+    total = data["record_count"]
+    evaluated = int(cm.sum())
+    escalate_count = int(decisions["escalate"].sum())
+    missing_labels = data["labels"][decisions["missing"]]
+    return {
+        "threshold": float(threshold),
+        "min_boxes": min_boxes,
+        "skip_below": skip_below,
+        "accept_above": accept_above,
+        "confusion_matrix": cm,
+        "accuracy": metrics["accuracy"],
+        "precision": float(metrics["precision"][0]),
+        "recall": float(metrics["recall"][0]),
+        "f1": float(metrics["f1"][0]),
+        "alarm_rate": float((decisions["preds"] == 0).sum() / evaluated) if evaluated else 0.0,
+        "vlm_call_rate": escalate_count / total if total else 0.0,
+        "vlm_calls": escalate_count,
+        "evaluated_count": evaluated,
+        "vlm_missing": int(decisions["missing"].sum()),
+        "vlm_missing_by_label": np.bincount(missing_labels, minlength=2)[:2].tolist(),
+        "accept_count": int(decisions["accept"].sum()),
+        "reject_count": int(decisions["reject"].sum())
+    }
+
+def parse_gate(value):
+    """解析送检区间 'skip_below:accept_above'，none 表示不限制；'yolo' 表示只用YOLO（全部直接接受）"""
+    if value == "yolo":
+        return None, 0.0
+    skip_below, accept_above = value.split(":")
+    parse = lambda v: None if v.lower() == "none" else float(v)
+    return parse(skip_below), parse(accept_above)
+
+def sweep(data, thresholds=None, min_boxes=None, gates=None):
+    """
+    在 YOLO阈值 x 最少框数 x 送检区间 的网格上评估所有工作点，每个阈值只统计一次框数与最高置信度
+
+    Args:
+        data: load_replay_data 的返回值
+        thresholds: YOLO置信度阈值列表
+        min_boxes: 最少盖板缺失框数列表
+        gates: 送检区间列表，元素为 (skip_below, accept_above)
+
+    Returns:
+        list: 每个工作点的评估结果（见 evaluate_operating_point）
+    """
+    thresholds = thresholds if thresholds is not None else DEFAULT_THRESHOLDS
+    min_boxes = min_boxes if min_boxes is not None else DEFAULT_MIN_BOXES
+    gates = gates if gates is not None else [parse_gate(gate) for gate in DEFAULT_GATES]
+    points = []
+    for threshold in thresholds:
+        counts, max_conf = open_box_stats(data, threshold)
+        for boxes, (skip_below, accept_above) in itertools.product(min_boxes, gates):
+            points.append(evaluate_operating_point(data, counts, max_conf, threshold, boxes, skip_below, accept_above))
+    return points
+
+def pr_curves(points):
+    """按 (最少框数, 送检区间) 分组，每组按阈值排列的PR曲线"""
+    curves = {}
+    for point in points:
+        key = (point["min_boxes"], point["skip_below"], point["accept_above"])
+        curves.setdefault(key, []).append(point)
+    return [
+        {
+            "min_boxes": key[0],
+            "skip_below": key[1],
+            "accept_above": key[2],
+            "points": [
+                {key: point[key] for key in ("threshold", "precision", "recall", "f1", "vlm_call_rate")}
+                for point in sorted(group, key=lambda p: p["threshold"])
+            ]
+        }
+        for key, group in curves.items()
+    ]
+
+def best_operating_point(points, max_vlm_call_rate=None, min_recall=None):
+    """满足约束（VLM调用率上限、最低召回率）的工作点中F1最高的一个，没有满足约束的工作点时返回None"""
+    candidates = [
+        p for p in points
+        if (max_vlm_call_rate is None or p["vlm_call_rate"] <= max_vlm_call_rate)
+        and (min_recall is None or p["recall"] >= min_recall)
+    ]
+    return max(candidates, key=lambda p: (p["f1"], -p["vlm_call_rate"])) if candidates else None
+
+def save_points_csv(points, path):
+    """将所有工作点保存为CSV（混淆矩阵展开为 tp/fn/fp/tn，正类为盖板缺失）"""
+    fields = ["threshold", "min_boxes", "skip_below", "accept_above", "accuracy", "precision", "recall", "f1",
+              "alarm_rate", "vlm_call_rate", "vlm_calls", "evaluated_count", "vlm_missing", "accept_count", "reject_count"]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(fields + ["vlm_missing_positive", "vlm_missing_negative", "tp", "fn", "fp", "tn"])
+        for point in points:
+            cm = point["confusion_matrix"]
+            writer.writerow([point[field] for field in fields] + point["vlm_missing_by_label"]
+                            + [cm[0][0], cm[0][1], cm[1][0], cm[1][1]])
+
+def format_gate(point):
+    if point["skip_below"] is None and point["accept_above"] == 0.0:
+        return "只用YOLO"
+    if point["skip_below"] is None and point["accept_above"] is None:
+        return "全部送检"
+    return f"[{point['skip_below']}, {point['accept_above']})"
+
+def print_points(points, top=20):
+    """按F1从高到低打印工作点"""
+    print(f"{'阈值':>6}{'框数':>6}  {'送检区间':<16}{'precision':>10}{'recall':>10}{'f1':>10}{'VLM调用率':>12}{'缺VLM答案':>10}")
+    for point in sorted(points, key=lambda p: -p["f1"])[:top]:
+        print(f"{point['threshold']:>6.2f}{point['min_boxes']:>6}  {format_gate(point):<16}{point['precision']:>10.4f}"
+              f"{point['recall']:>10.4f}{point['f1']:>10.4f}{point['vlm_call_rate']:>12.2%}{point['vlm_missing']:>10}")
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="基于已保存的推理结果离线扫描YOLO阈值与VLM送检策略")
+    parser.add_argument("--results", nargs="+", required=True, help="结果文件（.jsonl 或 .json）")
+    parser.add_argument("--labels", nargs="+", required=True, help="每个结果文件的真实标签，与--results一一对应")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=DEFAULT_THRESHOLDS, help="YOLO置信度阈值")
+    parser.add_argument("--stored-threshold", type=float, default=DEFAULT_STORED_THRESHOLD,
+                        help="推理时使用的YOLO阈值，低于它的阈值无法回放")
+    parser.add_argument("--min-boxes", type=int, nargs="+", default=DEFAULT_MIN_BOXES, help="最少盖板缺失框数")
+    parser.add_argument("--gates", nargs="+", default=DEFAULT_GATES,
+                        help="VLM送检区间 skip_below:accept_above（none表示不限制），yolo 表示只用YOLO")
+    parser.add_argument("--open-classes", nargs="+", default=DEFAULT_OPEN_CLASSES, help="视为盖板缺失的YOLO类别")
+    parser.add_argument("--max-vlm-call-rate", type=float, default=None, help="选择最佳工作点时的VLM调用率上限")
+    parser.add_argument("--min-recall", type=float, default=None, help="选择最佳工作点时的最低召回率")
+    parser.add_argument("--workers", type=int, default=None, help="并行读取文件的进程数")
+    parser.add_argument("--output", default=None, help="扫描结果JSON路径（含PR曲线）")
+    parser.add_argument("--csv", default=None, help="工作点CSV路径")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    thresholds = sorted(t for t in args.thresholds if t >= args.stored_threshold)
+    skipped = sorted(set(args.thresholds) - set(thresholds))
+    if skipped:
+        print(f"跳过低于推理阈值 {args.stored_threshold} 的阈值（结果中没有对应的检测框）: {skipped}")
+    gates = [parse_gate(gate) for gate in args.gates]
+
+    data = load_replay_data(args.results, args.labels, args.open_classes, args.workers)
+    points = sweep(data, thresholds, args.min_boxes, gates)
+    print(f"记录数: {data['record_count']}（跳过无效记录 {data['excluded_count']} 条）, "
+          f"盖板缺失框数: {len(data['box_conf'])}, 工作点数: {len(points)}")
+    print_points(points)
+
+    best = best_operating_point(points, args.max_vlm_call_rate, args.min_recall)
+    if best is not None:
+        print(f"\n最佳工作点: 阈值 {best['threshold']:.2f}, 框数 >= {best['min_boxes']}, 送检区间 {format_gate(best)}, "
+              f"f1 {best['f1']:.4f}, VLM调用率 {best['vlm_call_rate']:.2%}")
+        print(f"混淆矩阵（行为真实类别，列为预测，顺序 {POSITIVE_CLASS}/{NEGATIVE_CLASS}）:\n{best['confusion_matrix']}")
+    else:
+        print("\n没有满足约束的工作点")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(to_serializable({
+                "record_count": data["record_count"],
+                "excluded_count": data["excluded_count"],
+                "stored_threshold": args.stored_threshold,
+                "operating_points": points,
+                "pr_curves": pr_curves(points),
+                "best": best
+            }), f, ensure_ascii=False, indent=2)
+        print(f"扫描结果已保存到: {args.output}")
+    if args.csv:
+        save_points_csv(points, args.csv)
+        print(f"工作点已保存到: {args.csv}")
+
+if __name__ == "__main__":
+    main()
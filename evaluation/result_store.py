@@ -0,0 +1,506 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import numpy as np
+from metrics_engine import iter_records, RUN_SEPARATOR
+
+INSERT_BATCH_SIZE = 1000  # 导入时每批写入的图片数
+
+# predict 的保存方式：能由 think/answer 还原时不保存原文
+PREDICT_VERBATIM = 0  # 原样保存
+PREDICT_THINK_ANSWER = 1  # <think>\n{think}\n</think>\n<answer>{answer}</answer>
+PREDICT_ANSWER_ONLY = 2  # 快速模式：<answer>{answer}</answer>
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    source_path TEXT,
+    imported_at REAL,
+    image_count INTEGER,
+    summary TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    image_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    image_name TEXT,
+    success INTEGER,
+    final_decision TEXT,
+    gate_decision TEXT,
+    used_vlm INTEGER,
+    open_count INTEGER,
+    total_objects INTEGER,
+    boxes_returned INTEGER,
+    has_yolo INTEGER,
+    processing_time REAL,
+    queue_time REAL,
+    error TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS boxes (
+    image_id INTEGER NOT NULL REFERENCES images(image_id),
+    box_index INTEGER NOT NULL,
+    class_id INTEGER,
+    class_name TEXT,
+    conf REAL,
+    x1 REAL,
+    y1 REAL,
+    x2 REAL,
+    y2 REAL,
+    in_objects INTEGER,
+    is_open INTEGER,
+    returned INTEGER,
+    PRIMARY KEY (image_id, box_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS vlm (
+    image_id INTEGER PRIMARY KEY REFERENCES images(image_id),
+    success INTEGER,
+    answer TEXT,
+    think TEXT,
+    predict TEXT,
+    predict_format INTEGER,
+    model TEXT,
+    processing_time REAL,
+    error TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_images_name ON images(image_name);
+CREATE INDEX IF NOT EXISTS idx_images_run_decision ON images(run_id, final_decision);
+CREATE INDEX IF NOT EXISTS idx_images_decision ON images(final_decision);
+"""
+
+# 已拆分到各列的字段，其余字段以JSON保存在 extra 中
+IMAGE_FIELDS = {"image_name", "success", "final_decision", "detection_summary", "yolo_detection", "detection_boxes",
+                "vlm_analysis", "processing_time", "queue_time", "error"}
+SUMMARY_FIELDS = ("gate_decision", "used_vlm", "open_count", "total_objects", "boxes_returned")
+YOLO_FIELDS = {"has_open", "detection_count", "objects", "open_objects"}
+VLM_FIELDS = {"success", "answer", "think", "predict", "model", "processing_time", "error", "image_name"}
+
+def parse_store_path(path):
+    """
+    拆分结果库路径
+
+    Returns:
+        tuple: (数据库文件路径, 运行名)，未指定运行名时为None（表示全部运行）
+    """
+    db_path, _, run_name = path.partition(RUN_SEPARATOR)
+    return db_path, run_name or None
+
+def _mark_boxes(entries, boxes, flag):
+    """
+    在 entries（按 objects 顺序排列）中按位置标记 boxes 中的框：open_objects 与 detection_boxes
+    是 objects 按原顺序筛选出的子序列，每个框依次匹配下一个相同的、尚未标记的框，
+    因此 objects 中完全相同的两个框也各自保留一行。匹配不到的框追加为 in_objects=0 的新行。
+    """
+    position = 0
+    for box in boxes:
+        index = next((i for i in range(position, len(entries)) if not entries[i][flag] and entries[i]["box"] == box), None)
+        if index is None:
+            entries.append({"box": box, "in_objects": 0, "is_open": 0, "returned": 0, flag: 1})
+            continue
+        entries[index][flag] = 1
+        position = index + 1
+
+def _predict_format(vlm):
+    """判断predict能否由think/answer还原"""
+    predict = vlm.get("predict")
+    think, answer = vlm.get("think") or "", vlm.get("answer") or ""
+    if predict is None:
+        return PREDICT_VERBATIM
+    if predict == f"<think>\n{think}\n</think>\n<answer>{answer}</answer>":
+        return PREDICT_THINK_ANSWER
+    if not think and predict == f"<answer>{answer}</answer>":
+        return PREDICT_ANSWER_ONLY
+    return PREDICT_VERBATIM
+
+def _rebuild_predict(predict_format, think, answer):
+    if predict_format == PREDICT_THINK_ANSWER:
+        return f"<think>\n{think or ''}\n</think>\n<answer>{answer or ''}</answer>"
+    return f"<answer>{answer or ''}</answer>"
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")) if value else None
+
+def _bool(value):
+    return None if value is None else int(bool(value))
+
+def normalize_record(image_id, run_id, record):
+    """
+    把一条推理结果拆分为 images/boxes/vlm 三张表的行
+
+    YOLO检测框在结果中保存了三份（yolo_detection.objects、open_objects、detection_boxes），
+    这里每个框只保存一行，用 in_objects/is_open/returned 标记它出现在哪些列表中。
+
+    Returns:
+        tuple: (images行, boxes行列表, vlm行或None)
+    """
+    summary = record.get("detection_summary") or {}
+    yolo = record.get("yolo_detection")
+    extra = {key: value for key, value in record.items() if key not in IMAGE_FIELDS}
+    if record.get("vlm_analysis") is None and "vlm_analysis" in record:
+        extra["vlm_analysis"] = None
+    extra_summary = {key: value for key, value in summary.items() if key not in SUMMARY_FIELDS}
+    if extra_summary:
+        extra["_detection_summary"] = extra_summary
+    if yolo is not None:
+        extra_yolo = {key: value for key, value in yolo.items() if key not in YOLO_FIELDS}
+        if extra_yolo:
+            extra["_yolo_detection"] = extra_yolo
+    if "detection_boxes" not in record:
+        extra["_no_detection_boxes"] = True
+
+    # 合并三个框列表，每个 objects 中的框一行，保持原顺序
+    entries = [{"box": box, "in_objects": 1, "is_open": 0, "returned": 0} for box in (yolo or {}).get("objects", [])]
+    _mark_boxes(entries, (yolo or {}).get("open_objects", []), "is_open")
+    _mark_boxes(entries, record.get("detection_boxes") or [], "returned")
+    box_rows = []
+    for box_index, entry in enumerate(entries):
+        box = entry["box"]
+        x1, y1, x2, y2 = (list(box.get("bbox") or []) + [None] * 4)[:4]
+        box_rows.append((image_id, box_index, box.get("class_id"), box.get("class_name"), box.get("conf"),
+                         x1, y1, x2, y2, entry["in_objects"], entry["is_open"], entry["returned"]))
+
+    vlm_row = None
+    vlm = record.get("vlm_analysis")
+    if isinstance(vlm, dict):
+        predict_format = _predict_format(vlm)
+        vlm_extra = {key: value for key, value in vlm.items() if key not in VLM_FIELDS}
+        if vlm.get("image_name") not in (None, record.get("image_name")):
+            vlm_extra["image_name"] = vlm["image_name"]
+        vlm_row = (image_id, _bool(vlm.get("success")), vlm.get("answer"), vlm.get("think"),
+                   vlm.get("predict") if predict_format == PREDICT_VERBATIM else None, predict_format,
+                   vlm.get("model"), vlm.get("processing_time"), vlm.get("error"), _dumps(vlm_extra))
+
+    image_row = (image_id, run_id, record.get("image_name"), _bool(record.get("success")), record.get("final_decision"),
+                 summary.get("gate_decision"), _bool(summary.get("used_vlm")), summary.get("open_count"),
+                 summary.get("total_objects"), summary.get("boxes_returned"), int(yolo is not None),
+                 record.get("processing_time"), record.get("queue_time"), record.get("error"), _dumps(extra))
+    return image_row, box_rows, vlm_row
+
+def rebuild_record(image, boxes, vlm):
+    """由三张表的行还原推理结果（与原始结果的字段一致）"""
+    extra = json.loads(image["extra"]) if image["extra"] else {}
+    record = {"image_name": image["image_name"]}
+    if image["success"] is not None:
+        record["success"] = bool(image["success"])
+    if image["final_decision"] is not None:
+        record["final_decision"] = image["final_decision"]
+    if image["error"] is not None:
+        record["error"] = image["error"]
+
+    def to_box(row):
+        box = {"bbox": [v for v in (row["x1"], row["y1"], row["x2"], row["y2"]) if v is not None],
+               "class_id": row["class_id"], "class_name": row["class_name"], "conf": row["conf"]}
+        # 坐标以REAL保存，原本是整数的还原为int
+        box["bbox"] = [int(v) if float(v).is_integer() else v for v in box["bbox"]]
+        return box
+
+    if image["has_yolo"]:
+        objects = [to_box(row) for row in boxes if row["in_objects"]]
+        open_objects = [to_box(row) for row in boxes if row["is_open"]]
+        record["yolo_detection"] = {"has_open": bool(open_objects), "detection_count": len(objects),
+                                    "objects": objects, "open_objects": open_objects,
+                                    **extra.pop("_yolo_detection", {})}
+    summary = {key: image[key] for key in SUMMARY_FIELDS if image[key] is not None}
+    if "used_vlm" in summary:
+        summary["used_vlm"] = bool(summary["used_vlm"])
+    summary.update(extra.pop("_detection_summary", {}))
+    if summary:
+        record["detection_summary"] = summary
+    if not extra.pop("_no_detection_boxes", False):
+        record["detection_boxes"] = [to_box(row) for row in boxes if row["returned"]]
+
+    if vlm is not None:
+        analysis = {"image_name": record["image_name"]}
+        analysis.update(json.loads(vlm["extra"]) if vlm["extra"] else {})
+        for key in ("answer", "think", "model", "processing_time", "error"):
+            if vlm[key] is not None:
+                analysis[key] = vlm[key]
+        if vlm["success"] is not None:
+            analysis["success"] = bool(vlm["success"])
+        if vlm["predict_format"] == PREDICT_VERBATIM:
+            if vlm["predict"] is not None:
+                analysis["predict"] = vlm["predict"]
+        else:
+            analysis["predict"] = _rebuild_predict(vlm["predict_format"], vlm["think"], vlm["answer"])
+        record["vlm_analysis"] = analysis
+    record.update(extra)
+    for key in ("processing_time", "queue_time"):
+        if image[key] is not None:
+            record[key] = image[key]
+    return record
+
+def _read_source(path):
+    """
+    读取待导入的结果文件
+
+    Returns:
+        tuple: (汇总信息dict, 结果记录的可迭代对象)。JSONL逐行流式读取，汇总来自同名 .summary.json；
+            旧版JSON的汇总与 all_results 在同一个文件中，整体解析一次
+    """
+    if path.endswith(".jsonl"):
+        summary_path = f"{os.path.splitext(path)[0]}.summary.json"
+        summary = {}
+        if os.path.exists(summary_path):
+            with open(summary_path, "r", encoding="utf-8") as f:
+                summary = json.load(f)
+        return summary, iter_records(path)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    records = data.pop("all_results", [])
+    return data, records
+
+class ResultStore:
+    """
+    基于SQLite的推理结果库
+
+    每次导入的结果文件是一个运行（runs），图片、检测框与VLM分析分别保存在 images/boxes/vlm 表中，
+    图片名、运行与最终决策上有索引，可跨运行快速查询；read_columns 按列读取为NumPy数组，
+    export_parquet 导出为Parquet供Arrow零拷贝读取（需要安装pyarrow）。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def import_file(self, path, run_name=None, replace=False):
+        """
+        导入一个结果文件（.jsonl 或旧版 complete_directory_test_*.json）为一个运行
+
+        Args:
+            path: 结果文件路径
+            run_name: 运行名，默认取文件名（不含扩展名）
+            replace: 同名运行已存在时是否覆盖，否则抛出 ValueError
+
+        Returns:
+            dict: 'run_id'、'name' 与 'image_count'
+        """
+        run_name = run_name or os.path.splitext(os.path.basename(path))[0]
+        summary, records = _read_source(path)
+        with self.conn:
+            existing = self.conn.execute("SELECT run_id FROM runs WHERE name = ?", (run_name,)).fetchone()
+            if existing is not None:
+                if not replace:
+                    raise ValueError(f"运行已存在: {run_name}")
+                # 与导入在同一个事务中，导入失败时旧数据保持不变
+                self._delete_run_rows(run_name)
+            run_id = self.conn.execute(
+                "INSERT INTO runs (name, source_path, imported_at, summary) VALUES (?, ?, ?, ?)",
+                (run_name, os.path.abspath(path), time.time(), _dumps(summary))
+            ).lastrowid
+            next_id = (self.conn.execute("SELECT MAX(image_id) FROM images").fetchone()[0] or 0) + 1
+            count = 0
+            batch = ([], [], [])
+            for record in records:
+                image_row, box_rows, vlm_row = normalize_record(next_id + count, run_id, record)
+                batch[0].append(image_row)
+                batch[1].extend(box_rows)
+                if vlm_row is not None:
+                    batch[2].append(vlm_row)
+                count += 1
+                if count % INSERT_BATCH_SIZE == 0:
+                    self._insert(*batch)
+                    batch = ([], [], [])
+            self._insert(*batch)
+            self.conn.execute("UPDATE runs SET image_count = ? WHERE run_id = ?", (count, run_id))
+        return {"run_id": run_id, "name": run_name, "image_count": count}
+
+    def _insert(self, image_rows, box_rows, vlm_rows):
+        self.conn.executemany(f"INSERT INTO images VALUES ({', '.join('?' * 15)})", image_rows)
+        self.conn.executemany(f"INSERT INTO boxes VALUES ({', '.join('?' * 12)})", box_rows)
+        self.conn.executemany(f"INSERT INTO vlm VALUES ({', '.join('?' * 10)})", vlm_rows)
+
+    def _delete_run_rows(self, run_name):
+        run_ids = "SELECT run_id FROM runs WHERE name = ?"
+        image_ids = f"SELECT image_id FROM images WHERE run_id IN ({run_ids})"
+        self.conn.execute(f"DELETE FROM boxes WHERE image_id IN ({image_ids})", (run_name,))
+        self.conn.execute(f"DELETE FROM vlm WHERE image_id IN ({image_ids})", (run_name,))
+        self.conn.execute(f"DELETE FROM images WHERE run_id IN ({run_ids})", (run_name,))
+        self.conn.execute("DELETE FROM runs WHERE name = ?", (run_name,))
+
+    def delete_run(self, run_name):
+        """删除一个运行及其全部图片、检测框与VLM分析"""
+        with self.conn:
+            self._delete_run_rows(run_name)
+
+    def runs(self):
+        """所有运行及各最终决策的图片数"""
+        runs = [dict(row) for row in self.conn.execute(
+            "SELECT run_id, name, source_path, imported_at, image_count FROM runs ORDER BY run_id")]
+        counts = self.conn.execute(
+            "SELECT run_id, final_decision, COUNT(*) FROM images GROUP BY run_id, final_decision").fetchall()
+        for run in runs:
+            run["decisions"] = {decision: count for run_id, decision, count in counts if run_id == run["run_id"]}
+        return runs
+
+    def _run_filter(self, run_name):
+        if run_name is None:
+            return "", ()
+        row = self.conn.execute("SELECT run_id FROM runs WHERE name = ?", (run_name,)).fetchone()
+        if row is None:
+            raise ValueError(f"运行不存在: {run_name}")
+        return "WHERE run_id = ?", (row["run_id"],)
+
+    def iter_records(self, run_name=None):
+        """
+        逐条还原推理结果（与原始结果文件中的记录一致），run_name 为None时遍历全部运行
+
+        images/boxes/vlm 三个查询都按 image_id 排序，逐行归并，不需要逐图查询。
+        """
+        where, params = self._run_filter(run_name)
+        subquery = f"SELECT image_id FROM images {where}"
+        images = self.conn.execute(f"SELECT * FROM images {where} ORDER BY image_id", params)
+        boxes = self.conn.cursor().execute(
+            f"SELECT * FROM boxes WHERE image_id IN ({subquery}) ORDER BY image_id, box_index", params)
+        vlms = self.conn.cursor().execute(
+            f"SELECT * FROM vlm WHERE image_id IN ({subquery}) ORDER BY image_id", params)
+        box = boxes.fetchone()
+        vlm = vlms.fetchone()
+        for image in images:
+            image_boxes = []
+            while box is not None and box["image_id"] == image["image_id"]:
+                image_boxes.append(box)
+                box = boxes.fetchone()
+            image_vlm = None
+            if vlm is not None and vlm["image_id"] == image["image_id"]:
+                image_vlm = vlm
+                vlm = vlms.fetchone()
+            yield rebuild_record(image, image_boxes, image_vlm)
+
+    def find_images(self, image_name=None, run_name=None, decision=None, limit=None):
+        """按图片名、运行与最终决策查询图片（均走索引），返回 images 表的行（附带运行名）"""
+        conditions, params = [], []
+        if image_name is not None:
+            conditions.append("images.image_name = ?")
+            params.append(image_name)
+        if run_name is not None:
+            conditions.append("runs.name = ?")
+            params.append(run_name)
+        if decision is not None:
+            conditions.append("images.final_decision = ?")
+            params.append(decision)
+        sql = ("SELECT runs.name AS run_name, images.* FROM images JOIN runs ON runs.run_id = images.run_id"
+               + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY images.image_id")
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def read_columns(self, sql, params=()):
+        """
+        执行查询并按列返回NumPy数组，如
+            store.read_columns("SELECT conf, image_id FROM boxes WHERE is_open = 1")
+
+        Returns:
+            dict: 列名 -> np.ndarray（数值列为数值类型，文本列为object类型）
+        """
+        cursor = self.conn.execute(sql, params)
+        names = [description[0] for description in cursor.description]
+        rows = cursor.fetchall()
+        if not rows:
+            return {name: np.zeros(0) for name in names}
+        return {name: np.asarray(values) for name, values in zip(names, zip(*rows))}
+
+    def read_decisions(self, run_name=None):
+        """按 image_id 顺序读取最终决策列（用于评估，不还原完整记录）"""
+        where, params = self._run_filter(run_name)
+        return [row[0] for row in self.conn.execute(f"SELECT final_decision FROM images {where} ORDER BY image_id", params)]
+
+    def export_parquet(self, output_dir, tables=("runs", "images", "boxes", "vlm")):
+        """
+        将各表导出为Parquet文件（每张表一个文件），之后可用 pyarrow.parquet.read_table(path, memory_map=True)
+        按列零拷贝读取。需要安装pyarrow。
+
+        Returns:
+            list: 导出的文件路径
+        """
+        import pyarrow as pa  # 只有导出Parquet时需要pyarrow，延迟导入
+        import pyarrow.parquet as pq
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for table in tables:
+            cursor = self.conn.execute(f"SELECT * FROM {table}")
+            names = [description[0] for description in cursor.description]
+            columns = list(zip(*cursor.fetchall())) or [[] for _ in names]
+            path = os.path.join(output_dir, f"{table}.parquet")
+            pq.write_table(pa.table({name: list(values) for name, values in zip(names, columns)}), path)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def iter_store_records(path):
+    """逐条读取结果库中的记录，path 形如 results.db 或 results.db#运行名"""
+    db_path, run_name = parse_store_path(path)
+    with ResultStore(db_path) as store:
+        yield from store.iter_records(run_name)
+
+def read_store_decisions(path):
+    """读取结果库中的最终决策列，path 形如 results.db 或 results.db#运行名"""
+    db_path, run_name = parse_store_path(path)
+    with ResultStore(db_path) as store:
+        return store.read_decisions(run_name)
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="推理结果库：导入、查询与导出")
+    parser.add_argument("--db", default="../data_output/results.db", help="结果库路径")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="导入结果文件（.jsonl 或旧版 .json），每个文件为一个运行")
+    import_parser.add_argument("paths", nargs="+", help="结果文件")
+    import_parser.add_argument("--name", default=None, help="运行名（只导入一个文件时可用），默认取文件名")
+    import_parser.add_argument("--replace", action="store_true", help="覆盖同名运行")
+
+    subparsers.add_parser("runs", help="列出所有运行")
+
+    query_parser = subparsers.add_parser("query", help="按图片名、运行与最终决策查询图片")
+    query_parser.add_argument("--image-name", default=None)
+    query_parser.add_argument("--run", default=None)
+    query_parser.add_argument("--decision", default=None)
+    query_parser.add_argument("--limit", type=int, default=20)
+
+    export_parser = subparsers.add_parser("export-parquet", help="导出为Parquet（需要pyarrow）")
+    export_parser.add_argument("output_dir", help="输出目录")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    with ResultStore(args.db) as store:
+        if args.command == "import":
+            if args.name and len(args.paths) > 1:
+                raise ValueError("导入多个文件时不能指定 --name")
+            for path in args.paths:
+                start = time.time()
+                run = store.import_file(path, args.name, args.replace)
+                print(f"已导入 {path} -> 运行 {run['name']}（{run['image_count']} 张图片，{time.time() - start:.2f} 秒）")
+        elif args.command == "runs":
+            for run in store.runs():
+                print(f"{run['name']}: {run['image_count']} 张图片, {run['decisions']}, 来源 {run['source_path']}")
+        elif args.command == "query":
+            rows = store.find_images(args.image_name, args.run, args.decision, args.limit)
+            for row in rows:
+                print(f"{row['run_name']}\t{row['image_name']}\t{row['final_decision']}\t"
+                      f"open={row['open_count']}\tused_vlm={row['used_vlm']}")
+            print(f"共 {len(rows)} 条")
+        elif args.command == "export-parquet":
+            for path in store.export_parquet(args.output_dir):
+                print(f"已导出: {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import os
+import io
+import json
+import tempfile
+import unittest
+import numpy as np
+from metrics_engine import _iter_json_array, iter_records, encode_predictions, confusion_matrix, metrics_from_confusion, LabelCoder, DEFAULT_CLASSES
+from result_store import ResultStore
+from calculate_performance import calculate_precision, calculate_recall
+
+# 仓库中随附的旧版结果文件（按本文件位置定位，与运行目录无关），不存在时跳过相关用例
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_output", "inference_result")
+SAMPLE_RESULTS = [
+    os.path.join(RESULTS_DIR, "complete_directory_test_20250715_014557.json"),
+    os.path.join(RESULTS_DIR, "complete_directory_test_20250715_014723.json")
+]
+CHUNK_SIZES = [1, 7, 64, 4096, None]  # 流式解析的缓冲区大小，覆盖元素、字符串跨越缓冲区边界的情况，None 为默认值
+
+# 手工构造的小样本：真实标签、最终决策，以及手工计算的混淆矩阵（行为真实类别，列为预测，顺序 盖板缺失/盖板存在）
+FIXTURE = [
+    ("盖板缺失", "盖板缺失"),
+    ("盖板缺失", "盖板缺失"),
+    ("盖板缺失", "盖板存在"),
+    ("盖板存在", "盖板存在"),
+    ("盖板存在", "盖板存在"),
+    ("盖板存在", "盖板存在"),
+    ("盖板存在", "盖板缺失"),
+    ("盖板存在", None),  # 处理失败，没有final_decision，不计入
+]
+FIXTURE_CM = [[2, 1], [1, 3]]
+
+def _box(conf, class_name="gaiban_open", class_id=1, bbox=(10, 20, 30, 40)):
+    return {"bbox": list(bbox), "class_id": class_id, "class_name": class_name, "conf": conf}
+
+# 结果库往返用的记录：包含完全相同的重复框、失败记录、快速模式与无法还原的predict
+STORE_FIXTURE = [
+    {
+        "success": True, "image_name": "cam_1.jpg", "final_decision": "盖板缺失",
+        "yolo_detection": {"has_open": True, "detection_count": 3, "objects": [_box(0.9), _box(0.9), _box(0.4, "gaiban_close", 0)],
+                           "open_objects": [_box(0.9), _box(0.9)]},
+        "detection_summary": {"open_count": 2, "total_objects": 3, "used_vlm": True, "gate_decision": "escalate", "boxes_returned": 2},
+        "detection_boxes": [_box(0.9), _box(0.9)],
+        "processing_steps": ["YOLO检测完成"],
+        "vlm_analysis": {"success": True, "think": "", "answer": "存在盖板缺失", "predict": "<answer>存在盖板缺失</answer>",
+                         "model": "m", "processing_time": 1.5, "image_name": "cam_1.jpg"},
+        "queue_time": 0.01, "processing_time": 1.6
+    },
+    {
+        "success": True, "image_name": "cam_2.jpg", "final_decision": "盖板存在",
+        "yolo_detection": {"has_open": True, "detection_count": 1, "objects": [_box(0.5, bbox=(1.5, 2, 3, 4))],
+                           "open_objects": [_box(0.5, bbox=(1.5, 2, 3, 4))]},
+        "detection_summary": {"open_count": 1, "total_objects": 1, "used_vlm": True, "boxes_returned": 0},
+        "detection_boxes": [],
+        "vlm_analysis": {"success": True, "think": "t", "answer": "不存在盖板缺失", "predict": "其他格式的输出",
+                         "model": "m", "processing_time": 2.0, "image_name": "cam_2.jpg", "dedup": {"hit": False}}
+    },
+    {"success": False, "error": "图片解码失败", "image_name": "cam_3.jpg", "processing_time": 0.1, "trace_id": "x"}
+]
+
+def _write_jsonl(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def _sample_results():
+    return [path for path in SAMPLE_RESULTS if os.path.exists(path)]
+
+class StreamingParserTest(unittest.TestCase):
+    """流式解析与 json.load 的结果逐条一致"""
+
+    def test_sample_results(self):
+        paths = _sample_results()
+        if not paths:
+            self.skipTest(f"没有随附的结果文件: {RESULTS_DIR}")
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                expected = json.load(f).get("all_results", [])
+            for chunk_size in CHUNK_SIZES:
+                with self.subTest(path=os.path.basename(path), chunk_size=chunk_size):
+                    with open(path, "r", encoding="utf-8") as f:
+                        records = list(_iter_json_array(f) if chunk_size is None else _iter_json_array(f, chunk_size=chunk_size))
+                    self.assertEqual(records, expected)
+            # 决策编码与逐条读取 final_decision 一致
+            coder = LabelCoder()
+            self.assertEqual(encode_predictions(path).tolist(), [coder.encode(r.get("final_decision")) for r in expected])
+
+    def test_edge_cases(self):
+        """空数组、嵌套同名键与字符串中的特殊字符"""
+        cases = {
+            '{"all_results": []}': [],
+            '{"test_type": "x", "all_results" : [ ]}': [],
+            '{"all_results": [{"a": "]}, [", "b": {"all_results": 1}}, {"c": "\\"引号\\""}]}': [{"a": "]}, [", "b": {"all_results": 1}}, {"c": "\"引号\""}],
+            '{"summary": {"n": 1}}': []
+        }
+        for text, expected in cases.items():
+            for chunk_size in (1, 3, 1024):
+                with self.subTest(text=text, chunk_size=chunk_size):
+                    self.assertEqual(list(_iter_json_array(io.StringIO(text), chunk_size=chunk_size)), expected)
+
+class FixtureMetricsTest(unittest.TestCase):
+    """手工计算的小样本混淆矩阵与指标"""
+
+    def setUp(self):
+        coder = LabelCoder(DEFAULT_CLASSES)
+        self.labels = [coder.encode(label) for label, _ in FIXTURE]
+        self.preds = [coder.encode(pred) for _, pred in FIXTURE]
+        self.cm = confusion_matrix(self.labels, self.preds, len(coder))
+
+    def test_confusion_matrix(self):
+        self.assertEqual(self.cm.tolist(), FIXTURE_CM)
+
+    def test_metrics(self):
+        metrics = metrics_from_confusion(self.cm)
+        # 盖板缺失: precision 2/3, recall 2/3；盖板存在: precision 3/4, recall 3/4；acc 5/7
+        expected = {"accuracy": 5 / 7, "precision": [2 / 3, 3 / 4], "recall": [2 / 3, 3 / 4], "f1": [2 / 3, 3 / 4]}
+        for key, value in expected.items():
+            self.assertTrue(np.allclose(metrics[key], value), f"{key}: {metrics[key]} != {value}")
+
+    def test_batched_metrics(self):
+        """批量混淆矩阵与逐个计算一致"""
+        cms = (self.cm, self.cm.T, np.zeros_like(self.cm))
+        batch = metrics_from_confusion(np.stack(cms))
+        for i, single in enumerate(cms):
+            single_metrics = metrics_from_confusion(single)
+            for key in ("accuracy", "precision", "recall", "f1"):
+                self.assertTrue(np.allclose(batch[key][i], single_metrics[key]), f"#{i} {key}")
+
+    def test_jsonl_encoding(self):
+        """通过结果文件走一遍完整流程"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "fixture.jsonl")
+            records = []
+            for _, decision in FIXTURE:
+                record = {"image_name": "x.jpg", "success": decision is not None}
+                if decision is not None:
+                    record["final_decision"] = decision
+                records.append(record)
+            _write_jsonl(path, records)
+            self.assertEqual(encode_predictions(path).tolist(), self.preds)
+
+class ResultStoreTest(unittest.TestCase):
+    """结果库导入后逐条还原与原始记录一致"""
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fixture_path = os.path.join(directory, "fixture.jsonl")
+            _write_jsonl(fixture_path, STORE_FIXTURE)
+            with ResultStore(os.path.join(directory, "results.db")) as store:
+                for path in _sample_results() + [fixture_path]:
+                    with self.subTest(path=os.path.basename(path)):
+                        run = store.import_file(path)
+                        self.assertEqual(list(store.iter_records(run["name"])), list(iter_records(path)))
+                # 重复框各占一行，predict 能还原时不保存原文
+                box_count = store.conn.execute(
+                    "SELECT COUNT(*) FROM boxes JOIN images USING (image_id) WHERE images.image_name = 'cam_1.jpg'").fetchone()[0]
+                self.assertEqual(box_count, 3)
+                predicts = store.conn.execute(
+                    "SELECT predict FROM vlm JOIN images USING (image_id) WHERE images.image_name LIKE 'cam_%' ORDER BY image_id").fetchall()
+                self.assertEqual([row[0] for row in predicts], [None, "其他格式的输出"])
+
+class ListMetricsTest(unittest.TestCase):
+    """calculate_precision / calculate_recall 同时支持可哈希与不可哈希（如检测框列表）的元素"""
+
+    def test_hashable(self):
+        self.assertAlmostEqual(calculate_precision([1, 2], [2, 3, 2]), 2 / 3)
+        self.assertAlmostEqual(calculate_recall([1, 2], [2, 3, 2]), 1 / 2)
+
+    def test_unhashable(self):
+        labels = [[10, 20, 30, 40], [1, 2, 3, 4]]
+        preds = [[10, 20, 30, 40], [10, 20, 30, 40], [5, 6, 7, 8]]
+        self.assertAlmostEqual(calculate_precision(labels, preds), 2 / 3)
+        self.assertAlmostEqual(calculate_recall(labels, preds), 1 / 2)
+
+if __name__ == "__main__":
+    unittest.main()
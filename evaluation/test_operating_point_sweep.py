@@ -0,0 +1,71 @@
+import os
+import json
+import tempfile
+import unittest
+from operating_point_sweep import load_replay_data, sweep, parse_gate
+from metrics_engine import evaluate
+
+def _record(decision, conf=None, answer=None, success=True):
+    """构造一条结果：conf 为盖板缺失框的置信度，answer 为VLM答案（None表示没有VLM答案）"""
+    record = {"success": success, "image_name": "x.jpg"}
+    if decision is not None:
+        record["final_decision"] = decision
+    record["yolo_detection"] = {"objects": [] if conf is None else [{"class_name": "gaiban_open", "conf": conf}]}
+    if answer is not None:
+        record["vlm_analysis"] = {"success": True, "answer": answer}
+    return record
+
+# 真实标签为盖板缺失的结果：含处理失败的记录与送检但缺VLM答案的记录
+POSITIVE_RECORDS = [
+    _record("盖板缺失", 0.9, "存在盖板缺失"),
+    _record("盖板存在", 0.8, "不存在盖板缺失"),
+    _record("盖板缺失", 0.7),  # 送检但没有VLM答案
+    _record(None, success=False),  # 处理失败
+]
+# 真实标签为盖板存在的结果
+NEGATIVE_RECORDS = [
+    _record("盖板存在"),
+    _record("盖板缺失", 0.6, "存在盖板缺失"),
+    _record("盖板存在", 0.5, "不存在盖板缺失"),
+]
+
+class OperatingPointSweepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        for name, records in (("positive.jsonl", POSITIVE_RECORDS), ("negative.jsonl", NEGATIVE_RECORDS)):
+            path = os.path.join(self.directory.name, name)
+            with open(path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.paths.append(path)
+        self.labels = ["盖板缺失", "盖板存在"]
+        self.data = load_replay_data(self.paths, self.labels, workers=1)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_invalid_records_excluded(self):
+        """处理失败的记录与 metrics_engine 一样不参与统计"""
+        self.assertEqual(self.data["record_count"], 6)
+        self.assertEqual(self.data["excluded_count"], 1)
+
+    def test_missing_answers_reported_separately(self):
+        """缺VLM答案的记录不计入混淆矩阵，单独统计"""
+        point = sweep(self.data, [0.25], [1], [parse_gate("none:none")])[0]
+        self.assertEqual(point["vlm_missing"], 1)
+        self.assertEqual(point["vlm_missing_by_label"], [1, 0])
+        self.assertEqual(point["evaluated_count"], 5)
+        self.assertEqual(point["confusion_matrix"].tolist(), [[1, 1], [1, 2]])
+
+    def test_matches_stored_decisions(self):
+        """在推理时的阈值与送检策略下，除缺VLM答案的记录外与按 final_decision 统计的混淆矩阵一致"""
+        point = sweep(self.data, [0.25], [1], [parse_gate("none:none")])[0]
+        stored = evaluate(self.paths, self.labels, workers=1)["confusion_matrix"]
+        # 缺VLM答案的那条记录在原始推理中按YOLO结论判为盖板缺失
+        stored[0][0] -= 1
+        self.assertEqual(point["confusion_matrix"].tolist(), stored.tolist())
+
+if __name__ == "__main__":
+    unittest.main()
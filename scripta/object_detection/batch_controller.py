@@ -0,0 +1,115 @@
+import threading
+
+class AdaptiveBatchController:
+    """
+    自适应批次大小与并发控制（AIMD）
+
+    根据每个批次的实际耗时与错误率调整后续批次的大小和同时在途的批次数：
+        - 批次失败或错误率超过 max_error_rate：批次大小与并发数按 decrease_factor 乘性减小
+        - 耗时超过目标（含容差）：批次大小按 目标耗时/实际耗时 的比例缩小（最多缩小到 decrease_factor 倍）
+        - 耗时低于目标（含容差）：批次大小加性增加 increase_step，批次大小已到上限时并发数加1
+        - 其余情况保持不变
+    min_batch_size == max_batch_size 且 min_concurrency == max_concurrency 时即为固定批次。
+
+    并发数的限制通过 acquire()/release() 实现，update() 只应在汇总批次结果的线程中调用。
+    """
+
+    def __init__(self, batch_size=16, min_batch_size=1, max_batch_size=64, concurrency=2, min_concurrency=1,
+                 max_concurrency=4, target_latency=30.0, tolerance=0.2, increase_step=2, decrease_factor=0.5,
+                 max_error_rate=0.2):
+        """
+        Args:
+            batch_size: 初始批次大小
+            min_batch_size, max_batch_size: 批次大小范围
+            concurrency: 初始在途批次数
+            min_concurrency, max_concurrency: 在途批次数范围
+            target_latency: 目标单批次耗时（秒）
+            tolerance: 目标耗时的容差比例，耗时在 target_latency * (1 ± tolerance) 内不调整
+            increase_step: 加性增加的步长（张）
+            decrease_factor: 乘性减小的系数
+            max_error_rate: 批次内失败图片比例超过该值时视为出错
+        """
+        self.min_batch_size = max(1, min_batch_size)
+        self.max_batch_size = max(self.min_batch_size, max_batch_size)
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.target_latency = target_latency
+        self.tolerance = tolerance
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.max_error_rate = max_error_rate
+        self._batch_size = float(min(max(batch_size, self.min_batch_size), self.max_batch_size))
+        self.concurrency = min(max(concurrency, self.min_concurrency), self.max_concurrency)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self.adjustments = {"increase": 0, "decrease": 0, "backoff": 0, "hold": 0}
+
+    @property
+    def batch_size(self):
+        """下一个批次的大小"""
+        return int(self._batch_size)
+
+    @property
+    def fixed(self):
+        """批次大小与并发数是否都不可调整"""
+        return self.min_batch_size == self.max_batch_size and self.min_concurrency == self.max_concurrency
+
+    def acquire(self):
+        """等待在途批次数低于当前并发上限后占用一个名额"""
+        with self._condition:
+            while self._in_flight >= self.concurrency:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        """批次请求结束，释放名额"""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _set_concurrency(self, concurrency):
+        with self._condition:
+            self.concurrency = min(max(concurrency, self.min_concurrency), self.max_concurrency)
+            self._condition.notify_all()
+
+    def update(self, latency, success, error_rate=0.0):
+        """
+        根据一个批次的结果调整后续批次
+
+        Args:
+            latency: 批次请求耗时（秒）
+            success: 批次请求是否成功
+            error_rate: 批次内失败图片的比例
+
+        Returns:
+            str: 本次调整的类型，increase / decrease / backoff / hold
+        """
+        if not success or error_rate > self.max_error_rate:
+            action = "backoff"
+            self._batch_size = max(self.min_batch_size, self._batch_size * self.decrease_factor)
+            self._set_concurrency(int(self.concurrency * self.decrease_factor))
+        elif latency > self.target_latency * (1 + self.tolerance):
+            action = "decrease"
+            scale = max(self.decrease_factor, self.target_latency / latency)
+            self._batch_size = max(self.min_batch_size, self._batch_size * scale)
+        elif latency < self.target_latency * (1 - self.tolerance):
+            action = "increase"
+            if self._batch_size >= self.max_batch_size:
+                self._set_concurrency(self.concurrency + 1)
+            self._batch_size = min(self.max_batch_size, self._batch_size + self.increase_step)
+        else:
+            action = "hold"
+        self.adjustments[action] += 1
+        return action
+
+    def stats(self):
+        return {
+            "batch_size": self.batch_size,
+            "concurrency": self.concurrency,
+            "min_batch_size": self.min_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "min_concurrency": self.min_concurrency,
+            "max_concurrency": self.max_concurrency,
+            "target_latency": self.target_latency,
+            "adjustments": dict(self.adjustments)
+        }
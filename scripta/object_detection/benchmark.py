@@ -0,0 +1,388 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import itertools
+from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from config_loader import config
+import vlm_inference
+from vlm_client import vlm_client
+from image_scanner import iter_images
+from image_preprocess import decode_image, encode_image_to_jpeg
+import inference_and_sve_json
+
+SCENARIOS = ("single", "batch", "directory")
+DEFAULT_OUTPUT_DIR = "../data_output/benchmark"  # 基准测试结果的默认保存目录
+DEFAULT_TOLERANCE = 0.10  # 对比模式下吞吐、延迟、字节数等指标允许的相对变化
+DEFAULT_MAX_ERROR_INCREASE = 0.01  # 对比模式下错误率允许的绝对增加量
+
+# 对比时各指标的方向：1 表示越大越好，-1 表示越小越好
+COMPARE_METRICS = {
+    "throughput": 1,
+    "latency.p50": -1,
+    "latency.p95": -1,
+    "latency.p99": -1,
+    "vlm_seconds_per_image": -1,
+    "bytes_per_image": -1
+}
+
+def percentile(values, q):
+    """线性插值的百分位数（q取0-100），values为空时返回None"""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarize_latency(latencies):
+    """延迟分布：均值、p50/p95/p99与最大值（秒）"""
+    if not latencies:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies)
+    }
+
+def load_images(test_dirs, limit=None, recursive=False):
+    """读取测试图片的原始字节，返回 [(图片名, 字节)]"""
+    images = []
+    for path in itertools.islice(iter_images(test_dirs, recursive), limit):
+        with open(path, "rb") as f:
+            images.append((os.path.basename(path), f.read()))
+    return images
+
+def resize_images(images, max_side):
+    """将图片等比缩放到最长边不超过max_side并重新编码为JPEG，max_side为0时保持原图"""
+    if not max_side:
+        return images
+    resized = []
+    for name, image_bytes in images:
+        image = decode_image(image_bytes)
+        image.thumbnail((max_side, max_side))
+        resized.append((name, encode_image_to_jpeg(image)))
+    return resized
+
+def vlm_seconds(result):
+    """一次实际VLM调用的耗时，命中缓存或复用近重复帧结论的结果不计入"""
+    if not result or not result.get("success") or result.get("cache_hit"):
+        return 0.0
+    if (result.get("dedup") or {}).get("hit"):
+        return 0.0
+    return result.get("processing_time", 0.0) or 0.0
+
+def count_errors(results):
+    """按错误信息（截取前80个字符）统计失败次数"""
+    return dict(Counter(str(r.get("error", "未知错误"))[:80] for r in results if not r.get("success")))
+
+def run_single(images, prompt, concurrency, mode=None):
+    """以concurrency个线程并发调用 inference_single_base64，每张图片的延迟为客户端观测到的耗时"""
+    def call(item):
+        name, image_bytes = item
+        start_time = time.time()
+        result = vlm_inference.inference_single_base64(image_bytes, prompt, name, mode)
+        return result, time.time() - start_time
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outputs = list(pool.map(call, images))
+    return [result for result, _ in outputs], [latency for _, latency in outputs]
+
+def run_batch(images, prompt, concurrency, batch_size, mode=None):
+    """逐批调用 inference_batch_base64（批内最多concurrency个请求同时在途），每张图片的延迟为结果中的处理时间"""
+    results = []
+    for start in range(0, len(images), batch_size):
+        batch = [{"image_bytes": image_bytes, "image_name": name} for name, image_bytes in images[start:start + batch_size]]
+        results.extend(vlm_inference.inference_batch_base64(batch, prompt, max_in_flight=concurrency, mode=mode))
+    return results, [r.get("processing_time", 0.0) for r in results if r.get("success")]
+
+def run_directory(images, base_url, concurrency, batch_size, upload_format=None):
+    """
+    将图片写入临时目录后调用 test_complete_directory（经由混合推理服务），
+    延迟按批次统计（每个批次请求的往返耗时）
+    """
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as tmp_dir:
+        paths = []
+        for index, (name, image_bytes) in enumerate(images):
+            path = os.path.join(tmp_dir, f"{index:06d}_{name}")
+            with open(path, "wb") as f:
+                f.write(image_bytes)
+            paths.append(path)
+        complete_result = inference_and_sve_json.test_complete_directory(
+            paths, base_url, batch_size=batch_size, max_batches_in_flight=concurrency, upload_format=upload_format
+        )
+    results = complete_result.get("all_results", [])
+    # 失败的批次没有逐图结果，按图片数计为失败
+    failed_images = sum(b["batch_size"] for b in complete_result["batch_summaries"] if "error" in b["summary"])
+    results.extend({"success": False, "error": "批次处理失败"} for _ in range(failed_images))
+    return results, [b["latency"] for b in complete_result["batch_summaries"]]
+
+def run_scenario(scenario, images, prompt, concurrency, batch_size, image_size, base_url=None, mode=None,
+                 upload_format=None):
+    """
+    运行一个场景并汇总指标
+
+    Returns:
+        dict: 场景参数、吞吐（张/秒）、延迟分布、错误率与错误分类、VLM耗时、收发字节数
+    """
+    if scenario == "directory":
+        inference_and_sve_json.reset_wire_stats()
+    else:
+        vlm_client.reset_wire_stats()
+
+    start_time = time.time()
+    if scenario == "single":
+        results, latencies = run_single(images, prompt, concurrency, mode)
+    elif scenario == "batch":
+        results, latencies = run_batch(images, prompt, concurrency, batch_size, mode)
+    elif scenario == "directory":
+        results, latencies = run_directory(images, base_url, concurrency, batch_size, upload_format)
+    else:
+        raise ValueError(f"未知的场景: {scenario}")
+    wall_time = time.time() - start_time
+
+    wire = inference_and_sve_json.get_wire_stats() if scenario == "directory" else vlm_client.wire_stats()
+    if scenario == "directory":
+        total_vlm_seconds = sum(vlm_seconds(r.get("vlm_analysis")) for r in results)
+    else:
+        total_vlm_seconds = sum(vlm_seconds(r) for r in results)
+    total = len(results)
+    success_count = sum(1 for r in results if r.get("success"))
+
+    return {
+        "name": f"{scenario}/size={image_size or 'original'}/c={concurrency}"
+                + (f"/b={batch_size}" if scenario != "single" else ""),
+        "scenario": scenario,
+        "image_size": image_size,
+        "concurrency": concurrency,
+        "batch_size": batch_size if scenario != "single" else None,
+        "images": total,
+        "success_count": success_count,
+        "error_count": total - success_count,
+        "error_rate": (total - success_count) / total if total else 0.0,
+        "errors": count_errors(results),
+        "wall_time": wall_time,
+        "throughput": total / wall_time if wall_time > 0 else 0.0,
+        "latency_unit": "batch" if scenario == "directory" else "image",
+        "latency": summarize_latency(latencies),
+        "vlm_seconds": total_vlm_seconds,
+        "vlm_seconds_per_image": total_vlm_seconds / total if total else 0.0,
+        "requests": wire["requests"],
+        "bytes_sent": wire["bytes_sent"],
+        "bytes_received": wire["bytes_received"],
+        "bytes_per_image": (wire["bytes_sent"] + wire["bytes_received"]) / total if total else 0.0
+    }
+
+def run_benchmark(test_dirs, scenarios=("single", "batch"), concurrency_levels=(1, 4, 16), image_sizes=(0,),
+                  batch_size=16, limit=100, recursive=False, base_url=None, mode=None, upload_format=None,
+                  warmup=2, use_cache=False):
+    """
+    在每个 场景 x 图片尺寸 x 并发数 组合下运行一次基准测试
+
+    Args:
+        test_dirs: 测试图片目录列表
+        scenarios: single（inference_single_base64）、batch（inference_batch_base64）、
+            directory（test_complete_directory，需要混合推理服务）
+        concurrency_levels: 并发数列表（single为线程数，batch为 max_in_flight，directory为在途批次数）
+        image_sizes: 图片最长边列表，0表示原图
+        batch_size: batch与directory场景的批次大小
+        limit: 最多使用的图片数
+        base_url: directory场景的混合推理服务地址
+        mode: VLM推理模式，None按配置决定
+        upload_format: directory场景的上传格式
+        warmup: 正式测试前预热调用的图片数（不计入结果）
+        use_cache: 为False时关闭客户端的结果缓存与近重复帧去重，避免重复图片直接命中缓存
+
+    Returns:
+        dict: 测试参数与每个组合的指标（runs）
+    """
+    if not use_cache:
+        vlm_inference.vlm_cache = None
+        vlm_inference.frame_deduplicator = None
+    if base_url is None:
+        base_url = inference_and_sve_json.DEFAULT_BASE_URL
+    prompt = config.get_prompt()
+
+    source_images = load_images(test_dirs, limit, recursive)
+    if not source_images:
+        raise ValueError(f"未在 {test_dirs} 中找到测试图片")
+    print(f"基准测试图片: {len(source_images)} 张")
+
+    if warmup and any(s != "directory" for s in scenarios):
+        run_single(source_images[:warmup], prompt, 1, mode)
+
+    runs = []
+    for image_size in image_sizes:
+        images = resize_images(source_images, image_size)
+        for scenario in scenarios:
+            for concurrency in concurrency_levels:
+                print(f"\n=== {scenario} | 图片尺寸 {image_size or '原图'} | 并发 {concurrency} ===")
+                run = run_scenario(scenario, images, prompt, concurrency, batch_size, image_size,
+                                   base_url, mode, upload_format)
+                runs.append(run)
+                latency = run["latency"]
+                print(f"吞吐: {run['throughput']:.2f} 张/秒, 错误率: {run['error_rate']:.2%}, "
+                      f"p50/p95/p99: {format_seconds(latency['p50'])}/{format_seconds(latency['p95'])}/"
+                      f"{format_seconds(latency['p99'])} ({run['latency_unit']}), "
+                      f"每张图片VLM耗时: {run['vlm_seconds_per_image']:.3f}秒, 每张图片字节数: {run['bytes_per_image']:.0f}")
+
+    return {
+        "benchmark": {
+            "created_at": datetime.now().isoformat(),
+            "test_dirs": list(test_dirs),
+            "images": len(source_images),
+            "scenarios": list(scenarios),
+            "concurrency_levels": list(concurrency_levels),
+            "image_sizes": list(image_sizes),
+            "batch_size": batch_size,
+            "mode": mode,
+            "upload_format": upload_format,
+            "use_cache": use_cache,
+            "vlm_api_bases": vlm_inference.VLLM_API_BASES,
+            "base_url": base_url if "directory" in scenarios else None
+        },
+        "runs": runs
+    }
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.3f}s"
+
+def get_metric(run, metric):
+    """按 'latency.p95' 形式的路径取指标值"""
+    value = run
+    for key in metric.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+def compare_reports(baseline, candidate, tolerance=DEFAULT_TOLERANCE, max_error_increase=DEFAULT_MAX_ERROR_INCREASE):
+    """
+    对比两次基准测试，按名称（场景/尺寸/并发/批次）匹配运行结果
+
+    吞吐下降、延迟/VLM耗时/字节数增加超过 tolerance（相对值），或错误率增加超过 max_error_increase（绝对值）
+    视为回退。
+
+    Returns:
+        dict: 每个匹配组合的指标对比（comparisons）、回退列表（regressions）与未匹配的组合
+    """
+    baseline_runs = {run["name"]: run for run in baseline["runs"]}
+    candidate_runs = {run["name"]: run for run in candidate["runs"]}
+    comparisons = []
+    regressions = []
+    for name, run in candidate_runs.items():
+        if name not in baseline_runs:
+            continue
+        base_run = baseline_runs[name]
+        metrics = {}
+        for metric, direction in COMPARE_METRICS.items():
+            old, new = get_metric(base_run, metric), get_metric(run, metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+            regressed = direction * change < -tolerance
+            metrics[metric] = {"baseline": old, "candidate": new, "change": change, "regressed": regressed}
+            if regressed:
+                regressions.append({"name": name, "metric": metric, "baseline": old, "candidate": new, "change": change})
+        old_error, new_error = base_run["error_rate"], run["error_rate"]
+        error_regressed = new_error - old_error > max_error_increase
+        metrics["error_rate"] = {"baseline": old_error, "candidate": new_error, "change": new_error - old_error,
+                                 "regressed": error_regressed}
+        if error_regressed:
+            regressions.append({"name": name, "metric": "error_rate", "baseline": old_error, "candidate": new_error,
+                                "change": new_error - old_error})
+        comparisons.append({"name": name, "metrics": metrics})
+
+    return {
+        "tolerance": tolerance,
+        "max_error_increase": max_error_increase,
+        "comparisons": comparisons,
+        "regressions": regressions,
+        "only_in_baseline": sorted(set(baseline_runs) - set(candidate_runs)),
+        "only_in_candidate": sorted(set(candidate_runs) - set(baseline_runs))
+    }
+
+def print_comparison(comparison):
+    """打印对比结果，回退的指标以 [回退] 标记"""
+    for item in comparison["comparisons"]:
+        print(f"\n{item['name']}")
+        for metric, values in item["metrics"].items():
+            change = (f"{values['change']:+.4f}" if metric == "error_rate" else f"{values['change']:+.1%}")
+            flag = "  [回退]" if values["regressed"] else ""
+            print(f"  {metric:<22} {values['baseline']:>12.4f} -> {values['candidate']:>12.4f}  ({change}){flag}")
+    for name in comparison["only_in_baseline"]:
+        print(f"\n仅在基线中: {name}")
+    for name in comparison["only_in_candidate"]:
+        print(f"\n仅在新结果中: {name}")
+    print(f"\n回退项: {len(comparison['regressions'])}")
+
+def save_report(report, filename=None):
+    """保存基准测试结果为JSON"""
+    if filename is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = os.path.join(DEFAULT_OUTPUT_DIR, f"benchmark_{timestamp}.json")
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到: {filename}")
+    return filename
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="VLM与混合推理基准测试（吞吐、延迟百分位、错误率与线路字节数）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="运行基准测试")
+    run_parser.add_argument("--dirs", nargs="+", default=["./test_images"], help="测试图片目录")
+    run_parser.add_argument("--recursive", action="store_true", help="递归扫描子目录")
+    run_parser.add_argument("--limit", type=int, default=100, help="最多使用的图片数")
+    run_parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=["single", "batch"], help="测试场景")
+    run_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="并发数列表")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[0], help="图片最长边列表，0表示原图")
+    run_parser.add_argument("--batch-size", type=int, default=16, help="batch与directory场景的批次大小")
+    run_parser.add_argument("--base-url", default=None, help="directory场景的混合推理服务地址")
+    run_parser.add_argument("--mode", choices=["fast", "think"], default=None, help="VLM推理模式")
+    run_parser.add_argument("--upload-format", choices=["json", "multipart"], default=None, help="directory场景的上传格式")
+    run_parser.add_argument("--warmup", type=int, default=2, help="预热图片数")
+    run_parser.add_argument("--use-cache", action="store_true", help="保留客户端结果缓存与近重复帧去重")
+    run_parser.add_argument("--output", default=None, help="结果JSON路径")
+
+    compare_parser = subparsers.add_parser("compare", help="对比两次基准测试结果")
+    compare_parser.add_argument("baseline", help="基线结果JSON")
+    compare_parser.add_argument("candidate", help="新结果JSON")
+    compare_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="允许的相对变化")
+    compare_parser.add_argument("--max-error-increase", type=float, default=DEFAULT_MAX_ERROR_INCREASE,
+                                help="允许的错误率绝对增加量")
+    compare_parser.add_argument("--output", default=None, help="对比结果JSON路径")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.command == "compare":
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.candidate, "r", encoding="utf-8") as f:
+            candidate = json.load(f)
+        comparison = compare_reports(baseline, candidate, args.tolerance, args.max_error_increase)
+        print_comparison(comparison)
+        if args.output:
+            save_report(comparison, args.output)
+        # 存在回退时以非零状态码退出，便于在CI中使用
+        sys.exit(1 if comparison["regressions"] else 0)
+
+    report = run_benchmark(
+        args.dirs, args.scenarios, args.concurrency, args.sizes, args.batch_size, args.limit, args.recursive,
+        args.base_url, args.mode, args.upload_format, args.warmup, args.use_cache
+    )
+    save_report(report, args.output)
+
+if __name__ == "__main__":
+    main()
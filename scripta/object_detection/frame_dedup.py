@@ -0,0 +1,168 @@
+import io
+import os
+import re
+import time
+import threading
+from collections import deque
+import numpy as np
+from PIL import Image
+from image_preprocess import image_data_to_bytes
+
+def dhash(image):
+    """
+    计算图像的64位差异哈希（dHash）
+
+    图像转灰度并缩放到 9x8，比较水平相邻像素的明暗得到64位哈希。
+    对噪声、轻微亮度变化和重新编码不敏感，适合固定机位的近重复帧判断。
+
+    Returns:
+        int: 64位哈希值
+    """
+    image.draft('L', (64, 64))  # JPEG可直接按缩小比例解码，省去全分辨率解码
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def dhash_image_data(image_data):
+    """计算原始图像字节或base64编码图像的dHash"""
+    try:
+        image = Image.open(io.BytesIO(image_data_to_bytes(image_data)))
+    except Exception as e:
+        raise ValueError(f"无法解码图片: {str(e)}")
+    return dhash(image)
+
+def hamming_distances(target_hash, hashes):
+    """向量化计算一个64位哈希与一组64位哈希之间的汉明距离"""
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(target_hash))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+class FrameDeduplicator:
+    """
+    固定机位近重复帧抑制
+
+    按相机（由图片名前缀解析）维护最近若干帧的dHash及其VLM结果，
+    新帧与同一相机最近的某帧汉明距离不超过阈值时直接复用该帧的结论。
+
+    同一批次中的近重复帧可能同时到达：正在推理的帧用 add_pending 登记，
+    后到的帧用 find_pending 找到与之相似的进行中帧，等它完成后再查找，VLM调用本身不需要串行。
+    """
+
+    def __init__(self, threshold=4, window=8, max_age=None, camera_pattern=r"^(.*)_\d+$"):
+        """
+        Args:
+            threshold: 判定为近重复的最大汉明距离
+            window: 每个相机保留的最近帧数
+            max_age: 历史帧的最长复用时间（秒），None表示不过期
+            camera_pattern: 从图片名（不含扩展名）解析相机标识的正则，取第1个分组；不匹配时使用整个文件名
+        """
+        self.threshold = threshold
+        self.window = window
+        self.max_age = max_age
+        self.camera_pattern = re.compile(camera_pattern)
+        self._index = {}  # 相机标识 -> deque[(哈希, 写入时间, 图片名, 结果)]
+        self._pending = {}  # 相机标识 -> [(哈希, 登记对象)]，正在推理、尚未记录结果的帧
+        self._lock = threading.Lock()
+        self._stats = {
+            "checked": 0,
+            "hits": 0,
+            "saved_seconds": 0.0
+        }
+
+    @classmethod
+    def from_config(cls, dedup_config):
+        """根据 vlm.dedup 配置块创建去重器"""
+        return cls(
+            threshold=dedup_config.get("threshold", 4),
+            window=dedup_config.get("window", 8),
+            max_age=dedup_config.get("max_age", None),
+            camera_pattern=dedup_config.get("camera_pattern", r"^(.*)_\d+$")
+        )
+
+    def camera_key(self, image_name):
+        """从图片名解析相机标识"""
+        stem = os.path.splitext(os.path.basename(image_name))[0]
+        match = self.camera_pattern.match(stem)
+        return match.group(1) if match else stem
+
+    def lookup(self, image_hash, image_name):
+        """
+        查找同一相机的近重复帧
+
+        Returns:
+            dict or None: 命中时返回 {'matched_image', 'distance', 'result'}
+        """
+        key = self.camera_key(image_name)
+        now = time.time()
+        with self._lock:
+            self._stats["checked"] += 1
+            entries = self._index.get(key)
+            if not entries:
+                return None
+            if self.max_age is not None:
+                while entries and now - entries[0][1] > self.max_age:
+                    entries.popleft()
+                if not entries:
+                    return None
+            distances = hamming_distances(image_hash, [entry[0] for entry in entries])
+            best = int(np.argmin(distances))
+            if distances[best] > self.threshold:
+                return None
+            _, _, matched_image, result = entries[best]
+            self._stats["hits"] += 1
+            self._stats["saved_seconds"] += result.get("processing_time", 0)
+            return {
+                "matched_image": matched_image,
+                "distance": int(distances[best]),
+                "result": dict(result)
+            }
+
+    def record(self, image_hash, image_name, result):
+        """记录一帧的哈希及其VLM结果，推理失败的结果不记录"""
+        if not result.get("success"):
+            return
+        key = self.camera_key(image_name)
+        with self._lock:
+            entries = self._index.setdefault(key, deque(maxlen=self.window))
+            entries.append((image_hash, time.time(), image_name, dict(result)))
+
+    def find_pending(self, image_hash, image_name):
+        """
+        查找同一相机正在推理的近重复帧
+
+        Returns:
+            add_pending 登记的对象，没有时返回None
+        """
+        key = self.camera_key(image_name)
+        with self._lock:
+            pending = self._pending.get(key)
+            if not pending:
+                return None
+            distances = hamming_distances(image_hash, [entry[0] for entry in pending])
+            best = int(np.argmin(distances))
+            return pending[best][1] if distances[best] <= self.threshold else None
+
+    def add_pending(self, image_hash, image_name, token):
+        """登记一帧正在推理，token 由调用方决定（如等待推理完成用的future）"""
+        key = self.camera_key(image_name)
+        with self._lock:
+            self._pending.setdefault(key, []).append((image_hash, token))
+
+    def remove_pending(self, image_name, token):
+        """推理结束（无论成功与否）后移除登记"""
+        key = self.camera_key(image_name)
+        with self._lock:
+            pending = [entry for entry in self._pending.get(key, []) if entry[1] is not token]
+            if pending:
+                self._pending[key] = pending
+            else:
+                self._pending.pop(key, None)
+
+    def stats(self):
+        """获取去重统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cameras"] = len(self._index)
+        stats["dedup_rate"] = stats["hits"] / stats["checked"] if stats["checked"] > 0 else 0
+        return stats
@@ -0,0 +1,543 @@
+import io
+import time
+import binascii
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import Flask, request, jsonify, Response
+from PIL import Image
+from config_loader import config
+from image_preprocess import image_data_to_bytes
+from yolo_stage import create_detector, VLMGatePolicy
+from tracing import (
+    Trace, StageMetrics, TraceBuffer, TRACE_HEADER, parse_traceparent, to_otel_json,
+    SERVICE_NAME, HISTOGRAM_BUCKETS, TRACE_BUFFER_SIZE
+)
+from vlm_inference import (
+    inference_batch_base64, POSITIVE_ANSWER,
+    get_cache_stats, get_dedup_stats, get_endpoint_stats
+)
+
+# 获取配置
+yolo_config = config.get_yolo_config()
+flask_config = config.get_flask_config()
+PROMPT = config.get_prompt()
+
+# YOLO 配置
+YOLO_MODEL_PATH = yolo_config.get("model_path", "weights/best.pt")
+YOLO_CONF_THRESHOLD = yolo_config.get("conf_threshold", 0.25)  # 请求未指定置信度阈值时使用
+vlm_gate = VLMGatePolicy.from_config(yolo_config)  # 按YOLO置信度决定是否送VLM确认
+
+# 服务配置
+MAX_BATCH_SIZE = flask_config.get("max_batch_size", 16)  # 单个微批次的最大图片数
+MAX_WORKERS = flask_config.get("max_workers", 8)  # 同时处理的微批次数
+MAX_WAIT = flask_config.get("max_wait_ms", 20) / 1000  # 微批次凑批的最长等待时间（秒）
+MAX_QUEUE_SIZE = flask_config.get("max_queue_size", 256)  # 排队图片数上限，超过时返回429
+REQUEST_TIMEOUT = flask_config.get("request_timeout", 300)  # 单个HTTP请求等待结果的最长时间（秒）
+
+# 追踪配置
+tracing_config = config.get("tracing", {})
+TRACE_SERVICE_NAME = tracing_config.get("service_name", SERVICE_NAME)  # 导出OpenTelemetry JSON时的服务名
+TRACE_HISTOGRAM_BUCKETS = tracing_config.get("histogram_buckets", HISTOGRAM_BUCKETS)  # 各阶段耗时直方图的桶上界（秒）
+TRACE_BUFFER = tracing_config.get("buffer_size", TRACE_BUFFER_SIZE)  # 保留的最近追踪数
+
+# 各阶段耗时统计（/metrics）与最近的追踪记录（/traces）
+stage_metrics = StageMetrics(TRACE_HISTOGRAM_BUCKETS)
+trace_buffer = TraceBuffer(TRACE_BUFFER)
+
+class QueueFullError(Exception):
+    """请求队列已满"""
+
+class MicroBatcher:
+    """
+    微批次请求队列
+
+    单张图片请求与批量请求中的每张图片都进入同一个队列，调度线程把最早的请求等待max_wait秒内到达的
+    请求合并为不超过max_batch_size张的微批次，交给max_workers个worker处理。
+    worker全忙时请求在队列中积压，队列中的图片数超过max_queue_size时新请求被拒绝（QueueFullError）。
+    """
+
+    def __init__(self, process_batch, max_batch_size=16, max_wait=0.02, max_workers=8, max_queue_size=256):
+        """
+        Args:
+            process_batch: 处理函数 process_batch(items)，返回与items等长的结果列表
+            max_batch_size: 单个微批次的最大图片数
+            max_wait: 凑批的最长等待时间（秒），从批次中最早的请求入队开始计算
+            max_workers: 同时处理的微批次数
+            max_queue_size: 排队图片数上限
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.max_workers = max(1, max_workers)
+        self.max_queue_size = max_queue_size
+        self._queue = deque()  # (请求, Future, 入队时间)
+        self._condition = threading.Condition()
+        self._idle_workers = threading.Semaphore(self.max_workers)
+        self._workers = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hybrid-worker")
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "batches": 0,
+            "batched_items": 0,
+            "busy_workers": 0,
+            "total_queue_time": 0.0
+        }
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="hybrid-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def submit_many(self, items):
+        """
+        提交一组请求，全部入队或全部拒绝
+
+        Returns:
+            list: 与items对应的Future，结果为 process_batch 返回的单项结果
+
+        Raises:
+            QueueFullError: 队列剩余容量不足
+        """
+        futures = [Future() for _ in items]
+        with self._condition:
+            if len(self._queue) + len(items) > self.max_queue_size:
+                with self._stats_lock:
+                    self._stats["rejected"] += len(items)
+                raise QueueFullError(f"请求队列已满 ({len(self._queue)}/{self.max_queue_size})")
+            now = time.time()
+            for item, future in zip(items, futures):
+                self._queue.append((item, future, now))
+            self._condition.notify()
+        with self._stats_lock:
+            self._stats["submitted"] += len(items)
+        return futures
+
+    def submit(self, item):
+        """提交单个请求"""
+        return self.submit_many([item])[0]
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            deadline = self._queue[0][2] + self.max_wait
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+
+    def _dispatch_loop(self):
+        while True:
+            # 先等到空闲worker再取批次，worker全忙期间到达的请求可以合并进下一个批次
+            self._idle_workers.acquire()
+            batch = self._next_batch()
+            self._workers.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        start_time = time.time()
+        with self._stats_lock:
+            self._stats["busy_workers"] += 1
+            self._stats["batches"] += 1
+            self._stats["batched_items"] += len(batch)
+            self._stats["total_queue_time"] += sum(start_time - enqueued_at for _, _, enqueued_at in batch)
+        try:
+            items = [dict(item, queue_time=start_time - enqueued_at) for item, _, enqueued_at in batch]
+            try:
+                results = self.process_batch(items)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                return
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        finally:
+            with self._stats_lock:
+                self._stats["busy_workers"] -= 1
+            self._idle_workers.release()
+
+    def stats(self):
+        """获取队列统计"""
+        with self._condition:
+            queue_size = len(self._queue)
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({
+            "queue_size": queue_size,
+            "max_queue_size": self.max_queue_size,
+            "max_batch_size": self.max_batch_size,
+            "max_workers": self.max_workers,
+            "avg_batch_size": stats["batched_items"] / stats["batches"] if stats["batches"] > 0 else 0,
+            "avg_queue_time": stats["total_queue_time"] / stats["batched_items"] if stats["batched_items"] > 0 else 0
+        })
+        return stats
+
+def new_item_trace(item, trace_id=None):
+    """
+    为一张图片创建服务端追踪：顶层span hybrid_server 覆盖从收到请求到结果生成，
+    request_parse（读取请求体并解码）、queue_wait、image_decode、yolo 与 VLM 各阶段都是它的子span
+    """
+    item["trace"] = Trace(trace_id)
+    item["trace"].add_span("request_parse", item["received_at"], time.time())
+    return item
+
+def _finish_trace(item, **attributes):
+    """补上顶层span并记录到各阶段统计，返回追踪记录"""
+    trace = item.get("trace")
+    if trace is None:
+        return None
+    trace.finish("hybrid_server", item["received_at"], image_name=item["image_name"], **attributes)
+    trace_dict = trace.to_dict()
+    stage_metrics.observe_trace(trace_dict)
+    trace_buffer.add(trace_dict)
+    return trace_dict
+
+def _error_result(item, error):
+    return {
+        "success": False,
+        "error": error,
+        "image_name": item["image_name"],
+        "processing_time": time.time() - item["received_at"],
+        "trace": _finish_trace(item, success=False)
+    }
+
+def build_hybrid_result(item, objects, vlm_result=None, gate_decision=None):
+    """根据YOLO检测结果、送检决策与VLM分析结果构建单张图片的串联推理结果"""
+    open_objects = vlm_gate.open_objects(objects)
+    if gate_decision is None:
+        gate_decision = "escalate" if open_objects else "no_open"
+    steps = ["YOLO检测完成"]
+    if gate_decision == "no_open":
+        steps.append("未检测到盖板缺失，不需要VLM分析")
+        final_decision = "盖板存在"
+    elif gate_decision == "accept":
+        steps.append("检测到盖板缺失，YOLO置信度高，跳过VLM分析")
+        final_decision = "盖板缺失"
+    elif gate_decision == "reject":
+        steps.append("检测到盖板缺失，YOLO置信度低，视为误检，跳过VLM分析")
+        final_decision = "盖板存在"
+    else:
+        steps.append("检测到盖板缺失，启动VLM分析")
+        if vlm_result is not None and vlm_result.get("success"):
+            steps.append("VLM分析完成")
+            if vlm_result.get("answer") == POSITIVE_ANSWER:
+                steps.append("VLM确认盖板缺失")
+                final_decision = "盖板缺失"
+            else:
+                steps.append("VLM否定盖板缺失")
+                final_decision = "盖板存在"
+        else:
+            # VLM不可用时保守地采用YOLO结论，避免漏报
+            steps.append("VLM分析失败，采用YOLO检测结果")
+            final_decision = "盖板缺失"
+    detection_boxes = open_objects if final_decision == "盖板缺失" else []
+    if vlm_result is not None and "trace" in vlm_result and item.get("trace") is not None:
+        # VLM的span并入本图片的追踪，结果中不再重复保存
+        item["trace"].merge(vlm_result["trace"], parent_id=item["trace"].root_span_id)
+        vlm_result = {key: value for key, value in vlm_result.items() if key != "trace"}
+    return {
+        "success": True,
+        "image_name": item["image_name"],
+        "final_decision": final_decision,
+        "yolo_detection": {
+            "has_open": bool(open_objects),
+            "detection_count": len(objects),
+            "objects": objects,
+            "open_objects": open_objects
+        },
+        "detection_summary": {
+            "open_count": len(open_objects),
+            "total_objects": len(objects),
+            "used_vlm": gate_decision == "escalate",
+            "gate_decision": gate_decision,
+            "boxes_returned": len(detection_boxes)
+        },
+        "detection_boxes": detection_boxes,
+        "processing_steps": steps,
+        "vlm_analysis": vlm_result,
+        "queue_time": item.get("queue_time", 0),
+        "processing_time": time.time() - item["received_at"],
+        "trace": _finish_trace(item, success=True, final_decision=final_decision, gate_decision=gate_decision)
+    }
+
+def process_hybrid_batch(items):
+    """
+    处理一个微批次：YOLO一次检测整批图片，检测到盖板缺失且置信度处于不确定区间的图片再并发送VLM确认
+
+    Args:
+        items: 请求列表，每个元素包含 'image_bytes'、'image_name'、'conf_threshold'、'received_at'，
+            以及可选的追踪信息（见 new_item_trace）
+
+    Returns:
+        list: 与items等长的串联推理结果
+    """
+    batch_start = time.time()
+    for item in items:
+        if item.get("trace") is not None:
+            item["trace"].add_span("queue_wait", batch_start - item.get("queue_time", 0), batch_start)
+    results = [None] * len(items)
+    images = []
+    valid_indices = []
+    for i, item in enumerate(items):
+        decode_start = time.time()
+        try:
+            images.append(Image.open(io.BytesIO(item["image_bytes"])).convert("RGB"))
+            valid_indices.append(i)
+        except Exception as e:
+            results[i] = _error_result(item, f"图片解码失败: {str(e)}")
+        if item.get("trace") is not None:
+            item["trace"].add_span("image_decode", decode_start, time.time())
+    if not valid_indices:
+        return results
+
+    # 整批使用最低的置信度阈值检测，再按各请求自己的阈值过滤
+    yolo_start = time.time()
+    try:
+        min_conf = min(items[i]["conf_threshold"] for i in valid_indices)
+        detections = detector.detect(images, min_conf)
+    except Exception as e:
+        for i in valid_indices:
+            results[i] = _error_result(items[i], f"YOLO检测失败: {str(e)}")
+        return results
+    yolo_end = time.time()
+    for i in valid_indices:
+        # 整批一次检测，各图片记录同一段耗时
+        if items[i].get("trace") is not None:
+            items[i]["trace"].add_span("yolo", yolo_start, yolo_end, batch_size=len(valid_indices))
+    objects_by_index = {
+        i: [obj for obj in objects if obj["conf"] >= items[i]["conf_threshold"]]
+        for i, objects in zip(valid_indices, detections)
+    }
+
+    gate_decisions = {i: vlm_gate.decide(vlm_gate.open_objects(objects_by_index[i])) for i in valid_indices}
+    vlm_indices = [i for i in valid_indices if gate_decisions[i] == "escalate"]
+    vlm_results = {}
+    if vlm_indices:
+        vlm_batch = inference_batch_base64(
+            [
+                {
+                    "image_bytes": items[i]["image_bytes"],
+                    "image_name": items[i]["image_name"],
+                    "trace_id": items[i]["trace"].trace_id if items[i].get("trace") is not None else None
+                }
+                for i in vlm_indices
+            ],
+            PROMPT
+        )
+        vlm_results = dict(zip(vlm_indices, vlm_batch))
+
+    for i in valid_indices:
+        results[i] = build_hybrid_result(items[i], objects_by_index[i], vlm_results.get(i), gate_decisions[i])
+    return results
+
+def summarize_batch(results, start_time):
+    """批量请求的处理摘要"""
+    open_count = sum(1 for r in results if r.get("final_decision") == "盖板缺失")
+    return {
+        "total_count": len(results),
+        "success_count": sum(1 for r in results if r.get("success")),
+        "open_alarm_count": open_count,
+        "open_count": open_count,
+        "vlm_used_count": sum(1 for r in results if r.get("detection_summary", {}).get("used_vlm")),
+        "boxes_returned_count": sum(1 for r in results if r.get("detection_summary", {}).get("boxes_returned", 0) > 0),
+        "processing_time": time.time() - start_time
+    }
+
+app = Flask(__name__)
+app.json.ensure_ascii = False
+detector = None
+batcher = None
+
+def init_server(yolo_detector=None):
+    """加载YOLO模型并启动微批次队列，yolo_detector 可传入自定义检测器（需实现 detect(images, conf)）"""
+    global detector, batcher
+    detector = yolo_detector if yolo_detector is not None else create_detector(yolo_config)
+    batcher = MicroBatcher(process_hybrid_batch, MAX_BATCH_SIZE, MAX_WAIT, MAX_WORKERS, MAX_QUEUE_SIZE)
+
+def _parse_conf_threshold(value):
+    return float(value) if value not in (None, "") else YOLO_CONF_THRESHOLD
+
+def _parse_json_image(image_data, received_at, default_conf=None, trace_id=None):
+    if not isinstance(image_data, dict):
+        raise ValueError("图片数据格式错误")
+    image_base64 = image_data.get("image_base64")
+    if not image_base64:
+        raise ValueError("缺少 image_base64")
+    try:
+        image_bytes = image_data_to_bytes(image_base64)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"无法解码base64图片: {str(e)}")
+    return new_item_trace({
+        "image_bytes": image_bytes,
+        "image_name": image_data.get("image_name", "image"),
+        "conf_threshold": _parse_conf_threshold(image_data.get("conf_threshold", default_conf)),
+        "received_at": received_at
+    }, image_data.get("trace_id") or trace_id)
+
+def _invalid_json_image(image_data, received_at, error):
+    """无法解析的图片，只保留生成错误结果所需的信息"""
+    image_data = image_data if isinstance(image_data, dict) else {}
+    return new_item_trace({
+        "image_name": image_data.get("image_name", "image"),
+        "received_at": received_at,
+        "error": error
+    }, image_data.get("trace_id"))
+
+def _wait_results(futures, items):
+    results = []
+    deadline = time.time() + REQUEST_TIMEOUT
+    for future, item in zip(futures, items):
+        try:
+            results.append(future.result(timeout=max(0, deadline - time.time())))
+        except FutureTimeoutError:
+            results.append(_error_result(item, f"处理超时 (超时时间: {REQUEST_TIMEOUT}秒)"))
+        except Exception as e:
+            results.append(_error_result(item, f"串联推理过程中出现未知错误: {str(e)}"))
+    return results
+
+def _queue_full_response(e):
+    response = jsonify({"success": False, "error": str(e)})
+    response.status_code = 429
+    response.headers["Retry-After"] = "1"
+    return response
+
+@app.route("/hybrid_inference", methods=["POST"])
+def hybrid_inference():
+    """
+    单张图片YOLO + VLM串联推理
+
+    支持两种请求格式：
+        - JSON: {"image_base64", "image_name", "conf_threshold", "trace_id"}
+        - multipart/form-data: 文件字段 image，表单字段 image_name、conf_threshold、trace_id
+    trace_id 也可以通过 traceparent 请求头传入，都没有时由服务端生成。
+    """
+    received_at = time.time()
+    header_trace_id, _ = parse_traceparent(request.headers.get(TRACE_HEADER))
+    try:
+        if request.files:
+            image_file = request.files.get("image")
+            if image_file is None:
+                raise ValueError("缺少文件字段 image")
+            item = new_item_trace({
+                "image_bytes": image_file.read(),
+                "image_name": request.form.get("image_name") or image_file.filename or "image",
+                "conf_threshold": _parse_conf_threshold(request.form.get("conf_threshold")),
+                "received_at": received_at
+            }, request.form.get("trace_id") or header_trace_id)
+        else:
+            item = _parse_json_image(request.get_json(silent=True) or {}, received_at, trace_id=header_trace_id)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    try:
+        future = batcher.submit(item)
+    except QueueFullError as e:
+        return _queue_full_response(e)
+    result = _wait_results([future], [item])[0]
+    return jsonify(result), 200 if result.get("success") else 500
+
+@app.route("/hybrid_inference/batch", methods=["POST"])
+def hybrid_inference_batch():
+    """
+    批量YOLO + VLM串联推理，每张图片单独进入微批次队列，结果按请求顺序返回
+
+    支持两种请求格式：
+        - JSON: {"images": [{"image_base64", "image_name", "conf_threshold", "trace_id"}, ...]}
+        - multipart/form-data: 每张图片一个名为 images 的文件字段（文件名即图片名），表单字段 conf_threshold，
+          以及可选的、与图片一一对应的 trace_ids 字段
+    每张图片使用各自的trace_id，未提供时由服务端生成。
+    """
+    received_at = time.time()
+    try:
+        if request.files:
+            conf_threshold = _parse_conf_threshold(request.form.get("conf_threshold"))
+            image_files = request.files.getlist("images")
+            trace_ids = request.form.getlist("trace_ids")
+            trace_ids += [None] * (len(image_files) - len(trace_ids))
+            items = [
+                new_item_trace({
+                    "image_bytes": image_file.read(),
+                    "image_name": image_file.filename or f"image_{i}",
+                    "conf_threshold": conf_threshold,
+                    "received_at": received_at
+                }, trace_ids[i])
+                for i, image_file in enumerate(image_files)
+            ]
+        else:
+            data = request.get_json(silent=True) or {}
+            items = []
+            for image_data in data.get("images", []):
+                try:
+                    items.append(_parse_json_image(image_data, received_at, data.get("conf_threshold")))
+                except ValueError as e:
+                    # 单张图片解码失败只影响该图片，其余图片照常处理
+                    items.append(_invalid_json_image(image_data, received_at, str(e)))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if not items:
+        return jsonify({"success": False, "error": "请求中没有图片"}), 400
+
+    valid_items = [item for item in items if "error" not in item]
+    try:
+        futures = batcher.submit_many(valid_items) if valid_items else []
+    except QueueFullError as e:
+        return _queue_full_response(e)
+    valid_results = iter(_wait_results(futures, valid_items))
+    results = [_error_result(item, item["error"]) if "error" in item else next(valid_results) for item in items]
+    return jsonify({
+        "success": True,
+        "results": results,
+        "batch_summary": summarize_batch(results, received_at)
+    })
+
+@app.route("/health", methods=["GET"])
+def health():
+    """健康检查"""
+    return jsonify({"status": "ok", "queue_size": batcher.stats()["queue_size"]})
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """各处理阶段耗时直方图（Prometheus文本格式）"""
+    return Response(stage_metrics.to_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/traces", methods=["GET"])
+def traces():
+    """
+    最近的追踪记录，默认为OpenTelemetry OTLP/JSON格式；
+    参数 trace_id 只返回指定追踪，format=raw 返回原始span列表
+    """
+    snapshot = trace_buffer.snapshot(request.args.get("trace_id"))
+    if request.args.get("format") == "raw":
+        return jsonify(snapshot)
+    return jsonify(to_otel_json(snapshot, TRACE_SERVICE_NAME))
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """队列、VLM送检决策、各阶段耗时、VLM缓存、去重与各vLLM副本的统计"""
+    return jsonify({
+        "queue": batcher.stats(),
+        "vlm_gate": vlm_gate.stats(),
+        "stages": stage_metrics.stats(),
+        "vlm_cache": get_cache_stats(),
+        "vlm_dedup": get_dedup_stats(),
+        "vlm_endpoints": get_endpoint_stats()
+    })
+
+def main():
+    print("=== YOLO + VLM 串联推理服务 ===")
+    print(f"YOLO模型: {YOLO_MODEL_PATH}")
+    print(f"VLM送检区间: [{vlm_gate.skip_below}, {vlm_gate.accept_above})（None表示不限制）")
+    print(f"微批次: 最大 {MAX_BATCH_SIZE} 张, 最长等待 {MAX_WAIT * 1000:.0f}毫秒")
+    print(f"worker数: {MAX_WORKERS}, 队列上限: {MAX_QUEUE_SIZE}")
+    init_server()
+    # 调试模式的自动重载会启动第二个进程重复加载模型，这里关闭
+    app.run(
+        host=flask_config.get("host", "0.0.0.0"),
+        port=flask_config.get("port", 5000),
+        debug=flask_config.get("debug", False),
+        threaded=True,
+        use_reloader=False
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import io
+import math
+import time
+import base64
+from PIL import Image
+
+def strip_data_url(image_base64):
+    """移除base64字符串的数据URL前缀"""
+    if image_base64.startswith('data:image'):
+        image_base64 = image_base64.split(',')[1]
+    return image_base64
+
+def image_data_to_bytes(image_data):
+    """将图像数据统一为原始字节：bytes原样返回，base64字符串（可带数据URL前缀）解码"""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return bytes(image_data)
+    return base64.b64decode(strip_data_url(image_data))
+
+def image_data_to_base64(image_data):
+    """将图像数据统一为不带前缀的base64字符串，只在提交给OpenAI兼容接口时使用"""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return base64.b64encode(image_data).decode('utf-8')
+    return strip_data_url(image_data)
+
+def image_data_size(image_data):
+    """图像数据对应的原始字节数（base64字符串按长度估算，不解码）"""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return len(image_data)
+    return len(strip_data_url(image_data)) * 3 // 4
+
+def open_image(image_data):
+    """打开原始图像字节或base64字符串，只解析文件头（尺寸、格式），像素在首次使用时才解码"""
+    try:
+        return Image.open(io.BytesIO(image_data_to_bytes(image_data)))
+    except Exception as e:
+        raise ValueError(f"无法解码图片: {str(e)}")
+
+def decode_image(image_data):
+    """将原始图像字节或base64字符串解码为PIL图像"""
+    image = open_image(image_data)
+    try:
+        image.load()
+        return image
+    except Exception as e:
+        raise ValueError(f"无法解码图片: {str(e)}")
+
+def encode_image_to_jpeg(image, quality=95):
+    """将PIL图像编码为JPEG字节"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def expand_box(bbox, margin, image_size, min_size=0):
+    """
+    按比例向外扩展检测框，保留目标周围的上下文
+
+    Args:
+        bbox: [x1, y1, x2, y2]
+        margin: 扩展比例，相对检测框宽高，例如0.5表示每边各扩展半个宽/高
+        image_size: (宽, 高)，扩展结果会被裁剪到图像范围内
+        min_size: 裁剪区域的最小边长（像素）
+
+    Returns:
+        list: 扩展后的 [x1, y1, x2, y2]
+    """
+    width, height = image_size
+    x1, y1, x2, y2 = bbox
+    pad_w = (x2 - x1) * margin
+    pad_h = (y2 - y1) * margin
+    x1, y1, x2, y2 = x1 - pad_w, y1 - pad_h, x2 + pad_w, y2 + pad_h
+
+    # 小目标扩展到最小边长，避免裁剪区域过小导致VLM看不清
+    if x2 - x1 < min_size:
+        cx = (x1 + x2) / 2
+        x1, x2 = cx - min_size / 2, cx + min_size / 2
+    if y2 - y1 < min_size:
+        cy = (y1 + y2) / 2
+        y1, y2 = cy - min_size / 2, cy + min_size / 2
+
+    return [max(0, int(x1)), max(0, int(y1)), min(width, int(round(x2))), min(height, int(round(y2)))]
+
+def merge_boxes(boxes, merge_distance):
+    """
+    合并间距小于merge_distance的框
+
+    Args:
+        boxes: 框列表，每个元素为 {'box': [x1, y1, x2, y2], 'source_indices': [...]}
+        merge_distance: 两框之间的最大间隙（像素），小于该值则合并为一个外接框
+
+    Returns:
+        list: 合并后的框列表，结构与输入相同
+    """
+    boxes = [{'box': list(b['box']), 'source_indices': list(b['source_indices'])} for b in boxes]
+    merged = True
+    while merged and len(boxes) > 1:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i]['box'], boxes[j]['box']
+                gap_x = max(0, max(a[0], b[0]) - min(a[2], b[2]))
+                gap_y = max(0, max(a[1], b[1]) - min(a[3], b[3]))
+                if gap_x <= merge_distance and gap_y <= merge_distance:
+                    boxes[i] = {
+                        'box': [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])],
+                        'source_indices': sorted(boxes[i]['source_indices'] + boxes[j]['source_indices'])
+                    }
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+def crop_regions(image_data, bboxes, margin=0.5, merge_distance=None, min_size=0, quality=95):
+    """
+    按检测框裁剪出待VLM分析的区域
+
+    Args:
+        image_data: 原图数据，原始字节或base64字符串
+        bboxes: 检测框列表，每个元素为 [x1, y1, x2, y2]
+        margin: 上下文扩展比例，见 expand_box
+        merge_distance: 扩展后的框间隙小于该值时合并为一个裁剪区域，None表示不合并
+        min_size: 裁剪区域的最小边长（像素）
+        quality: 裁剪图JPEG编码质量
+
+    Returns:
+        list: 裁剪结果列表，每个元素包含：
+            - 'crop_index': 裁剪区域序号
+            - 'crop_box': 裁剪区域在原图中的坐标 [x1, y1, x2, y2]
+            - 'source_indices': 该区域包含的检测框在bboxes中的下标
+            - 'image_bytes': 裁剪图的JPEG字节
+    """
+    image = decode_image(image_data)
+    regions = [
+        {'box': expand_box(bbox, margin, image.size, min_size), 'source_indices': [i]}
+        for i, bbox in enumerate(bboxes)
+    ]
+    if merge_distance is not None:
+        regions = merge_boxes(regions, merge_distance)
+
+    crops = []
+    for crop_index, region in enumerate(regions):
+        crops.append({
+            'crop_index': crop_index,
+            'crop_box': region['box'],
+            'source_indices': region['source_indices'],
+            'image_bytes': encode_image_to_jpeg(image.crop(tuple(region['box'])), quality)
+        })
+    return crops
+
+def estimate_vision_tokens(width, height, patch_size=28):
+    """估算图像经Qwen2.5-VL编码后的视觉token数（每个 patch_size x patch_size 区域对应一个token）"""
+    return max(1, round(height / patch_size)) * max(1, round(width / patch_size))
+
+def fit_to_pixel_budget(width, height, max_pixels, patch_size=28):
+    """
+    计算满足像素预算的目标尺寸，保持宽高比
+
+    未超出预算时返回原尺寸（不缩放、不重新编码，patch对齐由vLLM的预处理完成）；
+    超出预算时缩小并向下对齐到patch_size的整数倍，保证结果不超出预算。
+
+    Returns:
+        tuple: (目标宽, 目标高)
+    """
+    if not max_pixels or width * height <= max_pixels:
+        return width, height
+    beta = math.sqrt(height * width / max_pixels)
+    new_height = max(patch_size, math.floor(height / beta / patch_size) * patch_size)
+    new_width = max(patch_size, math.floor(width / beta / patch_size) * patch_size)
+    return new_width, new_height
+
+def preprocess_image(image_data, max_pixels=None, max_vision_tokens=None, patch_size=28, quality=85):
+    """
+    VLM提交前的图像预处理：按像素/视觉token预算缩放并对齐到patch倍数、重新JPEG编码
+
+    先只读取文件头得到尺寸，未超出预算时不解码像素，原样返回输入。
+
+    Args:
+        image_data: 原图数据，原始字节或base64字符串
+        max_pixels: 最大像素数，None表示不限制
+        max_vision_tokens: 最大视觉token数，会换算为 max_vision_tokens * patch_size^2 的像素预算，
+            与max_pixels同时设置时取较小者
+        patch_size: 模型的patch对齐倍数（Qwen2.5-VL为 14 * 2 = 28）
+        quality: 重新编码的JPEG质量
+
+    Returns:
+        tuple: (处理后的图像数据, 统计信息)。不需要缩放时原样返回输入，否则返回缩放后重新编码的JPEG字节。
+            统计信息包含：
+            - 'original': 原图的宽、高、字节数、估算视觉token数
+            - 'processed': 处理后的宽、高、字节数、估算视觉token数
+            - 'resized': 是否进行了缩放（只有缩放时才重新编码）
+            - 'preprocess_time': 预处理耗时（秒）
+    """
+    start_time = time.time()
+    original_bytes = image_data_size(image_data)
+
+    budgets = [b for b in (max_pixels, max_vision_tokens and max_vision_tokens * patch_size * patch_size) if b]
+    pixel_budget = min(budgets) if budgets else None
+
+    image = open_image(image_data)
+    width, height = image.size
+    new_width, new_height = fit_to_pixel_budget(width, height, pixel_budget, patch_size)
+
+    resized = (new_width, new_height) != (width, height)
+    if resized:
+        # JPEG按目标尺寸以缩小的比例解码（draft），减少解码的像素数
+        image.draft('RGB', (new_width, new_height))
+        try:
+            image = image.convert('RGB').resize((new_width, new_height), Image.BICUBIC)
+        except Exception as e:
+            raise ValueError(f"无法解码图片: {str(e)}")
+        image_data = encode_image_to_jpeg(image, quality)
+
+    stats = {
+        'original': {
+            'width': width,
+            'height': height,
+            'bytes': original_bytes,
+            'vision_tokens': estimate_vision_tokens(width, height, patch_size)
+        },
+        'processed': {
+            'width': new_width,
+            'height': new_height,
+            'bytes': image_data_size(image_data),
+            'vision_tokens': estimate_vision_tokens(new_width, new_height, patch_size)
+        },
+        'resized': resized,
+        'preprocess_time': time.time() - start_time
+    }
+    return image_data, stats
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif'}  # 扩展名比较时忽略大小写
+
+def is_image_file(name):
+    """按扩展名（忽略大小写）判断是否为图片文件"""
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+def scan_directory(directory):
+    """
+    单次列出目录，区分图片文件与子目录
+
+    Returns:
+        tuple: (图片列表 [(路径, 字节数, 修改时间)], 子目录列表, 目录修改时间)
+    """
+    images = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):  # 不跟随目录符号链接，避免循环
+                    subdirs.append(entry.path)
+                elif entry.is_file() and is_image_file(entry.name):
+                    stat = entry.stat()
+                    images.append((entry.path, stat.st_size, stat.st_mtime))
+            except OSError:
+                # 扫描过程中被删除或无权限的条目直接跳过
+                continue
+    images.sort()
+    subdirs.sort()
+    return images, subdirs, os.stat(directory).st_mtime
+
+class ImageManifest:
+    """
+    图片清单缓存
+
+    记录一次完整扫描得到的图片（路径、字节数、修改时间）以及扫描过的每个目录的修改时间。
+    再次运行时只需stat这些目录与图片（不列目录内容），全部未变化即直接使用清单，跳过扫描；
+    在目录中增删文件会改变目录的修改时间，原地改写图片会改变图片的字节数或修改时间，清单随之失效。
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def _key(test_dirs, recursive):
+        return {"dirs": [os.path.abspath(d) for d in test_dirs], "recursive": recursive}
+
+    def load(self, test_dirs, recursive):
+        """读取与本次参数匹配且仍然有效的清单，返回图片列表；不存在或已失效时返回None"""
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("key") != self._key(test_dirs, recursive):
+            return None
+        for directory, mtime in manifest.get("directories", {}).items():
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    return None
+            except OSError:
+                return None
+        images = [tuple(image) for image in manifest.get("images", [])]
+        for path, size, mtime in images:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            if stat.st_size != size or stat.st_mtime != mtime:
+                return None
+        return images
+
+    def save(self, test_dirs, recursive, images, directories):
+        """写入清单（先写临时文件再替换）"""
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "key": self._key(test_dirs, recursive),
+                "created_at": time.time(),
+                "directories": directories,
+                "images": images
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+def iter_image_entries(test_dirs, recursive=False, workers=8, manifest_path=None, refresh=False):
+    """
+    惰性扫描图片，边扫描边产出 (路径, 字节数, 修改时间)
+
+    每个目录只列一次（os.scandir），子目录在线程池中并行预扫描，调用方可以在扫描结束前就开始处理。
+    产出顺序固定：按test_dirs的顺序，每个目录先产出其中的图片，再依次进入各子目录（均按名称排序，深度优先）。
+    重复出现的路径（如test_dirs互相包含）只产出一次。
+
+    Args:
+        test_dirs: 目录列表，不存在的目录会被忽略
+        recursive: 是否递归扫描子目录
+        workers: 并行扫描的线程数
+        manifest_path: 清单缓存文件路径，None表示不缓存；清单有效时直接从清单产出，
+            完整扫描结束后写入清单
+        refresh: 为True时忽略已有清单，重新扫描
+    """
+    test_dirs = [d for d in test_dirs if os.path.isdir(d)]
+    manifest = ImageManifest(manifest_path)
+    if not refresh:
+        cached = manifest.load(test_dirs, recursive)
+        if cached is not None:
+            yield from cached
+            return
+
+    seen = set()
+    images = []
+    directories = {}
+    scanned = {os.path.abspath(d) for d in test_dirs}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # 栈顶为下一个要产出的目录；子目录一经发现即提交扫描，按深度优先的顺序取结果
+        stack = [(d, pool.submit(scan_directory, d)) for d in reversed(test_dirs)]
+        while stack:
+            directory, future = stack.pop()
+            try:
+                dir_images, subdirs, mtime = future.result()
+            except OSError as e:
+                print(f"扫描目录失败: {directory} ({e})")
+                continue
+            directories[os.path.abspath(directory)] = mtime
+            if recursive:
+                children = []
+                for subdir in subdirs:
+                    if os.path.abspath(subdir) not in scanned:
+                        scanned.add(os.path.abspath(subdir))
+                        children.append((subdir, pool.submit(scan_directory, subdir)))
+                stack.extend(reversed(children))
+            for image in dir_images:
+                key = os.path.normcase(os.path.abspath(image[0]))
+                if key in seen:
+                    continue
+                seen.add(key)
+                images.append(image)
+                yield image
+
+    manifest.save(test_dirs, recursive, images, directories)
+
+def iter_images(test_dirs, recursive=False, workers=8, manifest_path=None, refresh=False):
+    """iter_image_entries 的简化版本，只产出图片路径"""
+    for path, _, _ in iter_image_entries(test_dirs, recursive, workers, manifest_path, refresh):
+        yield path
+
+def relative_image_path(path, test_dirs):
+    """
+    图片相对于扫描根目录（多个目录时为它们的公共上级目录）的路径，分隔符统一为 '/'，
+    用作断点续跑的图片标识：递归扫描时不同子目录下的同名图片不会混淆
+    """
+    roots = [os.path.abspath(d) for d in test_dirs or []]
+    try:
+        root = os.path.commonpath(roots) if roots else os.getcwd()
+        relative = os.path.relpath(os.path.abspath(path), root)
+    except ValueError:
+        # 不同盘符等无法求相对路径的情况
+        relative = os.path.abspath(path)
+    return relative.replace(os.sep, '/')
@@ -2,18 +2,43 @@ import requests
 import base64
 import json
 import os
-import glob
-from PIL import Image
+import mimetypes
 from datetime import datetime
 import time
+import argparse
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from batch_controller import AdaptiveBatchController
+from image_scanner import iter_images, relative_image_path
+from result_sink import (
+    JsonlResultSink, iter_results, load_processed_names, drop_failed_results,
+    convert_jsonl_to_json, convert_json_to_jsonl, traces_path_for
+)
+from tracing import Trace, stage_durations
 # === 配置参数 ===
 DEFAULT_BASE_URL = "http://localhost:5000"  # 默认服务器地址
 DEFAULT_CONF_THRESHOLD = 0.25  # 默认置信度阈值
 DEFAULT_BATCH_SIZE = 16  # 分批处理时的批次大小
+DEFAULT_MAX_BATCHES_IN_FLIGHT = 2  # 同时提交给服务器的批次数
+DEFAULT_PREFETCH_WORKERS = 4  # 读取并编码图片的预取线程数
+DEFAULT_PREFETCH_BATCHES = 2  # 在途批次之外提前编码好的批次数
+DEFAULT_ADAPTIVE_BATCHING = False  # 是否根据批次耗时与错误率自动调整批次大小与在途批次数
+DEFAULT_TARGET_BATCH_LATENCY = 30.0  # 自适应模式下的目标单批次耗时（秒）
+DEFAULT_MIN_BATCH_SIZE = 1  # 自适应模式下的最小批次大小
+DEFAULT_MAX_BATCH_SIZE = 64  # 自适应模式下的最大批次大小
+DEFAULT_MAX_CONCURRENCY = 4  # 自适应模式下的最大在途批次数
+DEFAULT_SCAN_WORKERS = 8  # 并行扫描子目录的线程数
+DEFAULT_UPLOAD_FORMAT = "json"  # 图片上传格式：json 为base64内嵌在JSON中，multipart 直接上传原始字节（需服务端支持）
 
-def configure_test_parameters(base_url=None, conf_threshold=None, batch_size=None):
+def configure_test_parameters(base_url=None, conf_threshold=None, batch_size=None,
+                              max_batches_in_flight=None, prefetch_workers=None, upload_format=None,
+                              adaptive_batching=None, target_batch_latency=None):
     """配置测试参数"""
     global DEFAULT_BASE_URL, DEFAULT_CONF_THRESHOLD, DEFAULT_BATCH_SIZE
+    global DEFAULT_MAX_BATCHES_IN_FLIGHT, DEFAULT_PREFETCH_WORKERS, DEFAULT_UPLOAD_FORMAT
+    global DEFAULT_ADAPTIVE_BATCHING, DEFAULT_TARGET_BATCH_LATENCY
     
     if base_url is not None:
         DEFAULT_BASE_URL = base_url
@@ -26,6 +51,59 @@ def configure_test_parameters(base_url=None, conf_threshold=None, batch_size=Non
     if batch_size is not None:
         DEFAULT_BATCH_SIZE = batch_size
         print(f"已设置批次大小为: {batch_size}")
+    
+    if max_batches_in_flight is not None:
+        DEFAULT_MAX_BATCHES_IN_FLIGHT = max_batches_in_flight
+        print(f"已设置在途批次数为: {max_batches_in_flight}")
+    
+    if prefetch_workers is not None:
+        DEFAULT_PREFETCH_WORKERS = prefetch_workers
+        print(f"已设置预取线程数为: {prefetch_workers}")
+    
+    if upload_format is not None:
+        if upload_format not in ("multipart", "json"):
+            raise ValueError(f"未知的上传格式: {upload_format}")
+        DEFAULT_UPLOAD_FORMAT = upload_format
+        print(f"已设置上传格式为: {upload_format}")
+    
+    if adaptive_batching is not None:
+        DEFAULT_ADAPTIVE_BATCHING = adaptive_batching
+        print(f"已{'启用' if adaptive_batching else '关闭'}自适应批次")
+    
+    if target_batch_latency is not None:
+        DEFAULT_TARGET_BATCH_LATENCY = target_batch_latency
+        print(f"已设置目标单批次耗时为: {target_batch_latency}秒")
+
+_thread_local = threading.local()
+# 批量请求的线路字节统计（请求体与响应体，不含HTTP头）
+_wire_stats = {"requests": 0, "bytes_sent": 0, "bytes_received": 0}
+_wire_stats_lock = threading.Lock()
+
+def get_http_session():
+    """获取当前线程的HTTP会话（复用keep-alive连接，requests.Session不保证跨线程安全）"""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _thread_local.session = session
+    return session
+
+def get_wire_stats():
+    """累计的批量请求数与收发字节数"""
+    with _wire_stats_lock:
+        return dict(_wire_stats)
+
+def reset_wire_stats():
+    """清零收发字节统计"""
+    with _wire_stats_lock:
+        for key in _wire_stats:
+            _wire_stats[key] = 0
+
+def _record_wire_bytes(response):
+    body = response.request.body or b""
+    with _wire_stats_lock:
+        _wire_stats["requests"] += 1
+        _wire_stats["bytes_sent"] += len(body)
+        _wire_stats["bytes_received"] += len(response.content)
 
 def image_to_base64(image_path):
     """将图片文件转换为base64编码"""
@@ -33,45 +111,58 @@ def image_to_base64(image_path):
         encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
     return encoded_string
 
-def find_test_images(test_dirs=None):
-    """自动查找测试图片"""
-    # 常见的图片扩展名
-    image_extensions = ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tiff', '*.gif']
-    
-    test_images = []
+def image_to_file_part(image_path):
+    """读取图片原始字节，构建multipart上传的文件字段 (文件名, 字节, MIME类型)"""
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    mime_type = mimetypes.guess_type(image_path)[0] or 'application/octet-stream'
+    return os.path.basename(image_path), image_bytes, mime_type
+
+def iter_test_images(test_dirs=None, recursive=False, manifest_path=None, refresh=False):
+    """
+    惰性查找测试图片，边扫描边产出图片路径，可以直接传给 test_complete_directory
     
+    每个目录只列一次（扩展名忽略大小写），recursive为True时并行扫描子目录；
+    指定manifest_path时缓存扫描结果，目录未变化时重复运行直接使用缓存，详见 image_scanner。
+    """
     # 如果没有指定测试目录，使用默认目录
     if test_dirs is None:
         test_dirs = ['./test_images', './']
-    
-    # 在指定目录查找
-    for test_dir in test_dirs:
-        if os.path.exists(test_dir):
-            for ext in image_extensions:
-                test_images.extend(glob.glob(os.path.join(test_dir, ext)))
-                test_images.extend(glob.glob(os.path.join(test_dir, ext.upper())))
-    
-    return test_images
+    return iter_images(test_dirs, recursive, DEFAULT_SCAN_WORKERS, manifest_path, refresh)
 
-def test_hybrid_inference(image_path, base_url="http://localhost:5000", conf_threshold=None):
+def find_test_images(test_dirs=None, recursive=False, manifest_path=None):
+    """自动查找测试图片"""
+    return list(iter_test_images(test_dirs, recursive, manifest_path))
+
+def test_hybrid_inference(image_path, base_url="http://localhost:5000", conf_threshold=None, upload_format=None):
     """测试YOLO + VLM串联推理"""
     try:
         # 使用配置的置信度阈值
         if conf_threshold is None:
             conf_threshold = DEFAULT_CONF_THRESHOLD
-            
-        # 转换图片为base64
-        image_base64 = image_to_base64(image_path)
+        if upload_format is None:
+            upload_format = DEFAULT_UPLOAD_FORMAT
         
-        # 准备请求数据
-        data = {
-            "image_base64": image_base64,
-            "image_name": os.path.basename(image_path),
-            "conf_threshold": conf_threshold
-        }
-        
-        # 发送请求
-        response = requests.post(f"{base_url}/hybrid_inference", json=data)
+        if upload_format == "multipart":
+            # 直接上传原始图片字节，省去base64编码与33%的体积膨胀
+            response = requests.post(
+                f"{base_url}/hybrid_inference",
+                files={"image": image_to_file_part(image_path)},
+                data={"image_name": os.path.basename(image_path), "conf_threshold": str(conf_threshold)}
+            )
+        else:
+            # 转换图片为base64
+            image_base64 = image_to_base64(image_path)
+            
+            # 准备请求数据
+            data = {
+                "image_base64": image_base64,
+                "image_name": os.path.basename(image_path),
+                "conf_threshold": conf_threshold
+            }
+            
+            # 发送请求
+            response = requests.post(f"{base_url}/hybrid_inference", json=data)
         
         print(f"YOLO + VLM 串联推理结果: {response.status_code}")
         result = response.json()
@@ -130,32 +221,125 @@ def test_hybrid_inference(image_path, base_url="http://localhost:5000", conf_thr
         print(f"串联推理测试失败: {e}")
         return None
 
-def test_hybrid_inference_batch(image_paths, base_url="http://localhost:5000", conf_threshold=None):
-    """测试YOLO + VLM串联批量推理"""
-    try:
-        # 使用配置的置信度阈值
-        if conf_threshold is None:
-            conf_threshold = DEFAULT_CONF_THRESHOLD
-            
-        # 准备批量数据
-        images = []
-        for image_path in image_paths:
-            image_base64 = image_to_base64(image_path)
-            images.append({
-                "image_base64": image_base64,
-                "image_name": os.path.basename(image_path),
-                "conf_threshold": conf_threshold
-            })
-        
-        data = {
-            "images": images
+def prepare_batch_payload(image_paths, conf_threshold=None, upload_format=None, image_dirs=None):
+    """
+    读取并编码一批图片，构建批量推理请求数据
+    
+    upload_format 为 multipart 时返回 {'files': [...], 'form': {...}}：每张图片是一个名为 images 的文件字段
+    （文件名即图片名），置信度阈值作为表单字段；为 json 时返回 {'images': [...]}，图片以base64内嵌。
+    
+    每张图片生成一条追踪（'traces'，不随请求发送），trace_id 随图片一起提交给服务器，
+    读取（image_read）与base64编码（base64_encode）的耗时记录为span。
+    
+    指定image_dirs（扫描的目录）时，'image_paths' 中记录每张图片相对这些目录的路径（不随请求发送），
+    收到结果后写入 'image_path'，作为断点续跑的图片标识。
+    """
+    # 使用配置的置信度阈值
+    if conf_threshold is None:
+        conf_threshold = DEFAULT_CONF_THRESHOLD
+    if upload_format is None:
+        upload_format = DEFAULT_UPLOAD_FORMAT
+    
+    traces = [Trace() for _ in image_paths]
+    image_keys = [relative_image_path(image_path, image_dirs) for image_path in image_paths] if image_dirs else None
+    if upload_format == "multipart":
+        files = []
+        for image_path, trace in zip(image_paths, traces):
+            with trace.span("image_read"):
+                files.append(("images", image_to_file_part(image_path)))
+        return {
+            "files": files,
+            "form": {"conf_threshold": str(conf_threshold), "trace_ids": [trace.trace_id for trace in traces]},
+            "traces": traces,
+            "image_paths": image_keys
         }
         
+    # 准备批量数据
+    images = []
+    for image_path, trace in zip(image_paths, traces):
+        with trace.span("image_read"):
+            with open(image_path, "rb") as image_file:
+                image_bytes = image_file.read()
+        with trace.span("base64_encode", bytes=len(image_bytes)):
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        images.append({
+            "image_base64": image_base64,
+            "image_name": os.path.basename(image_path),
+            "conf_threshold": conf_threshold,
+            "trace_id": trace.trace_id
+        })
+    
+    return {
+        "images": images,
+        "traces": traces,
+        "image_paths": image_keys
+    }
+
+def test_hybrid_inference_batch(image_paths, base_url="http://localhost:5000", conf_threshold=None, verbose=True,
+                                upload_format=None):
+    """测试YOLO + VLM串联批量推理"""
+    try:
+        data = prepare_batch_payload(image_paths, conf_threshold, upload_format)
+        return post_batch_payload(data, base_url, verbose)
+    except Exception as e:
+        print(f"串联批量推理测试失败: {e}")
+        return None
+
+def merge_client_traces(results, traces, request_start, request_end):
+    """
+    将客户端的追踪与服务端返回的追踪合并，每张图片的结果中只保留 'trace_id'，合并后的追踪单独返回
+    
+    客户端记录 http_request（请求往返）及其子span upload（发出请求到服务端开始处理，
+    依赖两端时钟一致，服务端时间早于发出时间时不记录），服务端的span挂在 http_request 下，
+    最后补上顶层span client。
+    
+    Returns:
+        list: 与results一一对应的追踪记录 {'trace_id', 'spans'}
+    """
+    merged = []
+    for result, trace in zip(results, traces):
+        server_trace = result.get('trace')
+        if server_trace and server_trace.get('trace_id'):
+            trace.trace_id = server_trace['trace_id']
+        http_span = trace.add_span("http_request", request_start, request_end)
+        server_start = min((span['start'] for span in (server_trace or {}).get('spans', [])), default=None)
+        if server_start is not None and request_start < server_start < request_end:
+            trace.add_span("upload", request_start, server_start, parent_id=http_span['span_id'])
+        trace.merge(server_trace, parent_id=http_span['span_id'])
+        trace.finish("client", image_name=result.get('image_name'))
+        result.pop('trace', None)
+        result['trace_id'] = trace.trace_id
+        merged.append(trace.to_dict())
+    return merged
+
+def post_batch_payload(data, base_url="http://localhost:5000", verbose=True):
+    """
+    发送批量推理请求（data 由 prepare_batch_payload 构建），verbose为True时打印每张图片的详细结果
+    
+    请求成功时，合并后的各图片追踪放在返回值的 'traces' 中，不写入单张图片的结果
+    """
+    try:
         # 发送请求
-        response = requests.post(f"{base_url}/hybrid_inference/batch", json=data)
+        request_start = time.time()
+        if "files" in data:
+            response = get_http_session().post(f"{base_url}/hybrid_inference/batch", files=data["files"], data=data["form"])
+        else:
+            response = get_http_session().post(f"{base_url}/hybrid_inference/batch", json={"images": data["images"]})
+        request_end = time.time()
+        _record_wire_bytes(response)
         
-        print(f"YOLO + VLM 串联批量推理结果: {response.status_code}")
         result = response.json()
+        if response.status_code == 200 and "traces" in data:
+            result['traces'] = merge_client_traces(result.get('results', []), data["traces"], request_start, request_end)
+        if response.status_code == 200 and data.get("image_paths"):
+            for res, image_path in zip(result.get('results', []), data["image_paths"]):
+                res['image_path'] = image_path
+        if not verbose:
+            if response.status_code != 200:
+                print(f"批量请求失败: {result}")
+            return result
+        
+        print(f"YOLO + VLM 串联批量推理结果: {response.status_code}")
         
         if response.status_code == 200:
             # 显示批量处理摘要
@@ -219,82 +403,265 @@ def test_hybrid_inference_batch(image_paths, base_url="http://localhost:5000", c
         print(f"串联批量推理测试失败: {e}")
         return None
 
-def test_complete_directory(image_paths, base_url="http://localhost:5000", conf_threshold=None, batch_size=None):
-    """测试完整目录的所有图片（分批处理）"""
+def add_dedup_result(tally, result):
+    """把一条结果的VLM近重复帧去重信息计入 tally（summarize_dedup 的累加器，便于在单次遍历中使用）"""
+    dedup = (result.get('vlm_analysis') or {}).get('dedup')
+    if not dedup:
+        return tally
+    tally['dedup_checked_count'] += 1
+    if dedup.get('hit'):
+        tally['dedup_hit_count'] += 1
+        tally['saved_vlm_seconds'] += dedup.get('saved_seconds', 0)
+    tally['dedup_rate'] = tally['dedup_hit_count'] / tally['dedup_checked_count']
+    return tally
+
+def summarize_dedup(results):
+    """统计一组结果中VLM近重复帧去重的命中率与节省的VLM耗时"""
+    tally = {'dedup_checked_count': 0, 'dedup_hit_count': 0, 'dedup_rate': 0, 'saved_vlm_seconds': 0.0}
+    for r in results:
+        add_dedup_result(tally, r)
+    return tally
+
+def summarize_stage_times(traces):
+    """按追踪记录统计各阶段耗时（count 为包含该阶段的图片数）"""
+    stage_times = {}
+    for trace in traces:
+        for stage, duration in stage_durations(trace).items():
+            stage_time = stage_times.setdefault(stage, {'count': 0, 'total': 0.0})
+            stage_time['count'] += 1
+            stage_time['total'] += duration
+    for stage_time in stage_times.values():
+        stage_time['avg'] = stage_time['total'] / stage_time['count']
+    return stage_times
+
+def summarize_results(results, traces=()):
+    """单次遍历统计一组结果（可以是流式读取的迭代器）的整体汇总，各阶段耗时按traces统计"""
+    summary = {
+        'total_count': 0,
+        'success_count': 0,
+        'open_count': 0,
+        'vlm_used_count': 0,
+        'boxes_returned_count': 0
+    }
+    dedup = summarize_dedup([])
+    for r in results:
+        summary['total_count'] += 1
+        summary['success_count'] += bool(r.get('success', False))
+        summary['open_count'] += r.get('final_decision') == '盖板缺失'
+        summary['vlm_used_count'] += bool(r.get('detection_summary', {}).get('used_vlm', False))
+        summary['boxes_returned_count'] += r.get('detection_summary', {}).get('boxes_returned', 0) > 0
+        add_dedup_result(dedup, r)
+    summary['dedup'] = dedup
+    summary['stage_times'] = summarize_stage_times(traces)
+    return summary
+
+def create_batch_controller(batch_size, max_batches_in_flight, adaptive, target_latency=None):
+    """创建批次控制器，未启用自适应时批次大小与在途批次数固定"""
+    if not adaptive:
+        return AdaptiveBatchController(
+            batch_size=batch_size, min_batch_size=batch_size, max_batch_size=batch_size,
+            concurrency=max_batches_in_flight, min_concurrency=max_batches_in_flight, max_concurrency=max_batches_in_flight
+        )
+    return AdaptiveBatchController(
+        batch_size=batch_size,
+        min_batch_size=DEFAULT_MIN_BATCH_SIZE,
+        max_batch_size=max(DEFAULT_MAX_BATCH_SIZE, batch_size),
+        concurrency=max_batches_in_flight,
+        max_concurrency=max(DEFAULT_MAX_CONCURRENCY, max_batches_in_flight),
+        target_latency=target_latency if target_latency is not None else DEFAULT_TARGET_BATCH_LATENCY
+    )
+
+def test_complete_directory(image_paths, base_url="http://localhost:5000", conf_threshold=None, batch_size=None,
+                            max_batches_in_flight=None, prefetch_workers=None, sink=None, upload_format=None,
+                            adaptive=None, target_latency=None, trace_sink=None, image_dirs=None):
+    """
+    测试完整目录的所有图片（分批流水线处理）
+    
+    图片读取与编码（按upload_format构建请求数据）在预取线程池中提前进行，同时最多有max_batches_in_flight个批次在服务器端处理，
+    批次结果按原始顺序汇总。max_batches_in_flight为1时等价于逐批串行处理。
+    
+    adaptive为True时，batch_size与max_batches_in_flight只作为初始值，后续批次的大小与在途批次数
+    由 AdaptiveBatchController 根据已完成批次的耗时（目标为target_latency秒）与错误率调整，
+    每个批次实际使用的大小与并发数记录在 batch_summaries 中。
+    
+    image_paths 可以是列表，也可以是惰性产出路径的可迭代对象（如 iter_test_images），
+    后者在扫描结束前就开始提交批次。
+    
+    传入sink（JsonlResultSink）时，每个批次完成后结果立即追加写入sink，不在内存中累积，
+    返回值中不包含 all_results，整体汇总按sink文件的全部内容（含续跑前已有的结果）统计。
+    
+    每张图片的结果中只保存 trace_id，追踪（各阶段span）写入trace_sink，未传入时只用于统计各阶段耗时。
+    
+    传入image_dirs（扫描的目录）时，每张图片的结果中记录相对路径 'image_path'，供断点续跑识别已处理的图片。
+    """
     if batch_size is None:
         batch_size = DEFAULT_BATCH_SIZE
     if conf_threshold is None:
         conf_threshold = DEFAULT_CONF_THRESHOLD
+    if max_batches_in_flight is None:
+        max_batches_in_flight = DEFAULT_MAX_BATCHES_IN_FLIGHT
+    if prefetch_workers is None:
+        prefetch_workers = DEFAULT_PREFETCH_WORKERS
+    if upload_format is None:
+        upload_format = DEFAULT_UPLOAD_FORMAT
+    if adaptive is None:
+        adaptive = DEFAULT_ADAPTIVE_BATCHING
     
-    total_images = len(image_paths)
-    total_batches = (total_images + batch_size - 1) // batch_size  # 向上取整
+    controller = create_batch_controller(batch_size, max_batches_in_flight, adaptive, target_latency)
+    # 惰性输入在扫描结束前不知道总数
+    total_images = len(image_paths) if hasattr(image_paths, '__len__') else None
+    image_iter = iter(image_paths)
     
     print(f"开始完整目录测试:")
-    print(f"  - 总图片数量: {total_images}")
+    print(f"  - 总图片数量: {total_images if total_images is not None else '边扫描边处理'}")
     print(f"  - 批次大小: {batch_size}")
-    print(f"  - 总批次数: {total_batches}")
+    if controller.fixed and total_images is not None:
+        print(f"  - 总批次数: {(total_images + batch_size - 1) // batch_size}")
+    else:
+        print(f"  - 自适应批次: 批次大小 {controller.min_batch_size}-{controller.max_batch_size}, "
+              f"在途批次数 {controller.min_concurrency}-{controller.max_concurrency}, 目标耗时 {controller.target_latency}秒")
+    print(f"  - 在途批次数: {max_batches_in_flight}")
+    print(f"  - 预取线程数: {prefetch_workers}")
+    print(f"  - 上传格式: {upload_format}")
     print()
     
     all_results = []
+    all_traces = []
     batch_summaries = []
+    # 只有一个批次在途时输出不会交错，保留逐图详细打印
+    verbose = controller.fixed and max_batches_in_flight == 1
     
-    for batch_idx in range(total_batches):
-        start_idx = batch_idx * batch_size
-        end_idx = min(start_idx + batch_size, total_images)
-        batch_images = image_paths[start_idx:end_idx]
-        
-        print(f"正在处理批次 {batch_idx + 1}/{total_batches} (图片 {start_idx + 1}-{end_idx})...")
-        
-        # 调用批量推理
-        batch_result = test_hybrid_inference_batch(batch_images, base_url, conf_threshold)
+    def run_batch(encode_future):
+        try:
+            data = encode_future.result()
+        except Exception as e:
+            print(f"串联批量推理测试失败: {e}")
+            return None, 0.0
+        controller.acquire()
+        try:
+            start_time = time.time()
+            result = post_batch_payload(data, base_url, verbose)
+            return result, time.time() - start_time
+        finally:
+            controller.release()
+    
+    def collect(batch_idx, start_idx, end_idx, batch_size, concurrency, batch_future):
+        batch_result, latency = batch_future.result()
+        success = bool(batch_result) and 'results' in batch_result
         
-        if batch_result:
-            all_results.extend(batch_result.get('results', []))
+        if success:
+            results = batch_result.get('results', [])
+            if sink is not None:
+                sink.write(results)
+            else:
+                all_results.extend(results)
+            traces = batch_result.pop('traces', [])
+            if trace_sink is not None:
+                trace_sink.write(traces)
+            else:
+                all_traces.extend(traces)
             batch_summary = batch_result.get('batch_summary', {})
+            error_rate = 1 - sum(1 for r in results if r.get('success')) / len(results) if results else 0.0
+            action = controller.update(latency, True, error_rate)
             batch_summaries.append({
                 'batch_index': batch_idx + 1,
                 'image_range': f"{start_idx + 1}-{end_idx}",
-                'summary': batch_summary
+                'batch_size': batch_size,
+                'concurrency': concurrency,
+                'latency': latency,
+                'adjustment': action,
+                'summary': batch_summary,
+                'dedup': summarize_dedup(results)
             })
-            print(f"批次 {batch_idx + 1} 完成: 成功 {batch_summary.get('success_count', 0)}/{batch_summary.get('total_count', 0)}")
+            print(f"批次 {batch_idx + 1} 完成: 成功 {batch_summary.get('success_count', 0)}/{batch_summary.get('total_count', 0)}, "
+                  f"耗时 {latency:.2f}秒")
         else:
+            action = controller.update(latency, False)
             print(f"批次 {batch_idx + 1} 失败!")
             batch_summaries.append({
                 'batch_index': batch_idx + 1,
                 'image_range': f"{start_idx + 1}-{end_idx}",
+                'batch_size': batch_size,
+                'concurrency': concurrency,
+                'latency': latency,
+                'adjustment': action,
                 'summary': {'error': '批次处理失败'}
             })
+        if action != "hold" and not controller.fixed:
+            print(f"  自适应调整({action}): 批次大小 -> {controller.batch_size}, 在途批次数 -> {controller.concurrency}")
+    
+    # 窗口内的批次：已提交编码或请求、尚未汇总，窗口大小限制了预取占用的内存
+    window = deque()
+    start_idx = 0
+    batch_idx = 0
+    with ThreadPoolExecutor(max_workers=prefetch_workers) as prefetch_pool, \
+            ThreadPoolExecutor(max_workers=controller.max_concurrency) as submit_pool:
+        while True:
+            if len(window) >= controller.concurrency + DEFAULT_PREFETCH_BATCHES:
+                collect(*window.popleft())
+                continue
+            
+            batch_images = list(itertools.islice(image_iter, controller.batch_size))
+            if not batch_images:
+                break
+            end_idx = start_idx + len(batch_images)
+            
+            print(f"提交批次 {batch_idx + 1} (图片 {start_idx + 1}-{end_idx}"
+                  f"{f'/{total_images}' if total_images is not None else ''})...")
+            encode_future = prefetch_pool.submit(prepare_batch_payload, batch_images, conf_threshold, upload_format, image_dirs)
+            batch_future = submit_pool.submit(run_batch, encode_future)
+            window.append((batch_idx, start_idx, end_idx, end_idx - start_idx, controller.concurrency, batch_future))
+            start_idx = end_idx
+            batch_idx += 1
         
-        print()
+        while window:
+            collect(*window.popleft())
+    
+    print()
+    total_images = start_idx
     
     # 汇总所有批次的结果
-    total_success = len([r for r in all_results if r.get('success', False)])
-    total_open_count = len([r for r in all_results if r.get('final_decision') == '盖板缺失'])
-    total_vlm_used = len([r for r in all_results if r.get('detection_summary', {}).get('used_vlm', False)])
-    total_boxes_returned = len([r for r in all_results if r.get('detection_summary', {}).get('boxes_returned', 0) > 0])
+    if trace_sink is not None:
+        trace_sink.sync()
+        traces = iter_results(trace_sink.path)
+    else:
+        traces = all_traces
+    if sink is not None:
+        sink.sync()
+        overall_summary = summarize_results(iter_results(sink.path), traces)
+    else:
+        overall_summary = summarize_results(all_results, traces)
+    dedup_summary = overall_summary['dedup']
     
     complete_result = {
         'test_type': 'complete_directory',
         'total_images': total_images,
-        'total_batches': total_batches,
+        'total_batches': len(batch_summaries),
         'batch_size': batch_size,
-        'overall_summary': {
-            'total_count': total_images,
-            'success_count': total_success,
-            'open_count': total_open_count,
-            'vlm_used_count': total_vlm_used,
-            'boxes_returned_count': total_boxes_returned
-        },
-        'batch_summaries': batch_summaries,
-        'all_results': all_results
+        'adaptive_batching': controller.stats() if not controller.fixed else None,
+        'overall_summary': overall_summary,
+        'batch_summaries': batch_summaries
     }
+    if trace_sink is not None:
+        complete_result['traces_path'] = trace_sink.path
+    if sink is not None:
+        complete_result['results_path'] = sink.path
+        sink.write_summary(complete_result)
+    else:
+        complete_result['all_results'] = all_results
     
     print("=== 完整目录测试汇总 ===")
-    print(f"总图片数量: {total_images}")
-    print(f"处理成功: {total_success}")
-    print(f"盖板缺失: {total_open_count}")
-    print(f"VLM使用次数: {total_vlm_used}")
-    print(f"返回目标框的图片: {total_boxes_returned}")
+    print(f"总图片数量: {overall_summary['total_count']}")
+    print(f"处理成功: {overall_summary['success_count']}")
+    print(f"盖板缺失: {overall_summary['open_count']}")
+    print(f"VLM使用次数: {overall_summary['vlm_used_count']}")
+    print(f"返回目标框的图片: {overall_summary['boxes_returned_count']}")
+    print(f"近重复帧复用: {dedup_summary['dedup_hit_count']}/{dedup_summary['dedup_checked_count']} "
+          f"(去重率 {dedup_summary['dedup_rate']:.2%}, 节省VLM耗时 {dedup_summary['saved_vlm_seconds']:.2f}秒)")
+    if overall_summary['stage_times']:
+        print("各阶段平均耗时:")
+        for stage, stage_time in sorted(overall_summary['stage_times'].items(), key=lambda item: -item[1]['avg']):
+            print(f"  - {stage}: {stage_time['avg']:.3f}秒 ({stage_time['count']}张)")
     print()
     
     return complete_result
@@ -314,11 +681,39 @@ def save_result_to_json(result, filename=None):
         print(f"保存JSON文件失败: {e}")
         return None
 
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="YOLO + VLM 完整目录测试")
+    parser.add_argument("--dirs", nargs="+", default=None, help="测试图片目录，可指定多个")
+    parser.add_argument("--recursive", action="store_true", help="递归扫描子目录")
+    parser.add_argument("--manifest", default=None, help="图片清单缓存文件，目录未变化时重复运行跳过扫描")
+    parser.add_argument("--refresh-manifest", action="store_true", help="忽略已有清单，重新扫描")
+    parser.add_argument("--output", default=None, help="结果文件路径，默认按时间戳生成")
+    parser.add_argument("--resume", default=None,
+                        help="从已有的JSONL结果文件续跑，跳过其中已处理的图片；旧版JSON结果先转换为同名.jsonl再续跑")
+    parser.add_argument("--format", choices=["jsonl", "json"], default="json",
+                        help="json: 结束时一次性写入旧版格式（默认）；jsonl: 逐图增量写入")
+    parser.add_argument("--export-json", action="store_true", help="jsonl格式结束后额外导出旧版JSON")
+    parser.add_argument("--upload-format", choices=["json", "multipart"], default=None,
+                        help="图片上传格式，multipart直接上传原始字节，默认使用 DEFAULT_UPLOAD_FORMAT")
+    parser.add_argument("--adaptive", action="store_true", help="根据批次耗时与错误率自动调整批次大小与在途批次数")
+    parser.add_argument("--target-latency", type=float, default=None, help="自适应模式下的目标单批次耗时（秒）")
+    parser.add_argument("--convert", default=None, help="只将指定的JSONL结果转换为旧版JSON后退出")
+    return parser.parse_args()
+
 def main():
     """主测试函数"""
+    args = parse_args()
+    if args.convert:
+        print(f"已转换为: {convert_jsonl_to_json(args.convert)}")
+        return
+    
     base_url = DEFAULT_BASE_URL
     conf_threshold = DEFAULT_CONF_THRESHOLD
     batch_size = DEFAULT_BATCH_SIZE
+    max_batches_in_flight = DEFAULT_MAX_BATCHES_IN_FLIGHT
+    prefetch_workers = DEFAULT_PREFETCH_WORKERS
+    upload_format = args.upload_format or DEFAULT_UPLOAD_FORMAT
     
     print("=== YOLO + VLM 完整目录测试服务 ===\n")
     
@@ -327,42 +722,79 @@ def main():
     print(f"  - 服务器地址: {base_url}")
     print(f"  - 置信度阈值: {conf_threshold}")
     print(f"  - 批次大小: {batch_size}")
+    print(f"  - 在途批次数: {max_batches_in_flight}")
+    print(f"  - 预取线程数: {prefetch_workers}")
+    print(f"  - 上传格式: {upload_format}")
     print("  - 提示: 可以通过调用 configure_test_parameters() 函数来修改这些参数")
     print()
     
     # 1. 查找测试图片
     print("1. 查找测试图片...")
     # 可以指定多个测试目录
-    test_dirs = ["/mnt/nas_data2/gjx_workspace/Datasets/MissingCoverPlate/20250715/不存在盖板缺失"]  # 可以根据需要修改这里的路径
-    test_images = find_test_images(test_dirs)
+    test_dirs = args.dirs or ["/mnt/nas_data2/gjx_workspace/Datasets/MissingCoverPlate/20250715/不存在盖板缺失"]  # 可以根据需要修改这里的路径
+    # 惰性扫描：第一批图片扫描到后即开始推理
+    test_images = iter_test_images(test_dirs, args.recursive, args.manifest, args.refresh_manifest)
+    first_image = next(test_images, None)
     
-    if not test_images:
+    if first_image is None:
         print("未找到测试图片，请确保有以下格式的图片文件：")
         print("  - jpg, jpeg, png, bmp, tiff, gif")
         print(f"  - 可以放在以下目录中: {', '.join(test_dirs)}")
         return
     
-    print(f"找到 {len(test_images)} 张测试图片:")
-    for img in test_images[:5]:  # 只显示前5张
-        print(f"  - {img}")
-    if len(test_images) > 5:
-        print(f"  - ... 还有 {len(test_images) - 5} 张图片")
+    print(f"已找到测试图片（边扫描边推理）: {first_image} ...")
     print()
+    test_images = itertools.chain([first_image], test_images)
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    sink = None
+    if args.format == "jsonl" or args.resume:
+        output_path = args.resume or args.output or f"../data_output/inference_result/complete_directory_test_{timestamp}.jsonl"
+        if args.resume:
+            if not args.resume.endswith('.jsonl'):
+                # 旧版JSON不能追加写入，先转换为JSONL
+                try:
+                    output_path = convert_json_to_jsonl(args.resume)
+                except FileExistsError as e:
+                    print(f"无法续跑 {args.resume}: {e}，请直接对该JSONL文件续跑")
+                    return
+                print(f"已将 {args.resume} 转换为 {output_path}，续跑结果写入该文件")
+            processed_names = load_processed_names(output_path)
+            # 失败的记录由重新推理的结果替换
+            dropped = drop_failed_results(output_path)
+            test_images = (img for img in test_images if relative_image_path(img, test_dirs) not in processed_names)
+            print(f"续跑: {output_path} 中已有 {len(processed_names)} 张图片的成功结果，将跳过这些图片；"
+                  f"{dropped} 条失败记录将重新推理")
+            print()
+        sink = JsonlResultSink(output_path)
+    else:
+        output_path = args.output or f"../data_output/inference_result/complete_directory_test_{timestamp}.json"
+    # 各阶段追踪单独写入 {结果文件名}.traces.jsonl，结果中只保存 trace_id
+    trace_sink = JsonlResultSink(traces_path_for(output_path))
     
     # 2. 开始完整目录测试
     print("2. 开始完整目录测试...")
     time_start = time.time()
-    result = test_complete_directory(test_images, base_url, conf_threshold, batch_size)
+    try:
+        result = test_complete_directory(test_images, base_url, conf_threshold, batch_size,
+                                         max_batches_in_flight, prefetch_workers, sink, upload_format,
+                                         args.adaptive or DEFAULT_ADAPTIVE_BATCHING, args.target_latency, trace_sink,
+                                         test_dirs)
+    finally:
+        if sink is not None:
+            sink.close()
+        trace_sink.close()
     time_end = time.time()
     print(f"完整目录测试完成，用时: {time_end - time_start:.2f}秒")
     
-    if result:
+    if sink is not None:
+        print(f"测试完成！结果已逐条写入: {sink.path}，追踪: {trace_sink.path}")
+        if args.export_json:
+            print(f"已导出旧版JSON: {convert_jsonl_to_json(sink.path)}")
+    elif result:
         # 3. 保存结果到JSON文件
         print("3. 保存结果到JSON文件...")
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"../data_output/inference_result/complete_directory_test_{timestamp}.json"
-        os.makedirs("../../data_output/inference_result", exist_ok=True)
-        json_filename = save_result_to_json(result, filename)
+        json_filename = save_result_to_json(result, output_path)
         
         if json_filename:
             print(f"测试完成！结果已保存到: {json_filename}")
@@ -373,4 +805,4 @@ def main():
 
 if __name__ == "__main__":
     # 运行完整目录测试
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,300 @@
+import io
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from aiohttp import web
+from PIL import Image
+from image_preprocess import image_data_to_bytes, estimate_vision_tokens
+
+POSITIVE_ANSWER = "存在盖板缺失"
+NEGATIVE_ANSWER = "不存在盖板缺失"
+
+class MockVLLMServer:
+    """
+    OpenAI兼容的vLLM模拟服务，用于在没有GPU的机器上测试客户端的吞吐与尾延迟
+
+    - 延迟模型：预填充耗时 = prefill_base + prefill_per_token * (视觉token数 + 文本token数)，
+      解码耗时 = decode_per_token * 生成token数，两者各乘以一个对数正态抖动系数
+    - 并发限制：同时生成的请求数不超过 max_concurrency，其余排队；排队数超过 max_queue 时返回429
+    - 故障注入：按 error_rate 返回 error_statuses 中的5xx，按 timeout_rate 挂起 hang_seconds 秒后才响应
+    - 固定输出：按图片内容哈希决定答案（同一张图片答案固定），positive_rate 为答案为"存在盖板缺失"的比例；
+      请求带 stop=["</answer>"] 时只输出答案，带 guided_choice 时输出其中的一项
+    """
+
+    def __init__(self, model_name="MissCover-Qwen2.5VL-7B", prefill_base=0.05, prefill_per_token=0.0002,
+                 decode_per_token=0.02, jitter=0.1, max_concurrency=16, max_queue=None, error_rate=0.0,
+                 error_statuses=(500, 503), timeout_rate=0.0, hang_seconds=120.0, positive_rate=0.5,
+                 patch_size=28, stream_chunk_tokens=4, seed=0):
+        """
+        Args:
+            model_name: /v1/models 返回的模型名
+            prefill_base: 预填充固定耗时（秒）
+            prefill_per_token: 每个输入token的预填充耗时（秒）
+            decode_per_token: 每个生成token的解码耗时（秒）
+            jitter: 对数正态抖动的sigma，0表示无抖动
+            max_concurrency: 同时生成的最大请求数
+            max_queue: 最大排队请求数，None表示不限制
+            error_rate: 返回5xx错误的比例
+            error_statuses: 注入错误时随机选择的状态码
+            timeout_rate: 挂起请求（模拟超时）的比例
+            hang_seconds: 挂起的时长（秒）
+            positive_rate: 答案为"存在盖板缺失"的图片比例
+            patch_size: 估算视觉token数的patch大小
+            stream_chunk_tokens: 流式输出时每个chunk包含的token数
+            seed: 随机种子
+        """
+        self.model_name = model_name
+        self.prefill_base = prefill_base
+        self.prefill_per_token = prefill_per_token
+        self.decode_per_token = decode_per_token
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.error_rate = error_rate
+        self.error_statuses = list(error_statuses)
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.positive_rate = positive_rate
+        self.patch_size = patch_size
+        self.stream_chunk_tokens = max(1, stream_chunk_tokens)
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._semaphore = None  # 在事件循环中创建
+        self._waiting = 0
+        self._running = 0
+        self._request_id = 0
+        self._started_at = time.time()
+        self._stats = {
+            "requests": 0,
+            "completed": 0,
+            "rejected": 0,
+            "injected_errors": 0,
+            "injected_timeouts": 0,
+            "aborted": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_latency": 0.0
+        }
+
+    def _jitter(self):
+        return self._random.lognormvariate(0, self.jitter) if self.jitter > 0 else 1.0
+
+    def _parse_messages(self, messages):
+        """统计文本token数（按字符数估算）与视觉token数，并取出图片字节"""
+        text_tokens = 0
+        vision_tokens = 0
+        images = []
+        for message in messages:
+            content = message.get("content", "")
+            if isinstance(content, str):
+                text_tokens += len(content)
+                continue
+            for part in content:
+                if part.get("type") == "text":
+                    text_tokens += len(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    image_bytes = image_data_to_bytes(part["image_url"]["url"])
+                    width, height = Image.open(io.BytesIO(image_bytes)).size  # 只读文件头
+                    vision_tokens += estimate_vision_tokens(width, height, self.patch_size)
+                    images.append(image_bytes)
+        return text_tokens, vision_tokens, images
+
+    def _answer_for(self, images):
+        """按图片内容哈希决定答案，同一张图片在不同请求中的答案相同"""
+        hasher = hashlib.sha256(str(self.seed).encode("utf-8"))
+        for image_bytes in images:
+            hasher.update(image_bytes)
+        value = int.from_bytes(hasher.digest()[:8], "big") / 2 ** 64
+        return POSITIVE_ANSWER if value < self.positive_rate else NEGATIVE_ANSWER
+
+    def _build_output(self, request_data, answer):
+        """
+        按请求参数构建输出文本
+
+        Returns:
+            tuple: (输出token列表, finish_reason)
+        """
+        guided_choice = request_data.get("guided_choice")
+        stop = request_data.get("stop") or []
+        if guided_choice:
+            text = next((choice for choice in guided_choice if answer in choice), guided_choice[0])
+        elif "</answer>" in stop:
+            text = f"<answer>{answer}</answer>" if request_data.get("include_stop_str_in_output") else f"<answer>{answer}"
+        else:
+            reason = "部分盖板缺失，沟槽裸露" if answer == POSITIVE_ANSWER else "盖板完整覆盖在电缆沟上"
+            text = f"<think>\n图片中可以看到电缆沟，{reason}。因此，根据当前任务分析，图片中{answer}。\n</think>\n<answer>{answer}</answer>"
+        tokens = list(text)  # 中文约每字一个token
+        max_tokens = request_data.get("max_tokens")
+        if max_tokens is not None and len(tokens) > max_tokens:
+            return tokens[:max_tokens], "length"
+        return tokens, "stop"
+
+    async def handle_models(self, request):
+        return web.json_response({
+            "object": "list",
+            "data": [{"id": self.model_name, "object": "model", "owned_by": "mock"}]
+        })
+
+    async def handle_stats(self, request):
+        """请求计数、排队/运行中的请求数与平均延迟"""
+        stats = dict(self._stats)
+        uptime = time.time() - self._started_at
+        stats.update({
+            "waiting": self._waiting,
+            "running": self._running,
+            "uptime": uptime,
+            "throughput": stats["completed"] / uptime if uptime > 0 else 0,
+            "avg_latency": stats["total_latency"] / stats["completed"] if stats["completed"] > 0 else None
+        })
+        return web.json_response(stats)
+
+    async def handle_chat_completions(self, request):
+        start_time = time.time()
+        self._stats["requests"] += 1
+        try:
+            request_data = await request.json()
+            text_tokens, vision_tokens, images = self._parse_messages(request_data.get("messages", []))
+        except Exception as e:
+            return web.json_response({"error": {"message": f"无效的请求: {str(e)}", "type": "BadRequestError"}}, status=400)
+
+        # 故障注入
+        roll = self._random.random()
+        if roll < self.error_rate:
+            self._stats["injected_errors"] += 1
+            status = self._random.choice(self.error_statuses)
+            return web.json_response({"error": {"message": "mock注入的服务端错误", "type": "InternalServerError"}}, status=status)
+        if roll < self.error_rate + self.timeout_rate:
+            self._stats["injected_timeouts"] += 1
+            await asyncio.sleep(self.hang_seconds)
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self.max_queue is not None and self._semaphore.locked() and self._waiting >= self.max_queue:
+            self._stats["rejected"] += 1
+            return web.json_response({"error": {"message": "mock服务排队已满", "type": "RateLimitError"}}, status=429)
+
+        prompt_tokens = text_tokens + vision_tokens
+        tokens, finish_reason = self._build_output(request_data, self._answer_for(images))
+        self._request_id += 1
+        completion_id = f"chatcmpl-mock-{self._request_id}"
+
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        self._running += 1
+        try:
+            await asyncio.sleep((self.prefill_base + self.prefill_per_token * prompt_tokens) * self._jitter())
+            if request_data.get("stream"):
+                response = await self._stream(request, completion_id, tokens, finish_reason)
+            else:
+                await asyncio.sleep(self.decode_per_token * len(tokens) * self._jitter())
+                response = web.json_response({
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": self.model_name,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(tokens)},
+                        "finish_reason": finish_reason
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(tokens),
+                        "total_tokens": prompt_tokens + len(tokens)
+                    }
+                })
+        except (ConnectionResetError, asyncio.CancelledError):
+            # 客户端提前断开（如流式拿到结论后），与vLLM一样取消剩余生成
+            self._stats["aborted"] += 1
+            raise
+        finally:
+            self._running -= 1
+            self._semaphore.release()
+
+        self._stats["completed"] += 1
+        self._stats["prompt_tokens"] += prompt_tokens
+        self._stats["completion_tokens"] += len(tokens)
+        self._stats["total_latency"] += time.time() - start_time
+        return response
+
+    async def _stream(self, request, completion_id, tokens, finish_reason):
+        """以SSE逐块输出，每块 stream_chunk_tokens 个token"""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        def chunk(delta, finish=None):
+            return ("data: " + json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": self.model_name,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]
+            }, ensure_ascii=False) + "\n\n").encode("utf-8")
+
+        await response.write(chunk({"role": "assistant"}))
+        for start in range(0, len(tokens), self.stream_chunk_tokens):
+            piece = tokens[start:start + self.stream_chunk_tokens]
+            await asyncio.sleep(self.decode_per_token * len(piece) * self._jitter())
+            await response.write(chunk({"content": "".join(piece)}))
+        await response.write(chunk({}, finish_reason))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def make_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/v1/models", self.handle_models)
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="OpenAI兼容的vLLM模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--model", default="MissCover-Qwen2.5VL-7B", help="模型名")
+    parser.add_argument("--prefill-base", type=float, default=0.05, help="预填充固定耗时（秒）")
+    parser.add_argument("--prefill-per-token", type=float, default=0.0002, help="每个输入token的预填充耗时（秒）")
+    parser.add_argument("--decode-per-token", type=float, default=0.02, help="每个生成token的解码耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.1, help="延迟的对数正态抖动sigma")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="同时生成的最大请求数")
+    parser.add_argument("--max-queue", type=int, default=None, help="最大排队请求数，超过时返回429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入5xx错误的比例")
+    parser.add_argument("--error-statuses", type=int, nargs="+", default=[500, 503], help="注入错误时使用的状态码")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="挂起请求的比例")
+    parser.add_argument("--hang-seconds", type=float, default=120.0, help="挂起时长（秒）")
+    parser.add_argument("--positive-rate", type=float, default=0.5, help="答案为存在盖板缺失的比例")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    server = MockVLLMServer(
+        model_name=args.model,
+        prefill_base=args.prefill_base,
+        prefill_per_token=args.prefill_per_token,
+        decode_per_token=args.decode_per_token,
+        jitter=args.jitter,
+        max_concurrency=args.max_concurrency,
+        max_queue=args.max_queue,
+        error_rate=args.error_rate,
+        error_statuses=args.error_statuses,
+        timeout_rate=args.timeout_rate,
+        hang_seconds=args.hang_seconds,
+        positive_rate=args.positive_rate,
+        seed=args.seed
+    )
+    print(f"=== vLLM模拟服务 ===")
+    print(f"地址: http://{args.host}:{args.port}/v1")
+    print(f"并发上限: {args.max_concurrency}, 错误注入: {args.error_rate:.1%}, 超时注入: {args.timeout_rate:.1%}")
+    web.run_app(server.make_app(), host=args.host, port=args.port, print=None)
+
+if __name__ == "__main__":
+    main()
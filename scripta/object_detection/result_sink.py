@@ -0,0 +1,200 @@
+import os
+import json
+import time
+
+def summary_path_for(jsonl_path):
+    """JSONL结果文件对应的汇总文件路径"""
+    base, _ = os.path.splitext(jsonl_path)
+    return f"{base}.summary.json"
+
+def traces_path_for(result_path):
+    """结果文件对应的追踪文件路径（每行一条追踪，结果中只保存 trace_id）"""
+    base, _ = os.path.splitext(result_path)
+    return f"{base}.traces.jsonl"
+
+class JsonlResultSink:
+    """
+    增量结果写入器
+
+    每张图片的结果完成后立即追加为JSONL中的一行，并定期fsync，进程崩溃时最多丢失最后一个fsync周期内的结果；
+    整体汇总在结束时写入同名的 .summary.json 文件。以追加模式打开，可用于断点续跑。
+    """
+
+    def __init__(self, path, fsync_interval=5.0):
+        """
+        Args:
+            path: JSONL文件路径
+            fsync_interval: 两次fsync之间的最长间隔（秒），0表示每次写入都fsync
+        """
+        self.path = path
+        self.fsync_interval = fsync_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._repair_tail()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._last_fsync = time.time()
+        self.written = 0
+
+    def _repair_tail(self):
+        """截掉上次崩溃时写了一半的最后一行，避免续写的内容与之粘连"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            # 向前找到最后一个完整行的结尾
+            position = size - 1
+            while position > 0:
+                step = min(65536, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                index = chunk.rfind(b'\n')
+                if index >= 0:
+                    f.truncate(position - step + index + 1)
+                    return
+                position -= step
+            f.truncate(0)
+
+    def write(self, results):
+        """追加一组结果"""
+        for result in results:
+            self._file.write(json.dumps(result, ensure_ascii=False))
+            self._file.write('\n')
+            self.written += 1
+        self._file.flush()
+        if time.time() - self._last_fsync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """将已写入的结果落盘"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.time()
+
+    def write_summary(self, summary):
+        """写入整体汇总（先写临时文件再替换，避免汇总文件损坏）"""
+        path = summary_path_for(self.path)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return path
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def iter_results(path):
+    """
+    逐条读取结果，兼容两种格式：
+        - JSONL：每行一条结果（忽略崩溃留下的不完整末行）
+        - 旧版 complete_directory_test_*.json：读取其中的 all_results
+    """
+    if path.endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            for result in json.load(f).get('all_results', []):
+                yield result
+
+def load_processed_names(path):
+    """
+    读取结果文件中已成功处理的图片标识，用于断点续跑（处理失败的图片会重新推理）
+
+    标识为结果中的 'image_path'（相对扫描根目录的路径），旧版结果没有该字段时使用 'image_name'。
+    """
+    if not os.path.exists(path):
+        return set()
+    return {result.get('image_path') or result.get('image_name') for result in iter_results(path) if result.get('success')}
+
+def drop_failed_results(path):
+    """
+    续跑前从JSONL结果中删除处理失败的记录，重新推理的结果追加后即替换原来的失败记录
+
+    先写入临时文件再替换原文件，中途崩溃不会损坏已有结果。
+
+    Returns:
+        int: 删除的记录数
+    """
+    if not os.path.exists(path):
+        return 0
+    dropped = 0
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        for result in iter_results(path):
+            if not result.get('success'):
+                dropped += 1
+                continue
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    if dropped:
+        os.replace(temp_path, path)
+    else:
+        os.remove(temp_path)
+    return dropped
+
+def load_complete_result(path):
+    """
+    读取完整结果，返回与 complete_directory_test_*.json 相同的结构
+
+    JSONL文件会合并同名 .summary.json 中的汇总信息（不存在时只包含 all_results）。
+    """
+    if not path.endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    complete_result = {}
+    summary_path = summary_path_for(path)
+    if os.path.exists(summary_path):
+        with open(summary_path, 'r', encoding='utf-8') as f:
+            complete_result.update(json.load(f))
+    complete_result['all_results'] = list(iter_results(path))
+    return complete_result
+
+def convert_json_to_jsonl(json_path, jsonl_path=None):
+    """
+    将旧版 complete_directory_test_*.json 转换为JSONL结果（汇总写入 .summary.json），用于续跑旧版结果
+
+    目标文件已存在时不覆盖，抛出 FileExistsError。
+    """
+    if jsonl_path is None:
+        jsonl_path = f"{os.path.splitext(json_path)[0]}.jsonl"
+    if os.path.exists(jsonl_path):
+        raise FileExistsError(f"JSONL结果文件已存在: {jsonl_path}")
+    with open(json_path, 'r', encoding='utf-8') as f:
+        complete_result = json.load(f)
+    with JsonlResultSink(jsonl_path) as sink:
+        sink.write(complete_result.pop('all_results', []))
+        sink.write_summary(complete_result)
+    return jsonl_path
+
+def convert_jsonl_to_json(jsonl_path, json_path=None):
+    """将JSONL结果及其汇总转换为旧版 complete_directory_test_*.json 格式"""
+    if json_path is None:
+        json_path = f"{os.path.splitext(jsonl_path)[0]}.json"
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(load_complete_result(jsonl_path), f, ensure_ascii=False, indent=2)
+    return json_path
@@ -3,8 +3,18 @@ import base64
 import json
 import os
 import glob
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
 from tqdm import tqdm
+from result_sink import iter_results
+
+FONT_PATH = "SimHei.ttf"  # 标签字体，找不到时使用PIL默认字体
+DEFAULT_DECISIONS = ("盖板缺失",)  # 默认只渲染这些最终决策的图片
+DEFAULT_QUALITY = 95  # 保存JPEG的质量
+DEFAULT_CHUNKSIZE = 64  # 每次分发给进程池的记录数
+
 class Colors:
     # Ultralytics color palette https://ultralytics.com/
     def __init__(self):
@@ -25,13 +35,21 @@ class Colors:
 
 colors = Colors()
 
-def draw_bboxes(boxes_info: list,  raw_img: Image.Image):
-    """在模型上画框 (PIL版本)"""
+@functools.lru_cache(maxsize=32)
+def load_font(size):
+    """按字号缓存字体，同一进程内每个字号只加载一次"""
+    try:
+        return ImageFont.truetype(FONT_PATH, size=size)
+    except OSError:
+        return ImageFont.load_default()
+
+def draw_bboxes(boxes_info: list,  raw_img: Image.Image, scale: float = 1.0):
+    """在模型上画框 (PIL版本)，scale 为图片相对于检测时原图的缩放比例（缩略图时小于1）"""
     if len(boxes_info) > 0:
         rw, rh = raw_img.size
         line_thickness = max(round(sum([rw, rh]) / 2 * 0.002), 3)
         draw = ImageDraw.Draw(raw_img)
-        font = ImageFont.truetype("SimHei.ttf", size=int(line_thickness * 10))
+        font = load_font(int(line_thickness * 10))
 
         for i, det in enumerate(boxes_info):
             if len(det) == 5:
@@ -40,7 +58,7 @@ def draw_bboxes(boxes_info: list,  raw_img: Image.Image):
             else:
                 x1, y1, x2, y2, conf, cls = det
             color = (255,0,0)
-            box = [x1, y1, x2, y2] 
+            box = [x1 * scale, y1 * scale, x2 * scale, y2 * scale]
             p1 = (int(box[0]), int(box[1]))
             p2 = (int(box[2]), int(box[3]))
             
@@ -75,17 +93,103 @@ def draw_bboxes(boxes_info: list,  raw_img: Image.Image):
 
     return raw_img
 
-if __name__ == "__main__":
-    info_path = "../data_output/inference_result/complete_directory_test_20250707_034445.json"
-    image_folder = "/mnt/nas_data2/chenjn_workspace/datasets/project/online_feedback_test/jiujiang/577_火焰烟雾_cropped"
-    save_folder = "outputs"
-    os.makedirs(save_folder, exist_ok=True)
-    with open(info_path, "r") as f:
-        info = json.load(f)["all_results"]
-    for item in tqdm(info):
-        image_path = os.path.join(image_folder, item["image_name"])
+def boxes_for_item(item):
+    """
+    结果记录中要画的框：优先使用 detection_boxes（判定为盖板缺失时返回的框），
+    没有时使用YOLO检测到的盖板缺失目标（如被VLM否定的图片），便于复核
+    """
+    boxes = item.get("detection_boxes") or (item.get("yolo_detection") or {}).get("open_objects") or []
+    return [[*box['bbox'], box['conf'], box['class_name']] for box in boxes]
+
+def render_item(image_name, boxes, image_folder, save_folder, max_size=None, quality=DEFAULT_QUALITY):
+    """
+    渲染单张图片并保存到save_folder（文件名不变）
+
+    max_size 不为None时输出最长边不超过max_size的缩略图：JPEG使用draft模式在解码时直接按1/2、1/4、1/8缩小，
+    不解码全分辨率图像，框坐标按实际缩放比例换算。
+
+    Returns:
+        dict: {'image_name', 'success', 'output_path' 或 'error'}
+    """
+    image_path = os.path.join(image_folder, image_name)
+    try:
         image = Image.open(image_path)
-        if item["final_decision"] == "盖板缺失":
-            boxes = [[*box['bbox'],box['conf'],box['class_name']] for box in item["detection_boxes"]]
-            draw_bboxes(boxes, image)
-            image.save(os.path.join(save_folder, os.path.basename(image_path)))
\ No newline at end of file
+        original_width = image.size[0]
+        if max_size is not None:
+            image.draft('RGB', (max_size, max_size))
+        image = image.convert('RGB')
+        if max_size is not None:
+            image.thumbnail((max_size, max_size))
+        draw_bboxes(boxes, image, image.size[0] / original_width)
+        output_path = os.path.join(save_folder, os.path.basename(image_path))
+        image.save(output_path, quality=quality)
+        return {"image_name": image_name, "success": True, "output_path": output_path}
+    except Exception as e:
+        return {"image_name": image_name, "success": False, "error": str(e)}
+
+def _render_task(args):
+    return render_item(*args)
+
+def render_results(results, image_folder, save_folder, decisions=DEFAULT_DECISIONS, workers=None, max_size=None,
+                   quality=DEFAULT_QUALITY, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    批量渲染推理结果
+
+    只有 final_decision 在decisions中的记录才会解码和画框（decisions为None时渲染全部），
+    渲染在进程池中并行进行，每个任务只携带图片名和框，不传递整条结果记录。
+
+    Args:
+        results: 结果记录的可迭代对象（如 result_sink.iter_results 流式读取的结果）
+        image_folder: 原图目录
+        save_folder: 输出目录
+        decisions: 需要渲染的最终决策
+        workers: 进程数，默认为CPU核数，为1时在当前进程串行渲染
+        max_size: 缩略图最长边，None表示输出原分辨率
+        quality: JPEG质量
+        chunksize: 每次分发给进程池的任务数
+
+    Returns:
+        dict: 渲染数量、失败数量与失败记录
+    """
+    os.makedirs(save_folder, exist_ok=True)
+    tasks = [
+        (item["image_name"], boxes_for_item(item), image_folder, save_folder, max_size, quality)
+        for item in results
+        if decisions is None or item.get("final_decision") in decisions
+    ]
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        outputs = [render_item(*task) for task in tqdm(tasks)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            outputs = list(tqdm(pool.map(_render_task, tasks, chunksize=chunksize), total=len(tasks)))
+    failures = [output for output in outputs if not output["success"]]
+    for failure in failures[:10]:
+        print(f"渲染失败: {failure['image_name']} ({failure['error']})")
+    return {
+        "rendered_count": len(outputs) - len(failures),
+        "failed_count": len(failures),
+        "failures": failures
+    }
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="在推理结果图片上画出检测框")
+    parser.add_argument("--results", default="../data_output/inference_result/complete_directory_test_20250707_034445.json",
+                        help="推理结果文件（.jsonl 或 .json）")
+    parser.add_argument("--images", default="/mnt/nas_data2/chenjn_workspace/datasets/project/online_feedback_test/jiujiang/577_火焰烟雾_cropped",
+                        help="原图目录")
+    parser.add_argument("--output", default="outputs", help="输出目录")
+    parser.add_argument("--decisions", nargs="+", default=list(DEFAULT_DECISIONS),
+                        help="需要渲染的最终决策，all 表示全部")
+    parser.add_argument("--workers", type=int, default=None, help="渲染进程数，默认为CPU核数")
+    parser.add_argument("--max-size", type=int, default=None, help="输出缩略图的最长边（JPEG使用draft模式解码）")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY, help="JPEG质量")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    decisions = None if "all" in args.decisions else tuple(args.decisions)
+    summary = render_results(iter_results(args.results), args.images, args.output, decisions, args.workers,
+                             args.max_size, args.quality)
+    print(f"渲染完成: {summary['rendered_count']} 张, 失败 {summary['failed_count']} 张")
\ No newline at end of file
@@ -3,6 +3,7 @@ import base64
 import json
 import os
 import glob
+import mimetypes
 from PIL import Image, ImageDraw, ImageFont
 
 class Colors:
@@ -80,6 +81,13 @@ def image_to_base64(image_path):
         encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
     return encoded_string
 
+def image_to_file_part(image_path):
+    """读取图片原始字节，构建multipart上传的文件字段 (文件名, 字节, MIME类型)"""
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    mime_type = mimetypes.guess_type(image_path)[0] or 'application/octet-stream'
+    return os.path.basename(image_path), image_bytes, mime_type
+
 def find_test_images():
     """自动查找测试图片"""
     # 常见的图片扩展名
@@ -97,20 +105,27 @@ def find_test_images():
     
     return test_images
 
-def test_hybrid_inference(image_path, base_url="http://localhost:5000"):
-    """测试YOLO + VLM串联推理"""
+def test_hybrid_inference(image_path, base_url="http://localhost:5000", upload_format="json"):
+    """测试YOLO + VLM串联推理，upload_format 为 multipart 时直接上传原始图片字节"""
     try:
-        # 转换图片为base64
-        image_base64 = image_to_base64(image_path)
-        
-        # 准备请求数据
-        data = {
-            "image_base64": image_base64,
-            "image_name": os.path.basename(image_path)
-        }
-        
-        # 发送请求
-        response = requests.post(f"{base_url}/hybrid_inference", json=data)
+        if upload_format == "multipart":
+            response = requests.post(
+                f"{base_url}/hybrid_inference",
+                files={"image": image_to_file_part(image_path)},
+                data={"image_name": os.path.basename(image_path)}
+            )
+        else:
+            # 转换图片为base64
+            image_base64 = image_to_base64(image_path)
+            
+            # 准备请求数据
+            data = {
+                "image_base64": image_base64,
+                "image_name": os.path.basename(image_path)
+            }
+            
+            # 发送请求
+            response = requests.post(f"{base_url}/hybrid_inference", json=data)
         
         print(f"YOLO + VLM 串联推理结果: {response.status_code}")
         result = response.json()
@@ -171,24 +186,28 @@ def test_hybrid_inference(image_path, base_url="http://localhost:5000"):
         print(f"串联推理测试失败: {e}")
         return None
 
-def test_hybrid_inference_batch(image_paths, base_url="http://localhost:5000"):
-    """测试YOLO + VLM串联批量推理"""
+def test_hybrid_inference_batch(image_paths, base_url="http://localhost:5000", upload_format="json"):
+    """测试YOLO + VLM串联批量推理，upload_format 为 multipart 时每张图片作为一个 images 文件字段上传"""
     try:
-        # 准备批量数据
-        images = []
-        for image_path in image_paths:
-            image_base64 = image_to_base64(image_path)
-            images.append({
-                "image_base64": image_base64,
-                "image_name": os.path.basename(image_path)
-            })
-        
-        data = {
-            "images": images
-        }
-        
-        # 发送请求
-        response = requests.post(f"{base_url}/hybrid_inference/batch", json=data)
+        if upload_format == "multipart":
+            files = [("images", image_to_file_part(image_path)) for image_path in image_paths]
+            response = requests.post(f"{base_url}/hybrid_inference/batch", files=files)
+        else:
+            # 准备批量数据
+            images = []
+            for image_path in image_paths:
+                image_base64 = image_to_base64(image_path)
+                images.append({
+                    "image_base64": image_base64,
+                    "image_name": os.path.basename(image_path)
+                })
+            
+            data = {
+                "images": images
+            }
+            
+            # 发送请求
+            response = requests.post(f"{base_url}/hybrid_inference/batch", json=data)
         
         print(f"YOLO + VLM 串联批量推理结果: {response.status_code}")
         result = response.json()
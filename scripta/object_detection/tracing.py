@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+import contextlib
+from collections import deque
+from result_sink import iter_results
+
+# 默认追踪参数（本模块也被独立客户端导入，不依赖 config.json；服务端按 config 中的 tracing 配置传入）
+SERVICE_NAME = "cnas-hybrid"  # 导出OpenTelemetry JSON时的服务名
+HISTOGRAM_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]  # 各阶段耗时直方图的桶上界（秒）
+TRACE_BUFFER_SIZE = 1000  # 服务端保留的最近追踪数
+
+TRACE_HEADER = "traceparent"  # W3C Trace Context 请求头，vLLM开启OTLP追踪时会沿用其中的trace_id
+
+def new_trace_id():
+    """生成32位十六进制的trace_id"""
+    return uuid.uuid4().hex
+
+def new_span_id():
+    """生成16位十六进制的span_id"""
+    return uuid.uuid4().hex[:16]
+
+def format_traceparent(trace_id, span_id):
+    """构建 traceparent 请求头的值"""
+    return f"00-{trace_id}-{span_id}-01"
+
+def parse_traceparent(value):
+    """
+    解析 traceparent 请求头
+
+    Returns:
+        tuple: (trace_id, span_id)，格式不正确时为 (None, None)
+    """
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    return parts[1], parts[2]
+
+class Trace:
+    """
+    单张图片的追踪记录
+
+    每个阶段是一个span：{'name', 'span_id', 'parent_id', 'start', 'end', 'duration', 'attributes'}，
+    start/end 为Unix时间戳（秒）。客户端、服务端与VLM各自记录span，通过相同的trace_id串联，
+    to_dict() 的结果随推理结果一起返回，另一端用 merge() 合并。
+
+    每一端有一个顶层span（span_id 为 root_span_id，处理结束时用 finish() 记录），
+    未指定parent_id的span都是它的子span。
+    """
+
+    def __init__(self, trace_id=None, parent_id=None):
+        """
+        Args:
+            trace_id: 沿用上游传入的trace_id，None时生成新的
+            parent_id: 上游span的span_id，作为本端顶层span的父span
+        """
+        self.trace_id = trace_id or new_trace_id()
+        self.parent_id = parent_id
+        self.root_span_id = new_span_id()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, end, parent_id=None, **attributes):
+        """记录一个已经结束的阶段，返回span"""
+        span = {
+            "name": name,
+            "span_id": new_span_id(),
+            "parent_id": parent_id if parent_id is not None else self.root_span_id,
+            "start": start,
+            "end": end,
+            "duration": end - start,
+            "attributes": attributes
+        }
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name, parent_id=None, **attributes):
+        """
+        记录 with 块的耗时，产出span（span['span_id'] 可作为子span的parent_id，
+        span['attributes'] 可在块内补充属性）。块内抛出异常时记录 error 属性。
+        """
+        span = {
+            "name": name,
+            "span_id": new_span_id(),
+            "parent_id": parent_id if parent_id is not None else self.root_span_id,
+            "start": time.time(),
+            "attributes": attributes
+        }
+        try:
+            yield span
+        except BaseException as e:
+            span["attributes"]["error"] = repr(e)
+            raise
+        finally:
+            span["end"] = time.time()
+            span["duration"] = span["end"] - span["start"]
+            with self._lock:
+                self.spans.append(span)
+
+    def finish(self, name, start=None, end=None, **attributes):
+        """
+        记录本端的顶层span，start 为None时取已记录span中最早的开始时间，end 为None时取当前时间
+        """
+        end = end if end is not None else time.time()
+        with self._lock:
+            if start is None:
+                start = min((span["start"] for span in self.spans), default=end)
+            span = {
+                "name": name,
+                "span_id": self.root_span_id,
+                "parent_id": self.parent_id,
+                "start": start,
+                "end": end,
+                "duration": end - start,
+                "attributes": attributes
+            }
+            self.spans.append(span)
+        return span
+
+    def merge(self, trace_dict, parent_id=None):
+        """
+        合并另一端返回的span（如服务端结果中的 trace），parent_id 不为None时
+        作为其中顶层span（父span不在该记录中的span）的父span
+        """
+        if not trace_dict:
+            return
+        spans = trace_dict.get("spans", [])
+        own_ids = {span["span_id"] for span in spans}
+        with self._lock:
+            for span in spans:
+                span = dict(span)
+                if parent_id is not None and span.get("parent_id") not in own_ids:
+                    span["parent_id"] = parent_id
+                self.spans.append(span)
+
+    def to_dict(self):
+        """按开始时间排序的span列表"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        return {"trace_id": self.trace_id, "spans": spans}
+
+def stage_durations(trace_dict):
+    """按阶段名汇总一条追踪的耗时（同名span累加，如多次重试的VLM请求）"""
+    durations = {}
+    for span in (trace_dict or {}).get("spans", []):
+        durations[span["name"]] = durations.get(span["name"], 0.0) + span["duration"]
+    return durations
+
+class StageMetrics:
+    """
+    各阶段耗时的直方图统计，可导出为Prometheus文本格式
+
+    每个阶段一个直方图，指标名为 {namespace}_stage_duration_seconds，阶段名作为 stage 标签。
+    """
+
+    def __init__(self, buckets=None, namespace="cnas"):
+        self.buckets = sorted(buckets if buckets is not None else HISTOGRAM_BUCKETS)
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._histograms = {}  # 阶段名 -> {'buckets': [...], 'count', 'sum'}
+
+    def observe(self, stage, duration):
+        """记录一个阶段的耗时（秒）"""
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+                self._histograms[stage] = histogram
+            for i, upper in enumerate(self.buckets):
+                if duration <= upper:
+                    histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += duration
+
+    def observe_trace(self, trace_dict):
+        """记录一条追踪中的所有span"""
+        for span in (trace_dict or {}).get("spans", []):
+            self.observe(span["name"], span["duration"])
+
+    def stats(self):
+        """各阶段的次数、总耗时与平均耗时"""
+        with self._lock:
+            return {
+                stage: {
+                    "count": histogram["count"],
+                    "total": histogram["sum"],
+                    "avg": histogram["sum"] / histogram["count"] if histogram["count"] else 0.0
+                }
+                for stage, histogram in self._histograms.items()
+            }
+
+    def to_prometheus(self):
+        """导出为Prometheus文本格式（text/plain; version=0.0.4）"""
+        name = f"{self.namespace}_stage_duration_seconds"
+        lines = [f"# HELP {name} 各处理阶段的耗时（秒）", f"# TYPE {name} histogram"]
+        with self._lock:
+            for stage in sorted(self._histograms):
+                histogram = self._histograms[stage]
+                for upper, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{upper}"}} {count}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+class TraceBuffer:
+    """保留最近的若干条追踪，供服务端按需导出"""
+
+    def __init__(self, max_size=TRACE_BUFFER_SIZE):
+        self._traces = deque(maxlen=max_size)
+        self._lock = threading.Lock()
+
+    def add(self, trace_dict):
+        with self._lock:
+            self._traces.append(trace_dict)
+
+    def snapshot(self, trace_id=None):
+        """返回全部追踪，指定trace_id时只返回匹配的追踪"""
+        with self._lock:
+            traces = list(self._traces)
+        if trace_id is not None:
+            traces = [t for t in traces if t["trace_id"] == trace_id]
+        return traces
+
+def _otel_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def to_otel_json(traces, service_name=None):
+    """
+    将追踪转换为OpenTelemetry OTLP/JSON格式（ExportTraceServiceRequest），
+    可直接POST到OTLP HTTP接收端的 /v1/traces
+    """
+    spans = []
+    for trace_dict in traces:
+        for span in trace_dict.get("spans", []):
+            otel_span = {
+                "traceId": trace_dict["trace_id"],
+                "spanId": span["span_id"],
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(int(span["start"] * 1e9)),
+                "endTimeUnixNano": str(int(span["end"] * 1e9)),
+                "attributes": [{"key": key, "value": _otel_value(value)}
+                               for key, value in span.get("attributes", {}).items() if value is not None]
+            }
+            if span.get("parent_id"):
+                otel_span["parentSpanId"] = span["parent_id"]
+            spans.append(otel_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name or SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "cnas.tracing"}, "spans": spans}]
+        }]
+    }
+
+def iter_result_traces(records):
+    """
+    取出追踪记录：既可以是客户端导出的追踪文件（每行即一条追踪），
+    也可以是旧版把追踪内嵌在 'trace' 中的推理结果，没有追踪的记录跳过
+    """
+    for record in records:
+        if "spans" in record:
+            yield record
+        elif record.get("trace"):
+            yield record["trace"]
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="将客户端导出的追踪导出为Prometheus或OpenTelemetry JSON")
+    parser.add_argument("results", help="追踪文件（.traces.jsonl），或内嵌追踪的旧版推理结果文件（.jsonl 或 .json）")
+    parser.add_argument("--format", choices=["summary", "prometheus", "otel"], default="summary",
+                        help="summary 打印各阶段耗时汇总，prometheus 输出直方图文本，otel 输出OTLP/JSON")
+    parser.add_argument("--service-name", default=SERVICE_NAME, help="otel格式中的服务名")
+    parser.add_argument("--output", default=None, help="输出文件路径，默认打印到标准输出")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    traces = list(iter_result_traces(iter_results(args.results)))
+    if not traces:
+        print(f"{args.results} 中没有追踪记录")
+        return
+    if args.format == "otel":
+        content = json.dumps(to_otel_json(traces, args.service_name), ensure_ascii=False)
+    else:
+        metrics = StageMetrics()
+        for trace_dict in traces:
+            metrics.observe_trace(trace_dict)
+        if args.format == "prometheus":
+            content = metrics.to_prometheus()
+        else:
+            stats = metrics.stats()
+            lines = [f"追踪数: {len(traces)}", f"{'阶段':<20}{'次数':>8}{'总耗时(秒)':>14}{'平均(秒)':>12}"]
+            for stage, values in sorted(stats.items(), key=lambda item: -item[1]["total"]):
+                lines.append(f"{stage:<20}{values['count']:>8}{values['total']:>14.3f}{values['avg']:>12.4f}")
+            content = "\n".join(lines)
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(content)
+        print(f"已导出到: {args.output}")
+    else:
+        print(content)
+
+if __name__ == "__main__":
+    main()
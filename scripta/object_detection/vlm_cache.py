@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from image_preprocess import image_data_to_bytes
+
+def make_cache_key(image_data, prompt, model, params=None):
+    """
+    计算VLM结果缓存键
+
+    键由解码后的图像字节、提示词、模型名以及采样参数共同决定，
+    同一张图片无论以原始字节、base64还是带数据URL前缀的base64传入都得到相同的键。
+    """
+    hasher = hashlib.sha256()
+    hasher.update(hashlib.sha256(image_data_to_bytes(image_data)).digest())
+    hasher.update(prompt.encode('utf-8'))
+    hasher.update(model.encode('utf-8'))
+    hasher.update(json.dumps(params or {}, sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
+
+class VLMResultCache:
+    """
+    VLM推理结果缓存
+
+    两级缓存：内存LRU + 可选的SQLite磁盘缓存，两级都支持条目数上限与TTL过期。
+    只缓存推理成功的结果，线程安全。
+    """
+
+    def __init__(self, memory_max_entries=4096, ttl=None, disk_path=None, disk_max_entries=100000):
+        self.memory_max_entries = memory_max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.disk_max_entries = disk_max_entries
+        self._memory = OrderedDict()  # key -> (写入时间, 结果)
+        self._lock = threading.Lock()
+        self._db = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "evictions": 0,
+            "expired": 0
+        }
+        if disk_path:
+            self._open_disk()
+
+    @classmethod
+    def from_config(cls, cache_config):
+        """根据 vlm.cache 配置块创建缓存"""
+        return cls(
+            memory_max_entries=cache_config.get("memory_max_entries", 4096),
+            ttl=cache_config.get("ttl", None),
+            disk_path=cache_config.get("disk_path", None),
+            disk_max_entries=cache_config.get("disk_max_entries", 100000)
+        )
+
+    def _open_disk(self):
+        """打开（必要时创建）SQLite磁盘缓存"""
+        directory = os.path.dirname(self.disk_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.disk_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS vlm_cache ("
+            "key TEXT PRIMARY KEY, created_at REAL NOT NULL, accessed_at REAL NOT NULL, result TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_vlm_cache_accessed_at ON vlm_cache(accessed_at)")
+        self._db.commit()
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def _memory_put(self, key, created_at, result):
+        self._memory[key] = (created_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get(self, key):
+        """查询缓存，未命中返回None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, result = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self._stats["hits"] += 1
+                    self._stats["memory_hits"] += 1
+                    return dict(result)
+                del self._memory[key]
+                self._stats["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute("SELECT created_at, result FROM vlm_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    created_at, result_json = row
+                    if not self._expired(created_at, now):
+                        self._db.execute("UPDATE vlm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                        result = json.loads(result_json)
+                        self._memory_put(key, created_at, result)
+                        self._stats["hits"] += 1
+                        self._stats["disk_hits"] += 1
+                        return dict(result)
+                    self._db.execute("DELETE FROM vlm_cache WHERE key = ?", (key,))
+                    self._db.commit()
+                    self._stats["expired"] += 1
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key, result):
+        """写入缓存，推理失败的结果不缓存"""
+        if not result.get("success"):
+            return
+        now = time.time()
+        with self._lock:
+            self._memory_put(key, now, dict(result))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO vlm_cache (key, created_at, accessed_at, result) VALUES (?, ?, ?, ?)",
+                    (key, now, now, json.dumps(result, ensure_ascii=False))
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    def _evict_disk(self, now):
+        """淘汰磁盘缓存中过期及超出上限（按最近访问时间）的条目"""
+        if self.ttl is not None:
+            cursor = self._db.execute("DELETE FROM vlm_cache WHERE created_at < ?", (now - self.ttl,))
+            self._stats["expired"] += cursor.rowcount
+        count = self._db.execute("SELECT COUNT(*) FROM vlm_cache").fetchone()[0]
+        if count > self.disk_max_entries:
+            cursor = self._db.execute(
+                "DELETE FROM vlm_cache WHERE key IN (SELECT key FROM vlm_cache ORDER BY accessed_at LIMIT ?)",
+                (count - self.disk_max_entries,)
+            )
+            self._stats["evictions"] += cursor.rowcount
+
+    def clear(self):
+        """清空两级缓存"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM vlm_cache")
+                self._db.commit()
+
+    def stats(self):
+        """获取命中/未命中等计数"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            if self._db is not None:
+                stats["disk_entries"] = self._db.execute("SELECT COUNT(*) FROM vlm_cache").fetchone()[0]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0
+        return stats
@@ -0,0 +1,174 @@
+import json
+import asyncio
+import atexit
+import contextlib
+import threading
+import aiohttp
+from config_loader import config
+from vlm_retry import parse_retry_after
+
+# 获取VLM配置
+vlm_config = config.get_vlm_config()
+
+# 连接池配置
+POOL_SIZE = vlm_config.get("pool_size", 32)  # 连接池最大连接数
+KEEPALIVE_TIMEOUT = vlm_config.get("keepalive_timeout", 60)  # 空闲长连接保持时间（秒）
+
+class VLMClient:
+    """
+    共享的VLM HTTP客户端
+
+    内部在一个后台线程中运行独立的事件循环，并在该循环上持有唯一的 aiohttp.ClientSession，
+    所有请求（同步或异步调用）都复用这一个带 keep-alive 的连接池。
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._lock = threading.Lock()
+        # 线路字节统计（请求体与响应体，不含HTTP头），只在后台事件循环中更新
+        self._wire_stats = {"requests": 0, "bytes_sent": 0, "bytes_received": 0}
+
+    @property
+    def loop(self):
+        """获取后台事件循环，首次访问时启动后台线程"""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=loop.run_forever, name="vlm-client-loop", daemon=True)
+                    self._thread.start()
+                    self._loop = loop
+        return self._loop
+
+    async def get_session(self):
+        """获取共享会话（只能在后台事件循环中调用）"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _encode_payload(self, payload):
+        """序列化请求体并计入发送字节数"""
+        body = json.dumps(payload).encode("utf-8")
+        self._wire_stats["requests"] += 1
+        self._wire_stats["bytes_sent"] += len(body)
+        return body
+
+    @staticmethod
+    def _headers(headers):
+        return dict(headers or {}, **{"Content-Type": "application/json"})
+
+    async def post_json(self, url, payload, timeout, headers=None):
+        """
+        发送JSON POST请求，headers 为额外的请求头（如追踪用的 traceparent）
+
+        Returns:
+            tuple: (状态码, 响应JSON)，非200响应为 (状态码, {'retry_after': Retry-After秒数或None})
+        """
+        session = await self.get_session()
+        async with session.post(url, data=self._encode_payload(payload), headers=self._headers(headers),
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            body = await response.read()  # 非200时也要读完响应体，连接才能放回连接池
+            self._wire_stats["bytes_received"] += len(body)
+            if response.status != 200:
+                return response.status, {"retry_after": parse_retry_after(response.headers.get("Retry-After"))}
+            return response.status, json.loads(body)
+
+    async def get_status(self, url, timeout):
+        """发送GET请求并返回状态码（用于健康检查）"""
+        session = await self.get_session()
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            await response.read()
+            return response.status
+
+    @contextlib.asynccontextmanager
+    async def stream_json(self, url, payload, timeout, headers=None):
+        """
+        发送JSON POST请求并以SSE（Server-Sent Events）方式读取响应
+
+        用法：
+            async with client.stream_json(url, payload, timeout) as (status, events):
+                async for event in events:
+                    ...
+
+        提前退出 async with 时未读完的响应会被丢弃、连接关闭，服务端随之取消生成。
+        非200响应不读取事件流，第二项为 {'retry_after': Retry-After秒数或None}。
+        """
+        session = await self.get_session()
+        async with session.post(url, data=self._encode_payload(payload), headers=self._headers(headers),
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status != 200:
+                self._wire_stats["bytes_received"] += len(await response.read())
+                yield response.status, {"retry_after": parse_retry_after(response.headers.get("Retry-After"))}
+            else:
+                yield response.status, self._iter_sse(response)
+
+    async def _iter_sse(self, response):
+        """逐行解析SSE响应中的 data 事件，遇到 [DONE] 结束"""
+        async for line in response.content:
+            self._wire_stats["bytes_received"] += len(line)
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data = line[len(b"data:"):].strip()
+            if data == b"[DONE]":
+                break
+            yield json.loads(data)
+
+    def wire_stats(self):
+        """累计的请求数与收发字节数"""
+        return dict(self._wire_stats)
+
+    def reset_wire_stats(self):
+        """清零收发字节统计"""
+        self._wire_stats = {"requests": 0, "bytes_sent": 0, "bytes_received": 0}
+
+    def run_sync(self, coro):
+        """在后台事件循环中执行协程并阻塞等待结果（供同步接口使用）"""
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is not None and running_loop is self._loop:
+            coro.close()
+            raise RuntimeError("不能在VLM客户端事件循环中调用同步接口，请使用对应的async接口")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def run_async(self, coro):
+        """在后台事件循环中执行协程，可从任意事件循环中await"""
+        if asyncio.get_running_loop() is self._loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def _shutdown(self):
+        """取消后台任务（如健康检查）并关闭会话"""
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def close(self):
+        """关闭连接池并停止后台事件循环"""
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+        self._session = None
+
+# 全局VLM客户端实例
+vlm_client = VLMClient()
+atexit.register(vlm_client.close)
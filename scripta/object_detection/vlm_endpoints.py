@@ -0,0 +1,214 @@
+import time
+import asyncio
+import contextlib
+import aiohttp
+from vlm_retry import CircuitBreaker, CircuitOpenError
+
+TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)  # 连接失败、超时、读取响应中断等传输错误
+
+class Endpoint:
+    """单个vLLM副本的状态与计数"""
+
+    def __init__(self, base_url, breaker):
+        self.base_url = base_url.rstrip('/')
+        self.breaker = breaker
+        self.outstanding = 0  # 在途请求数
+        self.ewma_latency = None  # 请求延迟的指数加权移动平均（秒）
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self.last_error = None
+
+    @property
+    def healthy(self):
+        return self.breaker.state == "closed"
+
+    def stats(self, uptime):
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "circuit_breaker": self.breaker.stats(),
+            "ewma_latency": self.ewma_latency,
+            "avg_latency": self.total_latency / self.successes if self.successes > 0 else None,
+            "throughput": self.successes / uptime if uptime > 0 else 0,
+            "last_error": self.last_error
+        }
+
+class EndpointPool:
+    """
+    多副本vLLM负载均衡
+
+    按最少在途请求（least_outstanding）或延迟EWMA（latency_ewma）选择副本。
+    每个副本有独立的熔断器：连续失败达到阈值时熔断摘除，后台定期请求各副本的 /models 接口做健康检查，
+    检查通过后进入半开状态放行探测请求，探测成功即重新加入；所有副本都熔断时快速失败。
+    所有方法都应在VLM客户端的事件循环中调用。
+    """
+
+    def __init__(self, client, api_bases, strategy="least_outstanding", breaker_config=None,
+                 health_check_interval=10, health_check_timeout=5, ewma_alpha=0.3):
+        if not api_bases:
+            raise ValueError("至少需要配置一个VLM服务地址")
+        if strategy not in ("least_outstanding", "latency_ewma"):
+            raise ValueError(f"未知的负载均衡策略: {strategy}")
+        self.client = client
+        self.endpoints = [Endpoint(base_url, CircuitBreaker.from_config(breaker_config or {})) for base_url in api_bases]
+        self.strategy = strategy
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.ewma_alpha = ewma_alpha
+        self._health_task = None
+        self._started_at = time.time()
+        self.rejected = 0  # 所有副本都熔断时被快速拒绝的请求数
+
+    @classmethod
+    def from_config(cls, client, vlm_config):
+        """根据 vlm 配置块创建负载均衡器，api_bases 未配置时使用 api_base，熔断参数取自 vlm.circuit_breaker"""
+        api_bases = vlm_config.get("api_bases") or [vlm_config.get("api_base", "http://localhost:9999/v1")]
+        lb_config = vlm_config.get("load_balancer", {})
+        return cls(
+            client,
+            api_bases,
+            strategy=lb_config.get("strategy", "least_outstanding"),
+            breaker_config=vlm_config.get("circuit_breaker", {}),
+            health_check_interval=lb_config.get("health_check_interval", 10),
+            health_check_timeout=lb_config.get("health_check_timeout", 5),
+            ewma_alpha=lb_config.get("ewma_alpha", 0.3)
+        )
+
+    def _score(self, endpoint):
+        if self.strategy == "latency_ewma":
+            # 没有延迟数据的副本优先，让新副本尽快积累统计
+            latency = endpoint.ewma_latency if endpoint.ewma_latency is not None else 0.0
+            return (latency * (endpoint.outstanding + 1), endpoint.outstanding)
+        return (endpoint.outstanding, endpoint.ewma_latency or 0.0)
+
+    def acquire(self):
+        """
+        选择一个副本并增加其在途计数
+
+        Raises:
+            CircuitOpenError: 所有副本的熔断器都处于打开状态
+        """
+        self._ensure_health_checker()
+        candidates = [e for e in self.endpoints if e.breaker.available()]
+        if not candidates:
+            self.rejected += 1
+            for endpoint in self.endpoints:
+                endpoint.breaker.rejected += 1
+            raise CircuitOpenError(f"所有VLM副本均处于熔断状态: {', '.join(e.base_url for e in self.endpoints)}")
+        # 优先选择正常副本，半开副本只承担探测请求
+        closed = [e for e in candidates if e.breaker.state == "closed"]
+        endpoint = min(closed or candidates, key=self._score)
+        endpoint.breaker.on_acquire()
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint, success, latency=None, error=None):
+        """归还副本并记录本次请求结果"""
+        endpoint.outstanding -= 1
+        if success:
+            endpoint.successes += 1
+            endpoint.breaker.record_success()
+            if latency is not None:
+                endpoint.total_latency += latency
+                if endpoint.ewma_latency is None:
+                    endpoint.ewma_latency = latency
+                else:
+                    endpoint.ewma_latency = self.ewma_alpha * latency + (1 - self.ewma_alpha) * endpoint.ewma_latency
+        else:
+            endpoint.failures += 1
+            endpoint.last_error = error
+            was_open = endpoint.breaker.state == "open"
+            endpoint.breaker.record_failure()
+            if not was_open and endpoint.breaker.state == "open":
+                print(f"VLM副本 {endpoint.base_url} 连续失败 {endpoint.breaker.consecutive_failures} 次，已熔断")
+
+    @staticmethod
+    def _is_failure_status(status_code):
+        # 5xx 视为副本故障；4xx（含429过载）是请求或负载问题，不摘除副本
+        return status_code >= 500
+
+    async def post_json(self, path, payload, timeout, headers=None):
+        """
+        通过负载均衡选择副本发送JSON POST请求
+
+        Returns:
+            tuple: (状态码, 响应JSON, 副本地址)
+        """
+        endpoint = self.acquire()
+        start_time = time.time()
+        try:
+            status_code, result = await self.client.post_json(f"{endpoint.base_url}{path}", payload, timeout, headers)
+        except Exception as e:
+            self.release(endpoint, False, error=repr(e))
+            raise
+        success = not self._is_failure_status(status_code)
+        self.release(endpoint, success, time.time() - start_time if status_code == 200 else None,
+                     None if success else f"HTTP {status_code}")
+        return status_code, result, endpoint.base_url
+
+    @contextlib.asynccontextmanager
+    async def stream_json(self, path, payload, timeout, headers=None):
+        """
+        通过负载均衡选择副本发送流式请求，用法同 VLMClient.stream_json，
+        额外返回副本地址：async with pool.stream_json(...) as (status, events, base_url)
+
+        只有传输错误（或得到状态码之前的异常）计为副本失败；已得到状态码时，
+        调用方在 async with 块内抛出的异常（如429触发的 RetryableError）按状态码归还副本。
+        """
+        endpoint = self.acquire()
+        start_time = time.time()
+        status_code = None
+        error = None
+        try:
+            async with self.client.stream_json(f"{endpoint.base_url}{path}", payload, timeout, headers) as (status_code, events):
+                yield status_code, events, endpoint.base_url
+        except TRANSPORT_ERRORS as e:
+            error = repr(e)
+            raise
+        except BaseException as e:
+            if status_code is None:
+                error = repr(e)
+            raise
+        finally:
+            if error is not None:
+                self.release(endpoint, False, error=error)
+            else:
+                success = not self._is_failure_status(status_code)
+                self.release(endpoint, success, time.time() - start_time if status_code == 200 else None,
+                             None if success else f"HTTP {status_code}")
+
+    def _ensure_health_checker(self):
+        if self._health_task is None and self.health_check_interval:
+            self._health_task = asyncio.get_running_loop().create_task(self._health_check_loop())
+
+    async def _check_endpoint(self, endpoint):
+        try:
+            status_code = await self.client.get_status(f"{endpoint.base_url}/models", self.health_check_timeout)
+            healthy = status_code == 200
+        except Exception as e:
+            healthy = False
+            endpoint.last_error = repr(e)
+        if healthy and endpoint.breaker.state == "open":
+            endpoint.breaker.allow_probe()
+            print(f"VLM副本 {endpoint.base_url} 健康检查通过，进入半开状态")
+        elif not healthy and endpoint.breaker.state != "open":
+            endpoint.breaker.force_open()
+            print(f"VLM副本 {endpoint.base_url} 健康检查失败，已熔断")
+
+    async def _health_check_loop(self):
+        """定期检查所有副本的 /models 接口"""
+        while True:
+            await asyncio.gather(*[self._check_endpoint(endpoint) for endpoint in self.endpoints])
+            await asyncio.sleep(self.health_check_interval)
+
+    def stats(self):
+        """获取各副本的健康状态、熔断器状态、吞吐与延迟计数"""
+        uptime = time.time() - self._started_at
+        return [endpoint.stats(uptime) for endpoint in self.endpoints]
@@ -1,16 +1,16 @@
-import os
-import json
-import re
-from tqdm import tqdm
-import base64
-from PIL import Image
-import traceback
-import datetime
-from openai import OpenAI
-import requests
 import re
 import time
+import random
+import asyncio
+import aiohttp
 from config_loader import config
+from vlm_client import vlm_client
+from vlm_endpoints import EndpointPool
+from vlm_retry import RetryPolicy, RetryableError, RetryError, CircuitOpenError
+from image_preprocess import crop_regions, preprocess_image, image_data_to_base64
+from vlm_cache import VLMResultCache, make_cache_key
+from frame_dedup import FrameDeduplicator, dhash_image_data
+from tracing import Trace, TRACE_HEADER, format_traceparent, new_trace_id
 
 # 获取VLM配置
 vlm_config = config.get_vlm_config()
@@ -20,17 +20,102 @@ VLLM_API_BASE = vlm_config.get("api_base", "http://localhost:9999/v1")
 VLLM_MODEL = vlm_config.get("model_name", "MissCover-Qwen2.5VL-7B")
 TIMEOUT = vlm_config.get("timeout", 30)
 MAX_RETRIES = vlm_config.get("max_retries", 3)
+MAX_IN_FLIGHT = vlm_config.get("max_in_flight", 16)  # 批量推理时同时发往vLLM的最大请求数
+
+# 多副本负载均衡，vlm.api_bases 未配置时只使用 api_base 一个副本
+endpoint_pool = EndpointPool.from_config(vlm_client, vlm_config)
+VLLM_API_BASES = [endpoint.base_url for endpoint in endpoint_pool.endpoints]
+
+# 重试策略：指数退避+抖动，单张图片总截止时间见 vlm.retry.deadline
+retry_policy = RetryPolicy.from_config(vlm_config)
+
+# ROI裁剪模式配置
+roi_config = vlm_config.get("roi", {})
+ROI_CLASS_NAMES = roi_config.get("class_names", ["gaiban_open"])  # 需要裁剪送检的YOLO类别
+ROI_MARGIN = roi_config.get("margin", 0.5)  # 检测框四周保留的上下文比例
+ROI_MERGE_DISTANCE = roi_config.get("merge_distance", None)  # 相邻框合并距离（像素），None表示逐框裁剪
+ROI_MIN_SIZE = roi_config.get("min_size", 224)  # 裁剪区域最小边长（像素）
+
+# 提交前图像预处理配置
+preprocess_config = vlm_config.get("preprocess", {})
+PREPROCESS_ENABLED = preprocess_config.get("enabled", False)  # 是否在提交前缩放并重新编码图像
+PREPROCESS_MAX_PIXELS = preprocess_config.get("max_pixels", None)  # 最大像素数
+PREPROCESS_MAX_VISION_TOKENS = preprocess_config.get("max_vision_tokens", None)  # 最大视觉token数
+PREPROCESS_PATCH_SIZE = preprocess_config.get("patch_size", 28)  # 模型patch对齐倍数
+PREPROCESS_JPEG_QUALITY = preprocess_config.get("jpeg_quality", 85)  # 重新编码的JPEG质量
+
+# VLM结果缓存配置
+cache_config = vlm_config.get("cache", {})
+CACHE_ENABLED = cache_config.get("enabled", False)  # 是否启用结果缓存
+vlm_cache = VLMResultCache.from_config(cache_config) if CACHE_ENABLED else None
+
+# 近重复帧去重配置
+dedup_config = vlm_config.get("dedup", {})
+DEDUP_ENABLED = dedup_config.get("enabled", False)  # 是否对同一相机的近重复帧复用上一帧结论
+frame_deduplicator = FrameDeduplicator.from_config(dedup_config) if DEDUP_ENABLED else None
+
+# 采样参数（temperature为0，相同输入的结果是确定的，可以缓存）
+SAMPLING_PARAMS = {
+    "max_tokens": 2048,
+    "temperature": 0.0
+}
+
+# 快速模式配置：只生成<answer>，不输出<think>思考过程
+fast_mode_config = vlm_config.get("fast_mode", {})
+FAST_MODE_ENABLED = fast_mode_config.get("enabled", False)  # 是否默认使用快速模式
+FAST_MODE_PROMPT = fast_mode_config.get("prompt", "")  # 快速模式提示词，为空时沿用调用方的提示词
+FAST_MODE_MAX_TOKENS = fast_mode_config.get("max_tokens", 32)  # 快速模式最大生成token数
+FAST_MODE_STOP = fast_mode_config.get("stop", ["</answer>"])  # 停止序列，生成到</answer>立即结束
+# vLLM约束解码的候选答案，如 ["存在盖板缺失", "不存在盖板缺失"]，为空时不约束。
+# 约束解码时模型只能逐字输出候选项本身，未带<answer>标签的候选项会自动包成 <answer>候选项</answer>，
+# parse_vlm_result 也接受与候选项一致的裸答案
+FAST_MODE_GUIDED_CHOICE = fast_mode_config.get("guided_choice", [])
+FAST_MODE_AUDIT_SAMPLE_RATE = fast_mode_config.get("audit_sample_rate", 0.0)  # 快速模式下仍按思考模式推理的抽样比例
+
+def resolve_inference_mode(mode=None):
+    """
+    确定本次推理使用的模式
+
+    Args:
+        mode: 'fast'（只输出答案）、'think'（输出思考过程和答案）或None；
+            为None时按配置决定，启用快速模式时按 audit_sample_rate 抽样保留思考模式用于审计
+    """
+    if mode is None:
+        if FAST_MODE_ENABLED and random.random() >= FAST_MODE_AUDIT_SAMPLE_RATE:
+            return "fast"
+        return "think"
+    if mode not in ("fast", "think"):
+        raise ValueError(f"未知的推理模式: {mode}")
+    return mode
+
+def build_sampling_params(mode):
+    """根据推理模式构建采样参数"""
+    if mode == "think":
+        return dict(SAMPLING_PARAMS)
+    params = {
+        "max_tokens": FAST_MODE_MAX_TOKENS,
+        "temperature": 0.0,
+        "stop": FAST_MODE_STOP,
+        "include_stop_str_in_output": True  # 保留</answer>，parse_vlm_result可以照常解析
+    }
+    if FAST_MODE_GUIDED_CHOICE:
+        params["guided_choice"] = [choice if choice.lstrip().startswith("<answer>") else f"<answer>{choice}</answer>"
+                                   for choice in FAST_MODE_GUIDED_CHOICE]
+    return params
+
+POSITIVE_ANSWER = "存在盖板缺失"  # VLM确认盖板缺失时的答案
+# 约束解码候选项中的答案文本（去掉<answer>标签）
+GUIDED_CHOICE_ANSWERS = {re.sub(r"</?answer>", "", choice).strip() for choice in FAST_MODE_GUIDED_CHOICE}
 
 def encode_image_from_base64(base64_string):
-    """直接处理base64字符串，转换为API需要的格式"""
-    try:
-        # 如果base64字符串不包含数据URL前缀，添加它
-        if not base64_string.startswith('data:image'):
-            base64_string = f"data:image;base64,{base64_string}"
+    """直接处理base64字符串（也接受原始图像字节），转换为API需要的数据URL格式"""
+    if isinstance(base64_string, str) and base64_string.startswith('data:image'):
         return base64_string
+    try:
+        return f"data:image;base64,{image_data_to_base64(base64_string)}"
     except Exception as e:
         raise ValueError(f"无法处理base64图片: {str(e)}")
-    
+
 def parse_vlm_result(result):
     """解析出think和answer"""
     think_match = re.search(r"<think>(.*?)</think>", result, re.S)
@@ -38,139 +123,403 @@ def parse_vlm_result(result):
         think = think_match.group(1).strip()
     else:
         think = ""
-    answer_match = re.search(r"<answer>(.*?)</answer>", result, re.S)
+    # 快速模式下停止序列可能截断结尾的</answer>
+    answer_match = re.search(r"<answer>(.*?)(?:</answer>|$)", result, re.S)
     if answer_match:
         answer = answer_match.group(1).strip()
+    elif result.strip() in GUIDED_CHOICE_ANSWERS:
+        # 约束解码输出的裸答案（候选项不带标签）
+        answer = result.strip()
     else:
         answer = ""
     return think, answer
 
 
-def inference_single_base64(image_base64, prompt, image_name="image"):
+async def _prepare_vlm_request(image, prompt, mode=None):
     """
-    对单张base64编码的图像进行VLM推理
+    准备VLM请求：确定推理模式、查询结果缓存、预处理图像并构建请求数据
+
+    image 可以是原始图像字节或base64字符串，只在构建请求数据时按OpenAI兼容接口的要求编码一次base64。
+
+    Returns:
+        dict: 请求上下文，包含 'mode'、'cache_key'、'cached_result'（命中缓存时不为None，
+            此时不需要再发送请求）、'request_data' 和 'preprocess_stats'
+    """
+    mode = resolve_inference_mode(mode)
+    sampling_params = build_sampling_params(mode)
+    if mode == "fast" and FAST_MODE_PROMPT:
+        prompt = FAST_MODE_PROMPT
+    context = {
+        "mode": mode,
+        "cache_key": None,
+        "cached_result": None,
+        "request_data": None,
+        "preprocess_stats": None
+    }
     
-    Args:
-        image_base64: base64编码的图像数据
-        prompt: 推理提示词
-        image_name: 图像名称，用于日志记录
+    # 查询结果缓存，键包含原图内容、提示词、模型、采样参数以及预处理参数
+    if vlm_cache is not None:
+        cache_params = dict(sampling_params)
+        if PREPROCESS_ENABLED:
+            cache_params["preprocess"] = [PREPROCESS_MAX_PIXELS, PREPROCESS_MAX_VISION_TOKENS, PREPROCESS_PATCH_SIZE, PREPROCESS_JPEG_QUALITY]
+        context["cache_key"] = make_cache_key(image, prompt, VLLM_MODEL, cache_params)
+        context["cached_result"] = vlm_cache.get(context["cache_key"])
+        if context["cached_result"] is not None:
+            return context
     
-    Returns:
-        dict: 推理结果，包含：
-            - 'success': 是否成功
-            - 'predict': 预测结果
-            - 'error': 错误信息（如果失败）
-            - 'processing_time': 处理时间
+    # 按视觉token预算缩放图像（在线程池中执行，避免阻塞事件循环）
+    if PREPROCESS_ENABLED:
+        image, context["preprocess_stats"] = await asyncio.get_running_loop().run_in_executor(
+            None,
+            preprocess_image,
+            image,
+            PREPROCESS_MAX_PIXELS,
+            PREPROCESS_MAX_VISION_TOKENS,
+            PREPROCESS_PATCH_SIZE,
+            PREPROCESS_JPEG_QUALITY
+        )
+    
+    # 构建请求数据
+    context["request_data"] = {
+        "model": VLLM_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{image_data_to_base64(image)}"
+                        }
+                    }
+                ]
+            }
+        ],
+        **sampling_params
+    }
+    return context
+
+def _cached_vlm_result(context, image_name, start_time):
+    """将命中的缓存结果整理为本次推理的返回值"""
+    cached_result = context["cached_result"]
+    cached_result.update({
+        "cache_hit": True,
+        "original_processing_time": cached_result["processing_time"],
+        "processing_time": time.time() - start_time,
+        "image_name": image_name
+    })
+    return cached_result
+
+def _finish_vlm_result(vlm_result, context):
+    """补充预处理统计并写入结果缓存"""
+    if context["preprocess_stats"] is not None:
+        vlm_result["preprocess"] = context["preprocess_stats"]
+    if context["cache_key"] is not None:
+        vlm_cache.put(context["cache_key"], vlm_result)
+        vlm_result["cache_hit"] = False
+    return vlm_result
+
+def _request_error_result(error, image_name, start_time):
+    """构建请求失败的推理结果"""
+    return {
+        "success": False,
+        "error": error,
+        "processing_time": time.time() - start_time,
+        "image_name": image_name
+    }
+
+def _classify_request_exception(e, timeout):
+    """将请求异常转换为可重试错误"""
+    if isinstance(e, asyncio.TimeoutError):
+        return RetryableError(f"VLM请求超时 (超时时间: {timeout:.0f}秒)")
+    return RetryableError(f"VLM连接错误，请检查服务是否运行在 {', '.join(VLLM_API_BASES)}")
+
+def _attach_trace(result, trace):
+    """将追踪记录写入推理结果"""
+    result["trace"] = trace.to_dict()
+    return result
+
+async def _traced_inference(name, image_name, trace_id, parent_id, run):
+    """
+    在名为name的顶层span中执行 run(trace, span_id) 并把追踪写入结果
+
+    run 中的各阶段以该span为父span：vlm_prepare（缓存查询、预处理与编码）、vlm_request（每次请求尝试一个）、
+    流式推理时的 vlm_prefill / vlm_decode（以首个token为界），以及 vlm_parse。
     """
+    trace = Trace(trace_id, parent_id)
+    start_time = time.time()
+    result = await run(trace, trace.root_span_id)
+    trace.finish(name, start_time, image_name=image_name, success=bool(result.get("success")),
+                 cache_hit=bool(result.get("cache_hit")))
+    return _attach_trace(result, trace)
+
+async def _prepare_traced(image, prompt, mode, trace, parent_id):
+    with trace.span("vlm_prepare", parent_id=parent_id) as span:
+        context = await _prepare_vlm_request(image, prompt, mode)
+        span["attributes"].update(mode=context["mode"], cache_hit=context["cached_result"] is not None)
+    return context
+
+async def _inference_single_base64(image, prompt, image_name="image", mode=None, trace_id=None, parent_id=None):
+    """单张图片VLM推理的实现，运行在共享VLM客户端的事件循环中"""
+    return await _traced_inference(
+        "vlm", image_name, trace_id, parent_id,
+        lambda trace, root_id: _inference_single_base64_traced(image, prompt, image_name, mode, trace, root_id)
+    )
+
+async def _inference_single_base64_traced(image, prompt, image_name, mode, trace, root_id):
     start_time = time.time()
     
     try:
-        # 准备请求数据
-        if image_base64.startswith('data:image'):
-            # 移除数据URL前缀
-            image_base64 = image_base64.split(',')[1]
+        context = await _prepare_traced(image, prompt, mode, trace, root_id)
+        if context["cached_result"] is not None:
+            return _cached_vlm_result(context, image_name, start_time)
+        request_data = context["request_data"]
+        attempts = []
         
-        # 构建请求数据
-        request_data = {
-            "model": VLLM_MODEL,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            }
-                        }
-                    ]
+        async def send(timeout):
+            attempts.append(timeout)
+            with trace.span("vlm_request", parent_id=root_id, attempt=len(attempts)) as span:
+                try:
+                    status_code, result, base_url = await endpoint_pool.post_json(
+                        "/chat/completions",
+                        request_data,
+                        timeout=timeout,
+                        headers={TRACE_HEADER: format_traceparent(trace.trace_id, span["span_id"])}
+                    )
+                except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                    raise _classify_request_exception(e, timeout)
+                span["attributes"].update(status=status_code, endpoint=base_url)
+            
+            if status_code != 200:
+                error_msg = f"VLM API请求失败，状态码: {status_code}"
+                if retry_policy.should_retry_status(status_code):
+                    raise RetryableError(error_msg, retry_after=result.get("retry_after"))
+                return _request_error_result(error_msg, image_name, start_time)
+            
+            # 提取预测结果
+            if "choices" in result and len(result["choices"]) > 0:
+                predict = result["choices"][0]["message"]["content"]
+
+                with trace.span("vlm_parse", parent_id=root_id):
+                    think, answer = parse_vlm_result(predict)
+                
+                processing_time = time.time() - start_time
+                
+                vlm_result = {
+                    "success": True,
+                    "think": think,
+                    "answer": answer,
+                    "predict": predict,
+                    "processing_time": processing_time,
+                    "model": VLLM_MODEL,
+                    "image_name": image_name,
+                    "mode": context["mode"]
                 }
-            ],
-            "max_tokens": 2048,
-            "temperature": 0.0
-        }
+                return _finish_vlm_result(vlm_result, context)
+            else:
+                return _request_error_result("VLM响应格式错误", image_name, start_time)
         
-        # 发送请求，支持重试
-        for attempt in range(MAX_RETRIES):
+        # 发送请求，按重试策略退避重试
+        return await retry_policy.call(send)
+    
+    except RetryError as e:
+        return _request_error_result(str(e), image_name, start_time)
+    except CircuitOpenError as e:
+        return _request_error_result(f"VLM服务熔断，快速失败: {str(e)}", image_name, start_time)
+    except Exception as e:
+        return _request_error_result(f"VLM推理过程中出现未知错误: {str(e)}", image_name, start_time)
+
+def _extract_verdict(text):
+    """流式输出中<answer>闭合后返回答案，尚未闭合返回None"""
+    match = re.search(r"<answer>(.*?)</answer>", text, re.S)
+    return match.group(1).strip() if match else None
+
+async def _inference_single_base64_stream(image, prompt, image_name="image", mode=None, on_verdict=None, drain=False,
+                                          trace_id=None, parent_id=None):
+    """流式VLM推理的实现，运行在共享VLM客户端的事件循环中"""
+    return await _traced_inference(
+        "vlm", image_name, trace_id, parent_id,
+        lambda trace, root_id: _inference_single_base64_stream_traced(
+            image, prompt, image_name, mode, on_verdict, drain, trace, root_id
+        )
+    )
+
+async def _inference_single_base64_stream_traced(image, prompt, image_name, mode, on_verdict, drain, trace, root_id):
+    start_time = time.time()
+    
+    try:
+        context = await _prepare_traced(image, prompt, mode, trace, root_id)
+        if context["cached_result"] is not None:
+            result = _cached_vlm_result(context, image_name, start_time)
+            if on_verdict is not None and result.get("answer"):
+                on_verdict(result["answer"], image_name)
+            return result
+        request_data = dict(context["request_data"], stream=True)
+        attempts = []
+        
+        async def send(timeout):
+            attempts.append(timeout)
+            with trace.span("vlm_request", parent_id=root_id, attempt=len(attempts), stream=True) as span:
+                return await stream_once(timeout, span)
+        
+        async def stream_once(timeout, span):
+            request_start = time.time()
+            chunks = []
+            first_token_time = None
+            verdict_time = None
+            answer = None
+            early_stopped = False
+            headers = {TRACE_HEADER: format_traceparent(trace.trace_id, span["span_id"])}
             try:
-                response = requests.post(
-                    f"{VLLM_API_BASE}/chat/completions",
-                    json=request_data,
-                    timeout=TIMEOUT
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
+                async with endpoint_pool.stream_json("/chat/completions", request_data, timeout=timeout,
+                                                     headers=headers) as (status_code, events, base_url):
+                    span["attributes"].update(status=status_code, endpoint=base_url)
+                    if status_code != 200:
+                        error_msg = f"VLM API请求失败，状态码: {status_code}"
+                        if retry_policy.should_retry_status(status_code):
+                            # 非200响应的 events 为 {'retry_after': ...}
+                            raise RetryableError(error_msg, retry_after=events.get("retry_after"))
+                        return _request_error_result(error_msg, image_name, start_time)
                     
-                    # 提取预测结果
-                    if "choices" in result and len(result["choices"]) > 0:
-                        predict = result["choices"][0]["message"]["content"]
-
-                        think, answer = parse_vlm_result(predict)
-                        
-                        processing_time = time.time() - start_time
+                    async for event in events:
+                        choices = event.get("choices") or []
+                        if not choices:
+                            continue
+                        delta = choices[0].get("delta", {}).get("content") or ""
+                        if not delta:
+                            continue
+                        if first_token_time is None:
+                            first_token_time = time.time()
+                        chunks.append(delta)
                         
-                        return {
-                            "success": True,
-                            "think": think,
-                            "answer": answer,
-                            "predict": predict,
-                            "processing_time": processing_time,
-                            "model": VLLM_MODEL,
-                            "image_name": image_name
-                        }
-                    else:
-                        return {
-                            "success": False,
-                            "error": "VLM响应格式错误",
-                            "processing_time": time.time() - start_time,
-                            "image_name": image_name
-                        }
-                else:
-                    error_msg = f"VLM API请求失败，状态码: {response.status_code}"
-                    if attempt < MAX_RETRIES - 1:
-                        print(f"VLM请求失败，正在重试... (尝试 {attempt + 1}/{MAX_RETRIES})")
-                        time.sleep(1)  # 等待1秒后重试
-                        continue
-                    else:
-                        return {
-                            "success": False,
-                            "error": error_msg,
-                            "processing_time": time.time() - start_time,
-                            "image_name": image_name
-                        }
-                        
-            except requests.exceptions.Timeout:
-                error_msg = f"VLM请求超时 (超时时间: {TIMEOUT}秒)"
-                if attempt < MAX_RETRIES - 1:
-                    print(f"VLM请求超时，正在重试... (尝试 {attempt + 1}/{MAX_RETRIES})")
-                    time.sleep(2)  # 等待2秒后重试
-                    continue
-                else:
-                    return {
-                        "success": False,
-                        "error": error_msg,
-                        "processing_time": time.time() - start_time,
-                        "image_name": image_name
-                    }
-            except requests.exceptions.ConnectionError:
-                error_msg = f"VLM连接错误，请检查服务是否运行在 {VLLM_API_BASE}"
-                if attempt < MAX_RETRIES - 1:
-                    print(f"VLM连接失败，正在重试... (尝试 {attempt + 1}/{MAX_RETRIES})")
-                    time.sleep(2)  # 等待2秒后重试
-                    continue
-                else:
-                    return {
-                        "success": False,
-                        "error": error_msg,
-                        "processing_time": time.time() - start_time,
-                        "image_name": image_name
-                    }
-                    
+                        if answer is None:
+                            answer = _extract_verdict("".join(chunks))
+                            if answer is not None:
+                                verdict_time = time.time()
+                                if on_verdict is not None:
+                                    on_verdict(answer, image_name)
+                                if not drain:
+                                    # 已拿到结论，关闭连接让vLLM取消剩余生成
+                                    early_stopped = True
+                                    break
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                # 只在收到第一个token之前重试；结论已经拿到时，排空剩余输出出错不影响结果
+                if first_token_time is None:
+                    raise _classify_request_exception(e, timeout)
+                if answer is None:
+                    return _request_error_result(str(_classify_request_exception(e, timeout)), image_name, start_time)
+            
+            end_time = time.time()
+            # 预填充以收到首个token为界，之后为解码（提前结束时只到拿到结论为止）
+            if first_token_time is not None:
+                trace.add_span("vlm_prefill", request_start, first_token_time, parent_id=span["span_id"])
+                trace.add_span("vlm_decode", first_token_time, end_time, parent_id=span["span_id"],
+                               early_stopped=early_stopped)
+            predict = "".join(chunks)
+            with trace.span("vlm_parse", parent_id=root_id):
+                think, parsed_answer = parse_vlm_result(predict)
+            vlm_result = {
+                "success": True,
+                "think": think,
+                "answer": answer if answer is not None else parsed_answer,
+                "predict": predict,
+                "processing_time": end_time - start_time,
+                "model": VLLM_MODEL,
+                "image_name": image_name,
+                "mode": context["mode"],
+                "streaming": {
+                    "time_to_first_token": first_token_time - request_start if first_token_time else None,
+                    "time_to_verdict": verdict_time - request_start if verdict_time else None,
+                    "generation_time": end_time - request_start,
+                    "early_stopped": early_stopped
+                }
+            }
+            # 提前结束时输出不完整，不写入缓存
+            if early_stopped:
+                context["cache_key"] = None
+            return _finish_vlm_result(vlm_result, context)
+        
+        return await retry_policy.call(send)
+    
+    except RetryError as e:
+        return _request_error_result(str(e), image_name, start_time)
+    except CircuitOpenError as e:
+        return _request_error_result(f"VLM服务熔断，快速失败: {str(e)}", image_name, start_time)
+    except Exception as e:
+        return _request_error_result(f"VLM推理过程中出现未知错误: {str(e)}", image_name, start_time)
+
+async def _inference_with_dedup(image, image_name, run_inference, trace_id=None):
+    """
+    在推理前做近重复帧检查：同一相机最近的某帧与当前帧足够相似时直接复用其结论，
+    否则执行 run_inference(trace_id) 并记录当前帧。未启用去重时直接推理。
+    同一相机有相似帧正在推理时先等它完成再查找，从而复用其结论；只有查找与登记是串行的
+    （两者之间没有await，在事件循环中是原子的），不相似的帧照常并发推理。
+    检查的耗时记录为 vlm_dedup span，与推理的追踪合并；trace_id 为None时在这里生成，两者使用同一个trace_id。
+    """
+    trace_id = trace_id or new_trace_id()
+    if frame_deduplicator is None:
+        return await run_inference(trace_id)
+    
+    start_time = time.time()
+    try:
+        image_hash = await asyncio.get_running_loop().run_in_executor(None, dhash_image_data, image)
+    except Exception:
+        # 哈希失败不影响正常推理
+        return await run_inference(trace_id)
+    
+    waited = False
+    while True:
+        pending = frame_deduplicator.find_pending(image_hash, image_name)
+        if pending is None:
+            break
+        waited = True
+        # asyncio.wait 不会在当前任务取消时取消别的帧的推理
+        await asyncio.wait({pending})
+    match = frame_deduplicator.lookup(image_hash, image_name)
+    trace = Trace(trace_id)
+    trace.finish("vlm_dedup", start_time, hit=match is not None, waited=waited)
+    if match is not None:
+        result = match["result"]
+        result.update({
+            "processing_time": time.time() - start_time,
+            "image_name": image_name,
+            "dedup": {
+                "hit": True,
+                "matched_image": match["matched_image"],
+                "distance": match["distance"],
+                "saved_seconds": match["result"].get("processing_time", 0)
+            }
+        })
+        return _attach_trace(result, trace)
+    
+    done = asyncio.get_running_loop().create_future()
+    frame_deduplicator.add_pending(image_hash, image_name, done)
+    try:
+        result = await run_inference(trace_id)
+        frame_deduplicator.record(image_hash, image_name, result)
+    finally:
+        frame_deduplicator.remove_pending(image_name, done)
+        done.set_result(None)
+    result["dedup"] = {"hit": False}
+    trace.merge(result.get("trace"))
+    return _attach_trace(result, trace)
+
+async def _inference_batch_item(image_data, prompt, semaphore, mode=None):
+    """批量推理中的单张图片任务，任何异常都只影响当前图片"""
+    image_name = image_data.get('image_name', 'unknown')
+    start_time = time.time()
+    try:
+        async with semaphore:
+            image = image_data.get('image_bytes') or image_data.get('image_base64', '')
+            return await _inference_with_dedup(
+                image, image_name,
+                lambda trace_id: _inference_single_base64(image, prompt, image_name, mode, trace_id),
+                image_data.get('trace_id')
+            )
     except Exception as e:
         return {
             "success": False,
@@ -179,35 +528,259 @@ def inference_single_base64(image_base64, prompt, image_name="image"):
             "image_name": image_name
         }
 
-def inference_batch_base64(images_data, prompt):
+async def _inference_batch_base64(images_data, prompt, max_in_flight=None, mode=None):
+    """批量VLM推理的实现，运行在共享VLM客户端的事件循环中"""
+    if max_in_flight is None:
+        max_in_flight = MAX_IN_FLIGHT
+    semaphore = asyncio.Semaphore(max(1, int(max_in_flight)))
+    # gather 按输入顺序返回结果；同一相机的近重复帧由 _inference_with_dedup 等待进行中的相似帧，其余帧并发推理
+    return await asyncio.gather(*[_inference_batch_item(image_data, prompt, semaphore, mode) for image_data in images_data])
+
+async def _inference_roi_base64(image, prompt, objects, image_name="image", margin=None, merge_distance=None, mode=None,
+                               trace_id=None):
+    """ROI裁剪模式推理的实现，运行在共享VLM客户端的事件循环中"""
+    start_time = time.time()
+    trace_id = trace_id or new_trace_id()  # 所有裁剪区域共用一个trace_id
+    mode = resolve_inference_mode(mode)  # 同一张图片的所有裁剪区域使用相同模式
+    if margin is None:
+        margin = ROI_MARGIN
+    if merge_distance is None:
+        merge_distance = ROI_MERGE_DISTANCE
+    
+    bboxes = [obj['bbox'] for obj in objects if obj.get('class_name') in ROI_CLASS_NAMES]
+    if not bboxes:
+        # 没有可裁剪的区域时退回整图推理
+        return await _inference_single_base64(image, prompt, image_name, mode, trace_id)
+    
+    try:
+        crops = crop_regions(image, bboxes, margin, merge_distance, ROI_MIN_SIZE)
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"ROI裁剪失败: {str(e)}",
+            "processing_time": time.time() - start_time,
+            "image_name": image_name
+        }
+    
+    crop_results = await asyncio.gather(*[
+        _inference_single_base64(crop['image_bytes'], prompt, f"{image_name}#crop{crop['crop_index']}", mode, trace_id)
+        for crop in crops
+    ])
+    
+    # 任一裁剪区域确认盖板缺失即采用该区域的结果，否则采用第一个成功的区域
+    selected = None
+    for crop, crop_result in zip(crops, crop_results):
+        if crop_result.get('success') and crop_result.get('answer') == POSITIVE_ANSWER:
+            selected = (crop, crop_result)
+            break
+    if selected is None:
+        for crop, crop_result in zip(crops, crop_results):
+            if crop_result.get('success'):
+                selected = (crop, crop_result)
+                break
+    
+    roi_info = {
+        "crop_count": len(crops),
+        "crops": [
+            {
+                "crop_index": crop['crop_index'],
+                "crop_box": crop['crop_box'],
+                "source_indices": crop['source_indices'],
+                "success": crop_result.get('success', False),
+                "answer": crop_result.get('answer', ''),
+                "processing_time": crop_result.get('processing_time', 0)
+            }
+            for crop, crop_result in zip(crops, crop_results)
+        ],
+        "selected_crop": selected[0]['crop_index'] if selected else None
+    }
+    
+    if selected is None:
+        return {
+            "success": False,
+            "error": crop_results[0].get('error', 'ROI区域推理全部失败'),
+            "processing_time": time.time() - start_time,
+            "image_name": image_name,
+            "roi": roi_info
+        }
+    
+    trace = Trace(trace_id)
+    for crop_result in crop_results:
+        trace.merge(crop_result.get("trace"))
+    result = dict(selected[1])
+    result.update({
+        "processing_time": time.time() - start_time,
+        "image_name": image_name,
+        "roi": roi_info
+    })
+    return _attach_trace(result, trace)
+
+def inference_single_base64(image_base64, prompt, image_name="image", mode=None, trace_id=None):
+    """
+    对单张base64编码的图像进行VLM推理
+    
+    Args:
+        image_base64: base64编码的图像数据，也可以直接传入原始图像字节（bytes），
+            此时只在提交给vLLM时编码一次base64
+        prompt: 推理提示词
+        image_name: 图像名称，用于日志记录
+        mode: 推理模式，'fast' 只生成答案（见 vlm.fast_mode），'think' 输出思考过程和答案，
+            None 按配置决定
+        trace_id: 上游传入的追踪ID（如客户端为每张图片生成的ID），None时生成新的；
+            请求vLLM时通过 traceparent 请求头传递
+    
+    Returns:
+        dict: 推理结果，包含：
+            - 'success': 是否成功
+            - 'predict': 预测结果
+            - 'mode': 实际使用的推理模式
+            - 'error': 错误信息（如果失败）
+            - 'processing_time': 处理时间
+            - 'preprocess': 图像预处理前后的尺寸、字节数、视觉token数与耗时（启用 vlm.preprocess 时）
+            - 'cache_hit': 是否命中结果缓存（启用 vlm.cache 时），命中时原始推理耗时记录在 'original_processing_time'
+            - 'dedup': 近重复帧检查结果（启用 vlm.dedup 时），命中时包含复用的图片名、汉明距离与节省的VLM耗时
+            - 'trace': 追踪记录 {'trace_id', 'spans'}，各阶段span见 tracing.Trace
+    """
+    return vlm_client.run_sync(_inference_with_dedup(
+        image_base64, image_name,
+        lambda trace_id: _inference_single_base64(image_base64, prompt, image_name, mode, trace_id),
+        trace_id
+    ))
+
+async def inference_single_base64_async(image_base64, prompt, image_name="image", mode=None, trace_id=None):
+    """inference_single_base64 的异步版本，参数与返回值相同"""
+    return await vlm_client.run_async(_inference_with_dedup(
+        image_base64, image_name,
+        lambda trace_id: _inference_single_base64(image_base64, prompt, image_name, mode, trace_id),
+        trace_id
+    ))
+
+def inference_single_base64_stream(image_base64, prompt, image_name="image", mode=None, on_verdict=None, drain=False,
+                                   trace_id=None):
+    """
+    流式VLM推理：边生成边解析，<answer>闭合的瞬间即给出结论
+    
+    Args:
+        image_base64: base64编码的图像数据，也可以直接传入原始图像字节（bytes），
+            此时只在提交给vLLM时编码一次base64
+        prompt: 推理提示词
+        image_name: 图像名称，用于日志记录
+        mode: 推理模式，见 inference_single_base64
+        on_verdict: 结论回调 on_verdict(answer, image_name)，在<answer>闭合时立即调用，
+            用于告警派发；回调运行在VLM客户端的事件循环线程中，应尽快返回
+        drain: 拿到结论后是否继续读完剩余输出（保留完整的think/predict，用于审计）；
+            为False时立即断开连接，由vLLM取消剩余生成
+        trace_id: 追踪ID，见 inference_single_base64
+    
+    Returns:
+        dict: 与 inference_single_base64 相同的推理结果，额外包含 'streaming'：
+            - 'time_to_first_token': 首token延迟（秒）
+            - 'time_to_verdict': 得到结论的延迟（秒）
+            - 'generation_time': 请求发出到结束的总耗时（秒）
+            - 'early_stopped': 是否在结论后提前结束
+        追踪记录中以首个token为界分为 vlm_prefill 与 vlm_decode 两个阶段
+    """
+    return vlm_client.run_sync(_inference_single_base64_stream(
+        image_base64, prompt, image_name, mode, on_verdict, drain, trace_id
+    ))
+
+async def inference_single_base64_stream_async(image_base64, prompt, image_name="image", mode=None, on_verdict=None, drain=False,
+                                               trace_id=None):
+    """inference_single_base64_stream 的异步版本，参数与返回值相同"""
+    return await vlm_client.run_async(_inference_single_base64_stream(
+        image_base64, prompt, image_name, mode, on_verdict, drain, trace_id
+    ))
+
+def inference_roi_base64(image_base64, prompt, objects, image_name="image", margin=None, merge_distance=None, mode=None,
+                         trace_id=None):
+    """
+    ROI裁剪模式：只把YOLO检测到的区域（含上下文边距）送给VLM推理
+    
+    每个目标类别的检测框按margin扩展后裁剪，可选地将相邻框合并为一个裁剪区域，
+    各区域并发推理，任一区域确认盖板缺失即判定为盖板缺失。没有可裁剪的检测框时退回整图推理。
+    
+    Args:
+        image_base64: base64编码的原图数据，也可以直接传入原始图像字节（bytes）
+        prompt: 推理提示词
+        objects: YOLO检测结果列表（如 yolo_detection.open_objects），每个元素包含 'bbox' 和 'class_name'
+        image_name: 图像名称，用于日志记录
+        margin: 上下文扩展比例，默认使用配置中的 vlm.roi.margin
+        merge_distance: 相邻框合并距离（像素），默认使用配置中的 vlm.roi.merge_distance
+        mode: 推理模式，见 inference_single_base64
+        trace_id: 追踪ID，见 inference_single_base64，所有裁剪区域的推理记录在同一条追踪中
+    
+    Returns:
+        dict: 与 inference_single_base64 相同的推理结果，额外包含：
+            - 'roi': 裁剪信息，包括各区域的坐标与答案，以及给出最终答案的区域 'selected_crop'
+    """
+    return vlm_client.run_sync(_inference_with_dedup(
+        image_base64, image_name,
+        lambda trace_id: _inference_roi_base64(image_base64, prompt, objects, image_name, margin, merge_distance, mode, trace_id),
+        trace_id
+    ))
+
+async def inference_roi_base64_async(image_base64, prompt, objects, image_name="image", margin=None, merge_distance=None, mode=None,
+                                     trace_id=None):
+    """inference_roi_base64 的异步版本，参数与返回值相同"""
+    return await vlm_client.run_async(_inference_with_dedup(
+        image_base64, image_name,
+        lambda trace_id: _inference_roi_base64(image_base64, prompt, objects, image_name, margin, merge_distance, mode, trace_id),
+        trace_id
+    ))
+
+def inference_batch_base64(images_data, prompt, max_in_flight=None, mode=None):
     """
     对多张base64编码的图像进行批量VLM推理
     
+    图片会并发提交给vLLM（由其连续批处理合并），同时在途的请求数不超过max_in_flight。
+    返回结果的顺序与输入顺序一致，单张图片失败不影响其他图片。
+    
     Args:
         images_data: 图像数据列表，每个元素包含：
-            - 'image_base64': base64编码的图像数据
+            - 'image_base64': base64编码的图像数据，或
+            - 'image_bytes': 原始图像字节（multipart等二进制上传时使用，优先于image_base64）
             - 'image_name': 图像名称
+            - 'trace_id': 可选的追踪ID，见 inference_single_base64
         prompt: 推理提示词
+        max_in_flight: 最大在途请求数，默认使用配置中的 vlm.max_in_flight，
+            设为1时退化为逐张串行推理
+        mode: 推理模式，见 inference_single_base64
     
     Returns:
         list: 推理结果列表
     """
-    results = []
-    
-    for image_data in images_data:
-        image_base64 = image_data.get('image_base64', '')
-        image_name = image_data.get('image_name', 'unknown')
-        
-        result = inference_single_base64(image_base64, prompt, image_name)
-        results.append(result)
-    
-    return results
+    return vlm_client.run_sync(_inference_batch_base64(images_data, prompt, max_in_flight, mode))
+
+async def inference_batch_base64_async(images_data, prompt, max_in_flight=None, mode=None):
+    """inference_batch_base64 的异步版本，参数与返回值相同"""
+    return await vlm_client.run_async(_inference_batch_base64(images_data, prompt, max_in_flight, mode))
+
+def get_cache_stats():
+    """获取VLM结果缓存的命中/未命中统计，未启用缓存时返回None"""
+    if vlm_cache is None:
+        return None
+    return vlm_cache.stats()
+
+def get_dedup_stats():
+    """获取近重复帧去重统计，未启用去重时返回None"""
+    if frame_deduplicator is None:
+        return None
+    return frame_deduplicator.stats()
+
+def get_endpoint_stats():
+    """获取各vLLM副本的健康状态、熔断器状态与计数、吞吐与延迟计数"""
+    return endpoint_pool.stats()
 
 if __name__ == "__main__":
     # 测试VLM推理
     print("测试VLM推理...")
     print(f"使用模型: {VLLM_MODEL}")
-    print(f"API地址: {VLLM_API_BASE}")
+    print(f"API地址: {', '.join(VLLM_API_BASES)}")
+    print(f"最大在途请求数: {MAX_IN_FLIGHT}")
+    print(f"连接池大小: {vlm_client.pool_size}")
+    print(f"结果缓存: {'启用' if CACHE_ENABLED else '未启用'}")
+    print(f"近重复帧去重: {'启用' if DEDUP_ENABLED else '未启用'}")
+    print(f"默认推理模式: {'快速模式' if FAST_MODE_ENABLED else '思考模式'}")
     
     # 这里可以添加测试代码
     print("VLM推理模块已就绪")
@@ -0,0 +1,225 @@
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+
+class RetryableError(Exception):
+    """可重试的请求错误（超时、连接错误、429/503等）"""
+
+    def __init__(self, message, retry_after=None):
+        """
+        Args:
+            message: 错误信息
+            retry_after: 服务端 Retry-After 要求的等待时间（秒），None表示按退避策略等待
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RetryError(Exception):
+    """重试次数用尽或超过截止时间"""
+
+class CircuitOpenError(Exception):
+    """熔断器打开，请求被快速拒绝"""
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头（秒数或HTTP日期）
+
+    Returns:
+        float: 需要等待的秒数，没有该响应头或格式不正确时为None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RetryPolicy:
+    """
+    重试策略：指数退避 + 全抖动（full jitter），并限制单个请求的总截止时间
+
+    第n次重试前等待 uniform(0, min(max_delay, base_delay * multiplier^n)) 秒，
+    避免服务重启时所有请求在同一时刻重试。服务端返回 Retry-After 时按其等待（不超过 max_retry_after），
+    等待后会超过截止时间时直接失败。
+    """
+
+    def __init__(self, max_attempts=3, timeout=30, base_delay=0.5, max_delay=8.0, multiplier=2.0,
+                 deadline=None, retry_statuses=(429, 500, 502, 503, 504), max_retry_after=60.0, verbose=False):
+        """
+        Args:
+            max_attempts: 最多尝试次数（含第一次）
+            timeout: 单次请求超时（秒）
+            base_delay: 退避基数（秒）
+            max_delay: 单次退避上限（秒）
+            multiplier: 退避倍数
+            deadline: 单个请求（含所有重试与退避）的总截止时间（秒），None表示不限制
+            retry_statuses: 需要重试的HTTP状态码，其余非200状态码直接失败
+            max_retry_after: 按 Retry-After 等待的上限（秒）
+            verbose: 为True时打印每次重试
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self.retry_statuses = set(retry_statuses)
+        self.max_retry_after = max_retry_after
+        self.verbose = verbose
+        self.retries = 0  # 累计重试次数
+
+    @classmethod
+    def from_config(cls, vlm_config):
+        """根据 vlm 配置块创建重试策略（max_retries/timeout 沿用原有配置项）"""
+        retry_config = vlm_config.get("retry", {})
+        return cls(
+            max_attempts=vlm_config.get("max_retries", 3),
+            timeout=vlm_config.get("timeout", 30),
+            base_delay=retry_config.get("base_delay", 0.5),
+            max_delay=retry_config.get("max_delay", 8.0),
+            multiplier=retry_config.get("multiplier", 2.0),
+            deadline=retry_config.get("deadline", None),
+            retry_statuses=retry_config.get("retry_statuses", [429, 500, 502, 503, 504]),
+            max_retry_after=retry_config.get("max_retry_after", 60.0),
+            verbose=retry_config.get("verbose", False)
+        )
+
+    def should_retry_status(self, status_code):
+        """HTTP状态码是否需要重试"""
+        return status_code in self.retry_statuses
+
+    def backoff(self, retry_index):
+        """第retry_index次重试（从0开始）前的等待时间"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** retry_index))
+
+    async def call(self, send):
+        """
+        按策略执行请求
+
+        Args:
+            send: 协程函数 send(timeout)，成功或不可重试时返回结果，需要重试时抛出 RetryableError
+
+        Returns:
+            send 的返回值
+
+        Raises:
+            RetryError: 重试次数用尽或超过截止时间
+            CircuitOpenError: 熔断器打开（不重试，直接抛出）
+        """
+        start_time = time.monotonic()
+        attempt = 0
+        while True:
+            timeout = self.timeout
+            if self.deadline is not None:
+                remaining = self.deadline - (time.monotonic() - start_time)
+                if remaining <= 0:
+                    raise RetryError(f"超过单张图片截止时间 ({self.deadline}秒)")
+                timeout = min(timeout, remaining)
+
+            try:
+                return await send(timeout)
+            except RetryableError as e:
+                last_error = e
+
+            attempt += 1
+            if attempt >= self.max_attempts:
+                raise RetryError(str(last_error))
+            if last_error.retry_after is not None:
+                delay = min(last_error.retry_after, self.max_retry_after)
+            else:
+                delay = self.backoff(attempt - 1)
+            if self.deadline is not None and time.monotonic() - start_time + delay >= self.deadline:
+                raise RetryError(f"{last_error} (超过单张图片截止时间 {self.deadline}秒)")
+            self.retries += 1
+            if self.verbose:
+                print(f"{last_error}，{delay:.2f}秒后重试... (尝试 {attempt}/{self.max_attempts})")
+            await asyncio.sleep(delay)
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    - closed：正常放行，连续失败达到 failure_threshold 次后打开
+    - open：拒绝请求，recovery_timeout 秒后（或健康检查通过时）进入半开
+    - half_open：最多放行 half_open_max_calls 个探测请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30, half_open_max_calls=1):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.half_open_calls = 0
+        self.transitions = {}  # "旧状态->新状态" -> 次数
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, breaker_config):
+        """根据 vlm.circuit_breaker 配置块创建熔断器"""
+        return cls(
+            failure_threshold=breaker_config.get("failure_threshold", 5),
+            recovery_timeout=breaker_config.get("recovery_timeout", 30),
+            half_open_max_calls=breaker_config.get("half_open_max_calls", 1)
+        )
+
+    def _transition(self, new_state):
+        if new_state == self.state:
+            return
+        key = f"{self.state}->{new_state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.state = new_state
+        if new_state == "open":
+            self.opened_at = time.monotonic()
+        if new_state == "half_open":
+            self.half_open_calls = 0
+        if new_state == "closed":
+            self.consecutive_failures = 0
+
+    def available(self):
+        """当前是否可以放行请求（不改变状态）"""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.recovery_timeout
+        return self.half_open_calls < self.half_open_max_calls
+
+    def on_acquire(self):
+        """放行一个请求"""
+        if self.state == "open":
+            self._transition("half_open")
+        if self.state == "half_open":
+            self.half_open_calls += 1
+
+    def record_success(self):
+        if self.state == "half_open":
+            self._transition("closed")
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= self.failure_threshold):
+            self._transition("open")
+
+    def force_open(self):
+        """健康检查失败时立即打开"""
+        self._transition("open")
+
+    def allow_probe(self):
+        """健康检查通过时提前进入半开，放行探测请求"""
+        if self.state == "open":
+            self._transition("half_open")
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "transitions": dict(self.transitions),
+            "rejected": self.rejected
+        }
@@ -0,0 +1,294 @@
+import os
+import ast
+import threading
+import numpy as np
+from PIL import Image
+
+def xywh_to_xyxy(boxes):
+    """中心点宽高格式 [cx, cy, w, h] 转换为角点格式 [x1, y1, x2, y2]"""
+    xyxy = np.empty_like(boxes)
+    half_w = boxes[:, 2] / 2
+    half_h = boxes[:, 3] / 2
+    xyxy[:, 0] = boxes[:, 0] - half_w
+    xyxy[:, 1] = boxes[:, 1] - half_h
+    xyxy[:, 2] = boxes[:, 0] + half_w
+    xyxy[:, 3] = boxes[:, 1] + half_h
+    return xyxy
+
+def nms(boxes, scores, iou_threshold):
+    """
+    NumPy非极大值抑制，每轮用向量运算计算当前最高分框与其余所有框的IoU
+
+    Returns:
+        np.ndarray: 保留的框下标，按分数从高到低排列
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        inter_w = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None)
+        inter_h = np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None)
+        inter = inter_w * inter_h
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+def batched_nms(boxes, scores, class_ids, iou_threshold):
+    """按类别分别做NMS：给每个类别的框加上互不重叠的坐标偏移后统一做一次NMS"""
+    if boxes.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = class_ids.astype(boxes.dtype)[:, None] * (boxes.max() + 1)
+    return nms(boxes + offsets, scores, iou_threshold)
+
+def letterbox_batch(images, imgsz):
+    """
+    将一批PIL图像等比缩放并填充到 imgsz x imgsz，组成模型输入
+
+    Returns:
+        tuple: (输入张量 float32 [N, 3, imgsz, imgsz]，每张图片的 (缩放比例, 左侧填充, 上侧填充))
+    """
+    batch = np.full((len(images), imgsz, imgsz, 3), 114, dtype=np.uint8)
+    transforms = []
+    for i, image in enumerate(images):
+        width, height = image.size
+        ratio = min(imgsz / width, imgsz / height)
+        new_width, new_height = max(1, round(width * ratio)), max(1, round(height * ratio))
+        pad_left = (imgsz - new_width) // 2
+        pad_top = (imgsz - new_height) // 2
+        resized = image.convert('RGB').resize((new_width, new_height), Image.BILINEAR)
+        batch[i, pad_top:pad_top + new_height, pad_left:pad_left + new_width] = np.asarray(resized)
+        transforms.append((ratio, pad_left, pad_top))
+    return batch.transpose(0, 3, 1, 2).astype(np.float32) / 255.0, transforms
+
+def decode_predictions(prediction, conf, iou, max_det=300, has_objectness=False):
+    """
+    解析单张图片的YOLO原始输出并做过滤与NMS，全部为向量运算
+
+    Args:
+        prediction: YOLOv8格式 [4 + 类别数, 候选框数]（ultralytics导出的原始布局）或 [候选框数, 4 + 类别数]，
+            YOLOv5格式 [候选框数, 5 + 类别数]；坐标为模型输入尺度的 cx, cy, w, h
+        conf: 置信度阈值
+        iou: NMS的IoU阈值
+        max_det: 最多保留的框数
+        has_objectness: 是否为含objectness列的YOLOv5格式，此时分数为 objectness * 类别分数
+
+    Returns:
+        tuple: (框 [K, 4] xyxy，分数 [K]，类别 [K])
+    """
+    if prediction.shape[0] < prediction.shape[1]:
+        prediction = prediction.T  # 候选框数远大于通道数，统一为 [候选框数, 通道数]
+    if has_objectness:
+        class_scores = prediction[:, 5:] * prediction[:, 4:5]
+    else:
+        class_scores = prediction[:, 4:]
+    class_ids = class_scores.argmax(axis=1)
+    scores = class_scores[np.arange(class_scores.shape[0]), class_ids]
+    mask = scores >= conf
+    boxes = xywh_to_xyxy(prediction[mask, :4])
+    scores = scores[mask]
+    class_ids = class_ids[mask]
+    keep = batched_nms(boxes, scores, class_ids, iou)[:max_det]
+    return boxes[keep], scores[keep], class_ids[keep]
+
+class OnnxDetector:
+    """
+    ONNX Runtime YOLO检测器（CPU可用）
+
+    一次推理整批图片（模型导出为固定batch时按该batch分块），预处理、解码、置信度过滤与NMS均用NumPy向量化实现。
+    支持 ultralytics 导出的 YOLOv8 格式与 YOLOv5 格式（output_format='v5'）输出。
+    """
+
+    def __init__(self, model_path, imgsz=640, iou=0.45, max_det=300, class_names=None, providers=None,
+                 intra_op_threads=None, output_format="v8"):
+        import onnxruntime as ort  # 只有使用ONNX后端时需要onnxruntime，延迟导入
+        options = ort.SessionOptions()
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options,
+                                            providers=providers or ["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # 固定batch的模型按该大小分块，动态batch（维度为字符串或None）一次推理整批
+        self.fixed_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+        self.imgsz = model_input.shape[2] if isinstance(model_input.shape[2], int) else imgsz
+        self.iou = iou
+        self.max_det = max_det
+        self.has_objectness = output_format == "v5"
+        self.names = self._load_class_names(class_names)
+
+    def _load_class_names(self, class_names):
+        if class_names:
+            return dict(enumerate(class_names))
+        # ultralytics 导出时把类别名写入模型元数据，如 "{0: 'gaiban_close', 1: 'gaiban_open'}"
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if "names" in metadata:
+            try:
+                return {int(k): v for k, v in ast.literal_eval(metadata["names"]).items()}
+            except (ValueError, SyntaxError):
+                pass
+        return {}
+
+    def _run(self, batch):
+        if self.fixed_batch is None:
+            return self.session.run(None, {self.input_name: batch})[0]
+        outputs = []
+        for start in range(0, batch.shape[0], self.fixed_batch):
+            chunk = batch[start:start + self.fixed_batch]
+            pad = self.fixed_batch - chunk.shape[0]
+            if pad:
+                chunk = np.concatenate([chunk, np.zeros((pad, *chunk.shape[1:]), dtype=chunk.dtype)])
+            outputs.append(self.session.run(None, {self.input_name: chunk})[0][:self.fixed_batch - pad])
+        return np.concatenate(outputs)
+
+    def detect(self, images, conf):
+        """检测一批PIL图像，返回格式同 UltralyticsDetector.detect"""
+        if not images:
+            return []
+        batch, transforms = letterbox_batch(images, self.imgsz)
+        predictions = self._run(batch)
+        detections = []
+        for image, prediction, (ratio, pad_left, pad_top) in zip(images, predictions, transforms):
+            boxes, scores, class_ids = decode_predictions(prediction, conf, self.iou, self.max_det, self.has_objectness)
+            # 从模型输入坐标还原到原图坐标
+            boxes = (boxes - np.array([pad_left, pad_top, pad_left, pad_top], dtype=boxes.dtype)) / ratio
+            width, height = image.size
+            boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+            boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+            detections.append([
+                {
+                    "bbox": [int(round(v)) for v in box],
+                    "class_id": int(class_id),
+                    "class_name": self.names.get(int(class_id), str(int(class_id))),
+                    "conf": float(score)
+                }
+                for box, score, class_id in zip(boxes.tolist(), scores.tolist(), class_ids.tolist())
+            ])
+        return detections
+
+class UltralyticsDetector:
+    """ultralytics YOLO检测器，支持一次检测多张图片"""
+
+    def __init__(self, model_path, device=None, imgsz=640, iou=0.45, max_det=300):
+        from ultralytics import YOLO  # 只有使用ultralytics后端时需要，延迟导入
+        self.model = YOLO(model_path)
+        self.device = device
+        self.imgsz = imgsz
+        self.iou = iou
+        self.max_det = max_det
+        self._lock = threading.Lock()  # 同一模型实例不保证线程安全，多个worker串行使用
+
+    def detect(self, images, conf):
+        """
+        检测一批PIL图像
+
+        Returns:
+            list: 每张图片的检测结果列表，每个目标包含 'bbox'、'class_id'、'class_name'、'conf'
+        """
+        with self._lock:
+            results = self.model.predict(images, conf=conf, iou=self.iou, imgsz=self.imgsz, device=self.device,
+                                         max_det=self.max_det, verbose=False)
+        detections = []
+        for result in results:
+            boxes = result.boxes
+            detections.append([
+                {
+                    "bbox": [int(round(v)) for v in xyxy],
+                    "class_id": int(cls),
+                    "class_name": result.names[int(cls)],
+                    "conf": float(score)
+                }
+                for xyxy, cls, score in zip(boxes.xyxy.tolist(), boxes.cls.tolist(), boxes.conf.tolist())
+            ])
+        return detections
+
+def create_detector(yolo_config):
+    """
+    根据 yolo 配置块创建检测器
+
+    backend 为 'onnx' 时使用ONNX Runtime，为 'ultralytics' 时使用ultralytics；
+    未配置时按模型文件扩展名选择（.onnx 使用ONNX Runtime）。
+    """
+    model_path = yolo_config.get("model_path", "weights/best.pt")
+    backend = yolo_config.get("backend") or ("onnx" if os.path.splitext(model_path)[1].lower() == ".onnx" else "ultralytics")
+    if backend == "onnx":
+        return OnnxDetector(
+            model_path,
+            imgsz=yolo_config.get("imgsz", 640),
+            iou=yolo_config.get("iou_threshold", 0.45),
+            max_det=yolo_config.get("max_det", 300),
+            class_names=yolo_config.get("class_names"),
+            providers=yolo_config.get("providers"),
+            intra_op_threads=yolo_config.get("intra_op_threads"),
+            output_format=yolo_config.get("output_format", "v8")
+        )
+    if backend == "ultralytics":
+        return UltralyticsDetector(
+            model_path,
+            device=yolo_config.get("device", None),
+            imgsz=yolo_config.get("imgsz", 640),
+            iou=yolo_config.get("iou_threshold", 0.45),
+            max_det=yolo_config.get("max_det", 300)
+        )
+    raise ValueError(f"未知的YOLO后端: {backend}")
+
+class VLMGatePolicy:
+    """
+    VLM送检策略：按YOLO对盖板缺失类别的最高置信度决定是否需要VLM确认
+
+        - 最高置信度 >= accept_above：直接判定盖板缺失，不调用VLM（accept）
+        - 最高置信度 <  skip_below：视为误检，直接判定盖板存在，不调用VLM（reject）
+        - 其余（不确定区间）：送VLM确认（escalate）
+    两个阈值都为None时所有盖板缺失检测都送VLM，与不设策略时相同。
+    """
+
+    def __init__(self, open_class_names=("gaiban_open",), skip_below=None, accept_above=None):
+        self.open_class_names = set(open_class_names)
+        self.skip_below = skip_below
+        self.accept_above = accept_above
+        self._lock = threading.Lock()
+        self._stats = {"no_open": 0, "accept": 0, "reject": 0, "escalate": 0}
+
+    @classmethod
+    def from_config(cls, yolo_config):
+        """根据 yolo 配置块创建策略，阈值取自 yolo.gate"""
+        gate_config = yolo_config.get("gate", {})
+        return cls(
+            open_class_names=yolo_config.get("open_class_names", ["gaiban_open"]),
+            skip_below=gate_config.get("skip_below", None),
+            accept_above=gate_config.get("accept_above", None)
+        )
+
+    def open_objects(self, objects):
+        """筛选出盖板缺失类别的检测结果"""
+        return [obj for obj in objects if obj["class_name"] in self.open_class_names]
+
+    def decide(self, open_objects):
+        """
+        Returns:
+            str: 'no_open'（没有盖板缺失检测）、'accept'、'reject' 或 'escalate'
+        """
+        if not open_objects:
+            decision = "no_open"
+        else:
+            max_conf = max(obj["conf"] for obj in open_objects)
+            if self.accept_above is not None and max_conf >= self.accept_above:
+                decision = "accept"
+            elif self.skip_below is not None and max_conf < self.skip_below:
+                decision = "reject"
+            else:
+                decision = "escalate"
+        with self._lock:
+            self._stats[decision] += 1
+        return decision
+
+    def stats(self):
+        """各类决策的次数，以及盖板缺失检测中送VLM的比例"""
+        with self._lock:
+            stats = dict(self._stats)
+        gated = stats["accept"] + stats["reject"] + stats["escalate"]
+        stats["escalation_rate"] = stats["escalate"] / gated if gated > 0 else 0
+        return stats